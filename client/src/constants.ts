@@ -15,6 +15,7 @@ export const Routes = {
   validatePassword: '/validate-password', // Validate password
   deleteUser: '/delete-user', // Delete user
   getUserName: '/get-username', // Get username of user with specified id
+  getUserNames: '/get-usernames', // Get usernames of many users at once
 
   /// Order management
   placeOrder: '/place-order', // Place new order
@@ -22,7 +23,9 @@ export const Routes = {
   getOrderDetails: '/get-order', // Get details of a specific order
   takeInOrder: '/take-in-order', // Take in an order
   getUserOrders: '/get-user-orders', // Get all orders of a specific user
+  getPlacedOrders: '/get-placed-orders', // Get all orders placed by the user
   getOrderUsers: '/get-order-users', // Get all users of a specific order
+  orderEvents: '/order-events', // Stream of order changes (Server-Sent Events)
 
   submitOrder: '/submit-order', // Submit an order
 } as const;
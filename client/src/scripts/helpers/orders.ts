@@ -3,6 +3,7 @@ export type Order = {
   name: string;
   description: string;
   recipient: number; // Assigned by the server
+  recipientName?: string; // Only when requested with names
   deadline: string;
   placed: string;
   taken: boolean;
@@ -283,7 +283,10 @@ export const getUserName = (id:number): Promise<string> => {
       },
       data: { id },
       crossDomain: true,
-      success: (response) => resolve(response.username),
+      success: (response) => {
+        cachedNames[id] = response.username;
+        resolve(response.username);
+      },
       error: (xhr) => {
         reject(throwServerError(xhr))        
       },
@@ -291,6 +294,51 @@ export const getUserName = (id:number): Promise<string> => {
   });
 }
 
+/**
+ * Resolves many usernames with a single request
+ * @param ids User ids
+ * @returns map of id to username, unknown ids are left out
+ * @throws server error
+ */
+export const getUserNames = (ids:number[]): Promise<{ [key: number]: string }> => {
+  const missing = [...new Set(ids)].filter((id) => cachedNames[id] == undefined);
+  if(missing.length === 0){
+    return new Promise((resolve) => {
+      resolve({ ...cachedNames });
+    });
+  }
+
+  return new Promise((resolve, reject) => {
+    $.ajax({
+      url: `${SERVER_IP}${Routes.getUserNames}`,
+      method: 'GET',
+      xhrFields: {
+        withCredentials: true,
+      },
+      data: { ids: missing.join(',') },
+      crossDomain: true,
+      success: (response) => {
+        Object.entries(response.usernames).forEach(([id, name]) => {
+          cachedNames[Number(id)] = name as string;
+        });
+        resolve({ ...cachedNames });
+      },
+      error: (xhr) => {
+        reject(throwServerError(xhr))        
+      },
+    });
+  });
+}
+
+// Orders fetched with names embedded already carry the recipient's name
+const cacheRecipientNames = (orders: Order[]) => {
+  orders.forEach((order) => {
+    if(order.recipientName != undefined){
+      cachedNames[order.recipient] = order.recipientName;
+    }
+  });
+}
+
 //// Order Management
 
 export const getUserOrders = (): Promise<Order[]> => {
@@ -301,8 +349,10 @@ export const getUserOrders = (): Promise<Order[]> => {
       xhrFields: {
         withCredentials: true,
       },
+      data: { names: 1 },
       crossDomain: true,
       success: (response) => {
+        cacheRecipientNames(response);
         resolve(response);
       },
       error: (xhr) => {
@@ -313,13 +363,35 @@ export const getUserOrders = (): Promise<Order[]> => {
 }
 
 export const getUserPlacedOrders = (): Promise<Order[]> => {
-  // TODO: Implement
-  return new Promise((resolve) => {
-    resolve([]);
+  return new Promise((resolve, reject) => {
+    $.ajax({
+      url: `${SERVER_IP}${Routes.getPlacedOrders}`,
+      method: 'GET',
+      xhrFields: {
+        withCredentials: true,
+      },
+      crossDomain: true,
+      success: (response) => {
+        resolve(response);
+      },
+      error: (xhr) => {
+        reject(throwServerError(xhr));
+      },
+    })
   });
 }
 
-export const getAvailableOrders = (): Promise<Order[]> => {
+export type OrdersPage = {
+  orders: Order[];
+  next: string | null; // Cursor for the following page, null on the last one
+};
+
+/**
+ * One page of the orders that are still open, newest first
+ * @param cursor next from the previous page, leave out for the first one
+ * @throws ServerError
+ */
+export const getAvailableOrdersPage = (cursor?: string): Promise<OrdersPage> => {
   return new Promise((resolve,reject) => {
     $.ajax({
       url: `${SERVER_IP}${Routes.getAllOrders}`,
@@ -327,9 +399,11 @@ export const getAvailableOrders = (): Promise<Order[]> => {
       xhrFields: {
         withCredentials: true,
       },
+      data: { names: 1, not_expired: 1, not_taken: 1, ...(cursor ? { cursor } : {}) },
       crossDomain: true,
       success: (response) => {
-        resolve(response);
+        cacheRecipientNames(response.orders);
+        resolve({ orders: response.orders, next: response.next });
       },
       error: (xhr) => {
         reject(throwServerError(xhr))        
@@ -338,6 +412,59 @@ export const getAvailableOrders = (): Promise<Order[]> => {
   });
 }
 
+/**
+ * Every order that is still open, following the pages to the end
+ * @throws ServerError
+ */
+export const getAvailableOrders = async (): Promise<Order[]> => {
+  const orders: Order[] = [];
+  let cursor: string | undefined;
+  do {
+    const page = await getAvailableOrdersPage(cursor);
+    orders.push(...page.orders);
+    cursor = page.next ?? undefined;
+  } while (cursor);
+  return orders;
+}
+
+export type OrderEvents = {
+  created?: (order: Order) => void; // Partial order, same fields as getAvailableOrders
+  taken?: (id: number, taker: number) => void;
+  deleted?: (id: number) => void;
+  released?: (id: number) => void; // Its taker deleted their account, the order is open again
+  reset?: () => void; // Missed some changes, refetch the orders
+};
+
+/**
+ * Listens for order changes instead of polling
+ * The browser reconnects by itself and the server replays what was missed
+ * @returns the EventSource, close() it to stop listening
+ */
+export const subscribeOrderEvents = (handlers: OrderEvents): EventSource => {
+  const source = new EventSource(`${SERVER_IP}${Routes.orderEvents}`, {
+    withCredentials: true,
+  });
+
+  source.addEventListener('order.created', (event) => {
+    handlers.created?.(JSON.parse((event as MessageEvent).data));
+  });
+  source.addEventListener('order.taken', (event) => {
+    const data = JSON.parse((event as MessageEvent).data);
+    handlers.taken?.(data.id, data.taker);
+  });
+  source.addEventListener('order.deleted', (event) => {
+    handlers.deleted?.(JSON.parse((event as MessageEvent).data).id);
+  });
+  source.addEventListener('order.released', (event) => {
+    handlers.released?.(JSON.parse((event as MessageEvent).data).id);
+  });
+  source.addEventListener('reset', () => {
+    handlers.reset?.();
+  });
+
+  return source;
+}
+
 export const placeNewOrder = (order: Order): Promise<boolean> => {
   return new Promise((resolve, reject) => {
     $.ajax({
@@ -392,7 +519,7 @@ export const takeInOrder = (oid:number): Promise<boolean> => {
       crossDomain: true,
       success: () => resolve(true),
       error: (xhr) => {
-        const err = throwServerError(xhr, [400]);
+        const err = throwServerError(xhr, [400, 409]); // 409: someone took it first
         if(err == null){
           // Expected error
           resolve(false);
@@ -0,0 +1,368 @@
+"""
+Load test for the hot routes, against a seeded SQLite database.
+
+    python server/bench/bench.py --users 200 --orders 5000 --requests 2000 --concurrency 16
+    python server/bench/bench.py --save-baseline local    # write baselines/local.json
+    python server/bench/bench.py --baseline local         # compare, exit 1 on regression
+
+By default requests go through Flask's test client in this process, so results measure
+the server code and not the network. --url drives an already running server instead
+(it has to be started with the same DB_URL and STATIC_DIR so the seeded data is there).
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+bench_dir = os.path.abspath(os.path.dirname(__file__))
+src_dir = os.path.abspath(os.path.join(bench_dir, '..', 'src'))
+baseline_dir = os.path.join(bench_dir, 'baselines')
+
+PASSWORD = 'benchmark-password'
+ROUTES = ('login', 'register', 'all-orders', 'order', 'user-orders', 'submit', 'prof-pic')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the server routes')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--taken', type=float, default=0.2, help='fraction of orders taken by someone')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--upload-size', type=int, default=256 * 1024)
+    parser.add_argument('--seed', type=int, default=50)
+    parser.add_argument('--url', help='running server to drive over HTTP instead of the test client')
+    parser.add_argument('--workdir', help='keep the database and static files here instead of a temp folder')
+    parser.add_argument('--replicas', type=int, default=0, help='read replicas, all pointing at the same database file')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--baseline', metavar='NAME', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before failing')
+    return parser.parse_args()
+
+
+##### SETUP #####
+
+def boot(workdir, replicas=0):
+    """Import the app against a SQLite database in workdir"""
+    os.environ['DB_URL'] = f'sqlite:///{os.path.join(workdir, "bench.db")}'
+    # Replicas of the same file never lag, but reads take the routing path
+    os.environ['DB_REPLICAS'] = ','.join([os.environ['DB_URL']] * replicas)
+    os.environ['STATIC_DIR'] = os.path.join(workdir, 'static')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('CACHE_TYPE', 'memory')
+    os.environ['AUTO_MIGRATE'] = 'True' # Fresh database every run
+    os.environ['SWEEP_INTERVAL'] = '0' # No background work skewing the numbers
+    os.environ['RATE_LIMIT'] = 'False' # Every bench user logs in from the same address
+
+    sys.path.insert(0, src_dir)
+    import app as server
+    server.setup()
+    server.create_app()
+    return server
+
+
+def check_plans(db):
+    from helpers import plans
+
+    with db.engine.connect() as connection:
+        plans.analyze(connection)
+        return plans.check_plans(connection)
+
+
+def seed(server, args, rng):
+    from helpers.sql_helper import User
+
+    db = server.db
+    phash = server.hasher.hash(PASSWORD) # One hash for everyone, seeding shouldn't take minutes
+
+    for index in range(args.users):
+        db.create.user(User(name=f'user{index}', phash=phash))
+    uids = [db.read.user(username=f'user{index}').uid for index in range(args.users)]
+
+    now = datetime.now()
+    oids = []
+    per_user = max(args.orders // max(len(uids), 1), 1)
+    for uid in uids:
+        rows = [{
+            'name': f'order {rng.randrange(10**6)}',
+            'description': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 200))),
+            'deadline': now + timedelta(days=rng.randint(1, 90)),
+        } for _ in range(per_user)]
+        oids.extend(db.create.orders_bulk(rows, uid))
+
+    taken = rng.sample(oids, int(len(oids) * args.taken))
+    for oid in taken:
+        db.create.taken_order(rng.choice(uids), oid)
+
+    # The avatar every user without a picture gets
+    from PIL import Image
+    Image.new('RGB', (512, 512), (90, 120, 200)).save(os.path.join(server.profile_folder, 'DEFAULT.png'))
+
+    return uids, oids
+
+
+WORDS = (
+    'story novel chapter draft essay poem article review letter report thesis script dragon '
+    'history science fantasy mystery romance deadline editor publish manuscript character plot'
+).split()
+
+
+##### CLIENTS #####
+
+class TestClient:
+    def __init__(self, server):
+        self.client = server.app.test_client()
+
+    def request(self, method, path, **kwargs):
+        response = self.client.open(path, method=method, **kwargs)
+        response.close()
+        return response.status_code
+
+    def text(self, path):
+        return self.client.get(path).get_data(as_text=True)
+
+
+class HttpClient:
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.session.verify = False
+
+    def request(self, method, path, data=None, query_string=None):
+        files = None
+        if data and 'file' in data:
+            data = dict(data)
+            stream, name = data.pop('file')
+            files = {'file': (name, stream)}
+        return self.session.request(method, self.url + path, data=data, files=files, params=query_string).status_code
+
+    def text(self, path):
+        return self.session.get(self.url + path).text
+
+
+##### LOAD #####
+
+def make_request(route, client, rng, user, oids, payload):
+    if route == 'login':
+        return client.request('POST', '/login', data={'username': user, 'password': PASSWORD})
+    if route == 'register':
+        # A new name every time, a taken one is a 400 and would count as an error
+        return client.request('POST', '/register', data={
+            'username': f'new{rng.getrandbits(64):x}',
+            'password': PASSWORD,
+            'email': 'bench@example.com',
+        })
+    if route == 'all-orders':
+        return client.request('GET', '/get-all-orders', query_string={'names': 1})
+    if route == 'order':
+        return client.request('GET', '/get-order', query_string={'id': rng.choice(oids)})
+    if route == 'user-orders':
+        return client.request('GET', '/get-user-orders', query_string={'names': 1})
+    if route == 'submit':
+        return client.request('POST', '/submit-order', data={
+            'order': rng.choice(oids),
+            'file': (io.BytesIO(payload), 'draft.pdf'),
+        })
+    if route == 'prof-pic':
+        return client.request('GET', '/prof-pic/DEFAULT.png', query_string={'size': 128})
+    raise ValueError(f'Unknown route: {route}')
+
+
+def run_route(route, clients, args, uids, oids, seed):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_worker = args.requests // len(clients)
+
+    def worker(index, client):
+        rng = random.Random(seed * 1000 + index)
+        # Every worker logs in as some user and uploads its own file, repeated uploads hit dedup
+        user = f'user{rng.randrange(len(uids))}'
+        payload = bytes(rng.getrandbits(8) for _ in range(64)) * (args.upload_size // 64)
+
+        client.request('POST', '/login', data={'username': user, 'password': PASSWORD})
+
+        local = []
+        failed = 0
+        for _ in range(per_worker):
+            started = time.perf_counter()
+            status = make_request(route, client, rng, user, oids, payload)
+            local.append(time.perf_counter() - started)
+            if status >= 400:
+                failed += 1
+
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(index, client)) for index, client in enumerate(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return latencies, errors[0], elapsed
+
+
+##### REPORT #####
+
+METRIC_LINE = re.compile(r'^http_request_sql_queries_(sum|count)\{route="([^"]*)"\} (\S+)$')
+
+def scrape_queries(client):
+    """{route: [queries, requests]} from the /metrics endpoint"""
+    totals = {}
+    for line in client.text('/metrics').splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            kind, route, value = match.groups()
+            totals.setdefault(route, [0.0, 0.0])[0 if kind == 'sum' else 1] = float(value)
+    return totals
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+ROUTE_PATHS = {
+    'login': '/login',
+    'register': '/register',
+    'all-orders': '/get-all-orders',
+    'order': '/get-order',
+    'user-orders': '/get-user-orders',
+    'submit': '/submit-order',
+    'prof-pic': '/prof-pic/<path:filename>',
+}
+
+def summarize(route, latencies, errors, elapsed, before, after):
+    path = ROUTE_PATHS[route]
+    queries, requests = after.get(path, [0, 0])
+    old_queries, old_requests = before.get(path, [0, 0])
+    served = requests - old_requests
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'queries_per_request': (queries - old_queries) / served if served else 0.0,
+    }
+
+
+def print_report(results):
+    print(f'{"route":<12} {"req":>6} {"err":>5} {"req/s":>9} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8} {"q/req":>6}')
+    for route, result in results.items():
+        print(
+            f'{route:<12} {result["requests"]:>6} {result["errors"]:>5} {result["throughput"]:>9.1f} '
+            f'{result["p50_ms"]:>8.2f} {result["p90_ms"]:>8.2f} {result["p99_ms"]:>8.2f} '
+            f'{result["max_ms"]:>8.2f} {result["queries_per_request"]:>6.2f}'
+        )
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing regressions against baseline, empty if there are none"""
+    regressions = []
+    for route, result in results.items():
+        old = baseline.get(route)
+        if old is None:
+            continue
+
+        for key in ('p50_ms', 'p99_ms'):
+            if result[key] > old[key] * (1 + tolerance):
+                regressions.append(f'{route} {key}: {old[key]:.2f} -> {result[key]:.2f}')
+        if result['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append(f'{route} throughput: {old["throughput"]:.1f} -> {result["throughput"]:.1f}')
+        # Query counts are deterministic, any increase is a regression
+        if result['queries_per_request'] > old['queries_per_request'] + 0.01:
+            regressions.append(
+                f'{route} queries/request: {old["queries_per_request"]:.2f} -> {result["queries_per_request"]:.2f}'
+            )
+        if result['errors'] > old['errors']:
+            regressions.append(f'{route} errors: {old["errors"]} -> {result["errors"]}')
+    return regressions
+
+
+def main():
+    args = parse_args()
+    routes = [route for route in args.routes.split(',') if route]
+    for route in routes:
+        if route not in ROUTES:
+            sys.exit(f'Unknown route {route}, pick from {", ".join(ROUTES)}')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='cs50-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    rng = random.Random(args.seed)
+
+    try:
+        server = boot(workdir, args.replicas)
+
+        started = time.perf_counter()
+        uids, oids = seed(server, args, rng)
+        print(f'Seeded {len(uids)} users and {len(oids)} orders in {time.perf_counter() - started:.1f}s')
+
+        # A hot query reading a whole table fails the run, same check as migrate.py plans
+        full_scans = check_plans(server.db)
+
+        if args.url:
+            clients = [HttpClient(args.url) for _ in range(args.concurrency)]
+            scraper = HttpClient(args.url)
+        else:
+            clients = [TestClient(server) for _ in range(args.concurrency)]
+            scraper = TestClient(server)
+
+        results = {}
+        for index, route in enumerate(routes):
+            before = scrape_queries(scraper)
+            latencies, errors, elapsed = run_route(route, clients, args, uids, oids, args.seed + index)
+            results[route] = summarize(route, latencies, errors, elapsed, before, scrape_queries(scraper))
+
+        print_report(results)
+
+        if full_scans:
+            print('\nFull table scans:')
+            for name, lines in full_scans.items():
+                print(f'  {name}: {"; ".join(lines)}')
+
+        if args.save_baseline:
+            os.makedirs(baseline_dir, exist_ok=True)
+            path = os.path.join(baseline_dir, f'{args.save_baseline}.json')
+            with open(path, 'w') as file:
+                json.dump({'args': vars(args), 'results': results}, file, indent=2)
+            print(f'Baseline saved to {path}')
+
+        if args.baseline:
+            with open(os.path.join(baseline_dir, f'{args.baseline}.json')) as file:
+                baseline = json.load(file)['results']
+
+            regressions = compare(results, baseline, args.tolerance)
+            if regressions:
+                print('\nRegressions:')
+                for line in regressions:
+                    print(f'  {line}')
+                sys.exit(1)
+            print('\nNo regressions')
+
+        if full_scans:
+            sys.exit(1)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,40 @@
 # Python standard library imports
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.parser import isoparse
 import os
 from enum import Enum
-from base64 import b64decode
+from base64 import b64decode, urlsafe_b64encode, urlsafe_b64decode
 import uuid
+import tempfile
+import json
 from shutil import move
 
 # Library imports
-from werkzeug.security import generate_password_hash, check_password_hash
 from PIL import Image
 
 # Flask imports
-from flask import Flask, jsonify, request, send_from_directory, session, make_response, send_file
+from flask import Flask, Response, jsonify, request, send_from_directory, session, make_response, send_file
 from flask_cors import CORS, cross_origin
+from werkzeug.http import parse_etags
+from sqlalchemy import create_engine
 
 # Project imports
-from helpers.sql_helper import MySQL, User, Order, Submission, TakenOrder, Document
-from helpers.validation import validateUsername, validadePassword, validateEmail, login_required
+from helpers.sql_helper import MySQL, User, Order, Submission, Document, full_url
+from helpers.validation import validateUsername, validadePassword, validateEmail, validateOrder, login_required
+from helpers.cache import make_cache, connect_store
+from helpers.uploads import UploadRequest, HashingFile, copy_stream, clean_extension, commit, keep
+from helpers.images import ImageWorkers, is_image, pick_variant, variant_name, remove_avatar
+from helpers.passwords import PasswordHasher, HasherBusy, DEFAULT_METHOD
+from helpers import metrics
+from helpers.static_files import StaticFolder
+from helpers.sessions import ServerSessionInterface, make_session_interface
+from helpers.events import EventHub, SharedBroker
+from helpers.serializer import SerializerJSONProvider, make_serializer, stream_list
+from helpers.sweeper import OrderSweeper
+from helpers.replicas import begin_routing, wrote
+from helpers.compression import Compressor, PrecompressedFiles, compress_responses, parse_levels
+from helpers.limits import RateLimiter, RateLimited, AdmissionControl, Overloaded, make_bucket_store, parse_rate
+import migrations
 
 #### Initial setup
 IN_DOCKER = os.getenv('IN_DOCKER',False)
@@ -66,65 +83,64 @@ if IN_DEBUG:
 app_dir = os.path.abspath(os.path.dirname(__file__))
 base_dir = os.path.abspath(os.path.join(app_dir, '..', '..',)) # Go down two directories
 
-if IN_DOCKER:
+if os.getenv('STATIC_DIR'):
+    static_dir = os.path.abspath(os.getenv('STATIC_DIR')) # Set explicitly, benchmarks use a scratch folder
+elif IN_DOCKER:
     static_dir = os.path.abspath(f'{(base_dir)}server-data/static/')  # From base go up to server-data and then to static
 else:
     static_dir = os.path.abspath(f'{(base_dir)}/static/')    # From base go up to static
 
 ## Subpaths in static folder
 submission_folder = os.path.join(static_dir,'submissions')
-if not os.path.exists(submission_folder):
-    os.makedirs(submission_folder)
-
 profile_folder = os.path.join(static_dir,'profile')
-if not os.path.exists(profile_folder):
-    os.makedirs(profile_folder)
+
+# Uploads in progress, same filesystem as the folders above so storing them is a rename
+upload_folder = os.path.join(static_dir,'uploads')
+
+# Compressed copies of the files above
+compressed_folder = os.path.join(static_dir,'compressed')
 
 if IN_DEBUG:
     print(f'App dir: {app_dir}')
     print(f'Base dir: {base_dir}')
     print(f'Static dir: {static_dir}')
 
-# Default profile image has to be in static folder for the CDN to work
-# Docker can't copy to the volume during build, so we create the folder and copy the image here
-if IN_DOCKER:
-    if not os.path.exists(static_dir):
-        # Static folder won't exist on first run
-        os.makedirs(static_dir)
-        if IN_DEBUG:
-            print('Created static folder')
-
-    source_file = os.path.abspath(os.path.join(base_dir, 'app', 'static', 'DEFAULT.png'))
-    destination_file = os.path.join(profile_folder, 'DEFAULT.png')
-
-    if IN_DEBUG:
-        print(f'Source: {source_file}')
-        print(f'Destination: {destination_file}')
+#### Paths setup finished, the app is configured here
+# Importing this module has no side effects, so a pre-fork server can import it in its master.
+# setup() does the one-time work (folders, default image, schema) and runs once, in the master.
+# create_app() builds the per-process state (database engine, worker pools) and runs in every worker, after fork.
 
-    try:
-        move(source_file, destination_file)
-        if IN_DEBUG:
-            print('Moved default image to static folder')
+app = Flask(__name__)
 
-    except Exception as e:
-        print(e)
-        print('Failed to move default image to static folder')
+# Uploads are streamed to disk while the body is parsed
+upload_max_size = int(os.getenv('UPLOAD_MAX_SIZE', 50 * 1024 * 1024))
+upload_chunk_size = int(os.getenv('UPLOAD_CHUNK_SIZE', 64 * 1024))
 
-#### Inital setup finished, server initializes here
+UploadRequest.upload_folder = upload_folder
+UploadRequest.max_file_size = upload_max_size
+app.request_class = UploadRequest
 
-if IN_DEBUG:
-    print()
-    print('Initial setup finished, server initializing\n')
-
-app = Flask(__name__)
+# Bodies with a larger Content-Length are refused before anything is read
+app.config['MAX_CONTENT_LENGTH'] = upload_max_size + 64 * 1024 # Room for the other form fields
 
 # CORS, all origins
 CORS(
     app,
     supports_credentials=True,
-    resources={r"/*": {"origins": "*"}}
+    resources={r"/*": {"origins": "*"}},
+    expose_headers=['ETag', 'X-Order-Version'],
 )
 
+# Orders past their deadline move to the archive, SWEEP_INTERVAL=0 turns the sweeper off
+sweep_interval = int(os.getenv('SWEEP_INTERVAL', 300))
+sweep_batch = int(os.getenv('SWEEP_BATCH', 200))
+sweep_grace = timedelta(hours=float(os.getenv('SWEEP_GRACE_HOURS', 24)))
+changes_ttl = timedelta(days=float(os.getenv('ORDER_CHANGES_TTL_DAYS', 7)))
+
+# JSON encoder behind jsonify(), orjson when installed (auto), or json for the standard library
+serializer = make_serializer(os.getenv('JSON_SERIALIZER', 'auto'))
+app.json = SerializerJSONProvider(app, serializer)
+
 # HTTPS stuff
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 cert_pem = os.path.join(app_dir, 'localhost.pem')
@@ -134,9 +150,37 @@ if IN_DEBUG:
     print(f'Cert: {cert_pem}')
     print(f'Key: {key_pem}')
 
-# Session
+# Worker processes serving the app, gunicorn.conf.py and asgi.py set it for the ones they start
+web_workers = int(os.getenv('WEB_WORKERS', 1))
+
+# Key-value server shared by the workers (redis://host:6379/0), for sessions, the cache and order events
+# Without one every "shared" store is kept in each process
+shared_store_url = os.getenv('SHARED_STORE_URL') or None
+shared_store = connect_store(shared_store_url) if shared_store_url else None
+
+def per_process(kind):
+    """A store of this kind is only seen by the process that has it"""
+    return kind == 'memory' or (kind == 'shared' and shared_store is None)
+
+# Session, the cookie holds an id and the data is kept server side (memory, shared) or the signed cookie (cookie)
+# auto is shared with a shared store, else memory for one worker and cookie for several
 app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
+session_type = os.getenv('SESSION_STORE', 'auto')
+if session_type == 'auto':
+    session_type = 'shared' if shared_store is not None else 'memory' if web_workers == 1 else 'cookie'
+session_ttl = int(os.getenv('SESSION_TTL', 86400))
+
+# A login would only be known to the worker that handled it
+if web_workers > 1 and per_process(session_type):
+    raise RuntimeError(
+        f"SESSION_STORE={session_type} keeps sessions in each of the {web_workers} workers, "
+        "set SHARED_STORE_URL or use SESSION_STORE=cookie"
+    )
+
+app.session_interface = make_session_interface(session_type, ttl=session_ttl, client=shared_store)
+
+if IN_DEBUG:
+    print(f'Sessions: {session_type} ttl={session_ttl}s')
 
 
 # Connect to database
@@ -148,25 +192,381 @@ db_port = os.getenv("DB_PORT")
 
 dbConnection = "{}:{}@{}:{}/{}".format(db_user,db_pass,db_host,db_port,db_name)
 
+# A full SQLAlchemy url replaces the above, sqlite:///bench.db for benchmarks
+if os.getenv('DB_URL'):
+    dbConnection = os.getenv('DB_URL')
+
 if IN_DEBUG:
     print(f'DB Connection: {dbConnection}')
 
-db = MySQL(dbConnection)
+# Read replicas, a comma separated list in the same form as the connection above
+# Reads go to them, writes and the reads of a client that just wrote go to the primary
+db_replicas = [url.strip() for url in os.getenv('DB_REPLICAS', '').split(',') if url.strip()]
+replica_check_interval = float(os.getenv('REPLICA_CHECK_INTERVAL', 5))
+replica_max_lag = float(os.getenv('REPLICA_MAX_LAG')) if os.getenv('REPLICA_MAX_LAG') else None
+read_sticky_seconds = int(os.getenv('READ_STICKY_SECONDS', 5)) # Longer than the replicas usually lag
+STICKY_COOKIE = 'reads_primary'
+
+if IN_DEBUG and db_replicas:
+    print(f'DB Replicas: {db_replicas}')
+
+# Startup refuses to run on an old schema, unless told to migrate it itself (development, benchmarks)
+auto_migrate = os.getenv('AUTO_MIGRATE', 'False') == 'True'
+
+# Read cache, memory (per process), shared or none
+# auto is shared with a shared store, else memory for one worker and none for several
+cache_type = os.getenv('CACHE_TYPE', 'auto')
+if cache_type == 'auto':
+    cache_type = 'shared' if shared_store is not None else 'memory' if web_workers == 1 else 'none'
+
+# Writes only clear the cache of the worker that made them, the others would serve stale rows
+if web_workers > 1 and per_process(cache_type):
+    raise RuntimeError(
+        f"CACHE_TYPE={cache_type} keeps a cache in each of the {web_workers} workers, "
+        "set SHARED_STORE_URL or use CACHE_TYPE=none"
+    )
+cache_size = int(os.getenv('CACHE_SIZE', 4096))
+cache_ttl = int(os.getenv('CACHE_TTL', 300))
+
+if IN_DEBUG:
+    print(f'Cache: {cache_type} size={cache_size} ttl={cache_ttl}s')
+
+# Order events for /order-events, EVENTS=False turns the stream off
+# Changes reach the other workers through the shared store, without one a stream only sees its own worker's
+events_enabled = os.getenv('EVENTS', 'True') == 'True'
+if events_enabled and web_workers > 1 and shared_store is None:
+    raise RuntimeError(
+        f"Order events need SHARED_STORE_URL to reach all {web_workers} workers, or EVENTS=False"
+    )
 
+# Under gunicorn every stream holds one of the WEB_THREADS threads of its worker, these many at most
+# The async server (asgi.py) keeps them on the event loop and has no limit
+events_max_sync_streams = int(os.getenv('EVENTS_MAX_SYNC_STREAMS', max(1, int(os.getenv('WEB_THREADS', 4)) // 2)))
 
 # Extras
 app.config['STATIC_FOLDER'] = static_dir
 
-if IN_DEBUG:
-    print()
-    print('Server initialized\n')
+# Static files can be handed to the front server, sendfile (X-Sendfile) or accel (nginx X-Accel-Redirect)
+static_offload = os.getenv('STATIC_OFFLOAD') or None
+static_accel_prefix = os.getenv('STATIC_ACCEL_PREFIX', '/protected')
+
+# Response compression, negotiated from Accept-Encoding, COMPRESS=False turns it off
+# COMPRESS_LEVELS sets levels per type, as in application/json=br:5,gzip:6;image/svg+xml=zstd:9
+compressor = None
+if os.getenv('COMPRESS', 'True') == 'True':
+    compressor = Compressor(
+        threshold=int(os.getenv('COMPRESS_MIN_SIZE', 1024)),
+        encodings=[encoding.strip() for encoding in os.getenv('COMPRESS_ENCODINGS', 'zstd,br,gzip').split(',')],
+        levels=parse_levels(os.getenv('COMPRESS_LEVELS', '')),
+    )
+    compress_responses(app, compressor)
+
+    if IN_DEBUG:
+        print(f'Compression: {compressor.encodings} over {compressor.threshold} bytes')
+
+# Rate limits, a token bucket per client IP (and uid once logged in) for each rule
+# RATE_* are requests/seconds, RATE_LIMIT=False turns them off
+# RATE_LIMIT_STORE is memory (per process, each worker allows the full rate), shared, or auto for shared when there is a shared store
+rate_limit_store = os.getenv('RATE_LIMIT_STORE', 'auto')
+if rate_limit_store == 'auto':
+    rate_limit_store = 'shared' if shared_store is not None else 'memory'
+limiter = RateLimiter(
+    make_bucket_store(rate_limit_store, client=shared_store),
+    {
+        'login': parse_rate(os.getenv('RATE_LOGIN', '10/60')),
+        'register': parse_rate(os.getenv('RATE_REGISTER', '5/600')),
+        'check-user': parse_rate(os.getenv('RATE_CHECK_USER', '30/60')),
+        'submit': parse_rate(os.getenv('RATE_SUBMIT', '30/60')),
+    },
+    enabled=os.getenv('RATE_LIMIT', 'True') == 'True',
+)
+
+# Load shedding, requests get a 503 while a database checkout has waited over ADMIT_POOL_WAIT seconds,
+# and uploads past ADMIT_MAX_UPLOADS at once in a process. ADMISSION_CONTROL=False turns it off
+admission = AdmissionControl(
+    metrics.pool_waiting,
+    max_pool_wait=float(os.getenv('ADMIT_POOL_WAIT', 1.0)),
+    max_uploads=int(os.getenv('ADMIT_MAX_UPLOADS', 16)),
+    enabled=os.getenv('ADMISSION_CONTROL', 'True') == 'True',
+)
+ADMISSION_EXEMPT = {'health', 'prometheus_metrics', 'serve_image'} # No database, or needed to see the overload
+
+# Static text files are compressed once, on first request, into compressed_folder
+# Larger ones than PRECOMPRESS_MAX_SIZE are sent as they are
+precompressed = None
+if compressor:
+    precompressed = PrecompressedFiles(
+        compressed_folder,
+        compressor,
+        max_size=int(os.getenv('PRECOMPRESS_MAX_SIZE', 1024 * 1024)),
+    )
+
+profile_files = StaticFolder(
+    profile_folder,
+    offload=static_offload,
+    accel_prefix=f'{static_accel_prefix}/profile',
+    precompressed=precompressed,
+)
+submission_files = StaticFolder(
+    submission_folder,
+    offload=static_offload,
+    accel_prefix=f'{static_accel_prefix}/submissions',
+    precompressed=precompressed,
+    private=True, # Behind a login
+)
+
+# Request metrics, PROFILE_SLOW_MS turns on the sampling profiler for requests slower than that
+profile_slow_ms = os.getenv('PROFILE_SLOW_MS')
+profiler = None
+if profile_slow_ms:
+    profiler = metrics.SlowRequestProfiler(
+        os.path.join(base_dir, 'profiles'),
+        threshold=int(profile_slow_ms) / 1000,
+        interval=float(os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000,
+    )
+    if IN_DEBUG:
+        print(f'Profiling requests slower than {profile_slow_ms}ms')
+
+metrics.instrument_app(app, profiler)
+
+metrics.registry.add(metrics.Gauge(
+    'cache_events', 'Read cache counters by event',
+    lambda: {(event,): value for event, value in db.cache.stats.as_dict().items() if event != 'hit_ratio'},
+    labels=('event',),
+))
+metrics.registry.add(metrics.Gauge(
+    'password_hash_seconds', 'Password hasher queue wait and hash time',
+    lambda: {(stat,): value for stat, value in hasher.stats.as_dict().items() if stat not in ('count', 'rejected')},
+    labels=('stat',),
+))
+metrics.registry.add(metrics.Gauge(
+    'password_hash_requests', 'Password hashes done and rejected for a full queue',
+    lambda: {('done',): hasher.stats.count, ('rejected',): hasher.stats.rejected},
+    labels=('result',),
+))
+def poolConnections():
+    engines = [('primary', db.engine)]
+    if db.replicas is not None:
+        engines += [(replica.name, replica.engine) for replica in db.replicas.replicas]
+
+    values = {}
+    for name, engine in engines:
+        values[(name, 'checked_out')] = engine.pool.checkedout()
+        values[(name, 'idle')] = engine.pool.checkedin()
+        values[(name, 'overflow')] = max(engine.pool.overflow(), 0)
+    return values
+
+metrics.registry.add(metrics.Gauge(
+    'db_pool_connections', 'Connections in the pool by database and state',
+    poolConnections,
+    labels=('pool', 'state'),
+))
+metrics.registry.add(metrics.Gauge(
+    'db_replica', 'Read replica health (1 healthy), lag in seconds, reads routed and failed checks',
+    lambda: {
+        (name, stat): float(value) for name, stats in db.replicas.stats().items()
+        for stat, value in stats.items() if stat != 'last_error' and value is not None
+    } if db.replicas else {},
+    labels=('replica', 'stat'),
+))
+metrics.registry.add(metrics.Gauge(
+    'compression', 'Compressed responses and their bytes before and after, by encoding',
+    lambda: compressor.stats.as_dict() if compressor else {},
+    labels=('encoding', 'stat'),
+))
+metrics.registry.add(metrics.Gauge(
+    'rate_limit_requests', 'Requests let through and refused by rate limit rule',
+    lambda: limiter.stats(),
+    labels=('rule', 'result'),
+))
+metrics.registry.add(metrics.Gauge(
+    'admission', 'Requests shed for load, uploads running and database checkouts waiting, in this process',
+    lambda: admission.stats(),
+    labels=('stat',),
+))
+metrics.registry.add(metrics.Gauge(
+    'order_sweeper', 'Expired order sweeper counters, in this process',
+    lambda: {(stat,): value for stat, value in sweeper.stats.as_dict().items()} if sweeper else {},
+    labels=('stat',),
+))
+metrics.registry.add(metrics.Gauge(
+    'order_event_streams', 'Open /order-events streams and streams dropped for falling behind',
+    lambda: {('open',): events.subscribers(), ('dropped',): events.dropped} if events is not None else {},
+    labels=('state',),
+))
+
+#### Per-process state, built by create_app()
+db = None
+hasher = None
+image_workers = None
+events = None
+sweeper = None
+
+def setup():
+    """One-time setup, run once before any worker starts"""
+    for folder in (submission_folder, profile_folder, upload_folder, compressed_folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    # Default profile image has to be in static folder for the CDN to work
+    # Docker can't copy to the volume during build, so we copy the image here
+    if IN_DOCKER:
+        source_file = os.path.abspath(os.path.join(base_dir, 'app', 'static', 'DEFAULT.png'))
+        destination_file = os.path.join(profile_folder, 'DEFAULT.png')
+
+        if IN_DEBUG:
+            print(f'Source: {source_file}')
+            print(f'Destination: {destination_file}')
+
+        try:
+            move(source_file, destination_file)
+            if IN_DEBUG:
+                print('Moved default image to static folder')
+
+        except Exception as e:
+            print(e)
+            print('Failed to move default image to static folder')
+
+    # Only compares the schema version, migrate.py applies the changes
+    # Short lived engine, workers build their own after fork
+    engine = create_engine(full_url(dbConnection))
+    try:
+        if auto_migrate:
+            migrations.upgrade(engine)
+        else:
+            migrations.check(engine)
+    finally:
+        engine.dispose()
+
+    if IN_DEBUG:
+        print()
+        print('Initial setup finished\n')
+
+def create_app():
+    """Build this process' database engine and worker pools, run in every worker after fork"""
+    global db, hasher, image_workers, events, sweeper
+
+    if db is not None:
+        return app
+
+    # Order changes pushed to /order-events streams
+    if events_enabled:
+        events = EventHub(
+            broker=SharedBroker(shared_store) if shared_store is not None else None,
+            backlog=int(os.getenv('EVENTS_BACKLOG', 512)),
+            queue_size=int(os.getenv('EVENTS_QUEUE_SIZE', 256)),
+        )
+
+    db = MySQL(
+        dbConnection,
+        cache=make_cache(cache_type, max_size=cache_size, ttl=cache_ttl, client=shared_store),
+        poolclass=metrics.TimedQueuePool,
+        events=events,
+        replicas=db_replicas,
+        replica_check_interval=replica_check_interval,
+        replica_max_lag=replica_max_lag,
+    )
+    metrics.instrument_engine(db.engine)
+    if db.replicas is not None:
+        for replica in db.replicas.replicas:
+            metrics.instrument_engine(replica.engine)
+        db.replicas.start()
+
+    # Password hashes run in a process pool, PASSWORD_METHOD is a werkzeug method string with its work factor
+    # The cores are split between the web workers, each of them has a pool
+    hasher = PasswordHasher(
+        workers=int(os.getenv('HASH_WORKERS', max(1, (os.cpu_count() or 2) // web_workers))),
+        max_pending=int(os.getenv('HASH_MAX_PENDING', 32)),
+        queue_timeout=float(os.getenv('HASH_QUEUE_TIMEOUT', 1.0)),
+        method=os.getenv('PASSWORD_METHOD', DEFAULT_METHOD),
+    )
+
+    # Avatars are resized off the request thread
+    image_workers = ImageWorkers(int(os.getenv('IMAGE_WORKERS', 2)))
+
+    # Every process has one, the lock file leaves the sweeping to one of them
+    if sweep_interval > 0:
+        sweeper = OrderSweeper(
+            db,
+            interval=sweep_interval,
+            batch_size=sweep_batch,
+            grace=sweep_grace,
+            changes_ttl=changes_ttl,
+            lock_path=os.path.join(tempfile.gettempdir(), 'cs50-order-sweeper.lock'),
+        )
+        sweeper.start()
+
+    if IN_DEBUG:
+        print(f'Server initialized in process {os.getpid()}\n')
+
+    return app
 
 #### Server initialization finished
 
+@app.before_request
+def admit():
+    # Shed before any work is done, waiting for the pool would only make the queue longer
+    if request.endpoint not in ADMISSION_EXEMPT:
+        admission.check_pool()
+
+@app.before_request
+def routeReads():
+    # A client that wrote a moment ago reads from the primary, the replicas may not have its write yet
+    begin_routing(sticky=STICKY_COOKIE in request.cookies)
+
+@app.after_request
+def stickyReads(response):
+    if db.replicas is not None and wrote():
+        response.set_cookie(
+            STICKY_COOKIE,
+            '1',
+            max_age=read_sticky_seconds,
+            httponly=True,
+            secure=app.session_interface.get_cookie_secure(app),
+            samesite=app.session_interface.get_cookie_samesite(app),
+        )
+    return response
+
 @app.route("/health", methods=["GET"])
 def health():
     return "",200
 
+# Prometheus scrape endpoint
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return metrics.registry.render(),200,{'Content-Type':'text/plain; version=0.0.4'}
+
+# Password hasher queue is full
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    return '',503,{'Retry-After':'1'}
+
+# Client over its rate
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    return '',429,{'Retry-After':str(e.retry_after)}
+
+# Shedding load
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    return '',503,{'Retry-After':str(e.retry_after)}
+
+# Hasher counters, queue wait against time spent hashing
+@app.route("/hash-stats", methods=["GET"])
+def hash_stats():
+    if not IN_DEBUG:
+        return "",404
+
+    return jsonify(hasher.stats.as_dict()),200
+
+# Cache counters, for sizing CACHE_SIZE and CACHE_TTL
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    if not IN_DEBUG:
+        return "",404
+
+    return jsonify(db.cache.stats.as_dict()),200
+
 ####### User Management
 
 # Check if username exists in the database
@@ -182,6 +582,7 @@ def userExists(username:str):
 
 # Verify if username exists
 @app.route("/check-user", methods=["POST"])
+@limiter.limit('check-user')
 def check_user():
     toCheck = request.form.get('username')
 
@@ -202,6 +603,7 @@ class RegistResult(Enum):
     SUCCESS = 'SUCCESS' # Success
 
 @app.route("/register", methods=["POST"])
+@limiter.limit('register')
 def register():
 
     if IN_DEBUG:
@@ -257,19 +659,17 @@ def register():
     # Assemble object
     userData = User(
         name=username.lower(),
-        email=email.lower(),
-        phash=generate_password_hash(password)
+        phash=hasher.hash(password)
     )
 
     if IN_DEBUG:
         print('User object created')
         print(f'ID: {userData.uid}')
         print(f'Name: {userData.name}')
-        print(f'Email: {userData.email}')
         print(f'Password: {userData.phash}')
 
     # DB Insertion
-    db.Create.user(userData)
+    db.create.user(userData)
 
     return jsonify({
         'result':RegistResult.SUCCESS.value
@@ -278,6 +678,7 @@ def register():
 
 ##### Login
 @app.route("/login",methods=['POST'])
+@limiter.limit('login')
 def login():
     session.clear()
 
@@ -295,18 +696,28 @@ def login():
             'result':False
         }),400
 
-    user = db.read.user(username=username.lower())
+    user = db.read.user(username=username.lower(), fresh=True)
 
     if not user:
         return jsonify({
             'result':False
         }),400
 
-    if not check_password_hash(user.phash,password):
+    if not hasher.check(user.phash,password):
         return jsonify({
             'result':False
         }),400
 
+    # Hashing parameters changed since this hash was made, we have the password now so redo it
+    if hasher.needs_rehash(user.phash):
+        if IN_DEBUG:
+            print(f'Rehashing password of user {user.uid}')
+        db.update.user(user.uid, User(
+            name=user.name,
+            phash=hasher.hash(password),
+            picture=user.picture
+        ))
+
     session['user'] = user.uid
 
     return jsonify({
@@ -319,6 +730,7 @@ def login():
 @app.route("/logout",methods=['GET'])
 @login_required
 def logout():
+    # Removes the session from the store, the id in the cookie is dead from here on
     session.clear()
     return '',200
 
@@ -327,21 +739,19 @@ def logout():
 @app.route('/get-udata',methods=['GET'])
 @login_required
 def get_user_data():
-    uid = session.get("user")
+    profile = sessionProfile()
 
-    user = db.Read.user(uid=uid)
-
-    if not user:
+    if not profile:
         return '',400
 
     # Ensure image exists
-    if not os.path.exists(f'{profile_folder}/{user.picture}.png'):
-        user.picture = 'DEFAULT'
+    picture = profile['picture']
+    if not os.path.exists(f'{profile_folder}/{picture}.png'):
+        picture = 'DEFAULT'
 
     return jsonify({
-        'username':user.name,
-        'email':user.email,
-        'picture':f'{user.picture}.png'
+        'username':profile['name'],
+        'picture':f'{picture}.png'
     }),200
 
 
@@ -358,12 +768,11 @@ def update_user_data():
             print(f'{key}:{request.form.get(key)}')
         print()
 
-    current_user = db.Read.user(uid=uid)
+    current_user = db.read.user(uid=uid, fresh=True) # Its phash is written back
     if not current_user:
         return '',400
 
     username = request.form.get('username',current_user.name)
-    email = current_user.email
     phash = current_user.phash
 
     # Upload image
@@ -372,21 +781,32 @@ def update_user_data():
         if IN_DEBUG:
             print('Received image')
 
-        if image.content_type != 'image/png':
+        if image.content_type not in ('image/png', 'image/jpeg', 'image/webp'):
             if IN_DEBUG:
                 print('Invalid image type')
             return '',400
 
+        # The upload is already on disk (UploadRequest), check it is an image without decoding it
+        if not is_image(image.stream.path):
+            if IN_DEBUG:
+                print('Invalid image data')
+            return '',400
+
         newImageName = str(uuid.uuid4())
-        image.save(f'{profile_folder/{newImageName}.png}')
+        pending = os.path.join(upload_folder, f'{newImageName}.avatar')
+        with metrics.timed('file_io'):
+            keep(image.stream, pending)
+
+        # Workers write the cleaned image and its resized variants
+        image_workers.submit(pending, profile_folder, newImageName)
 
         if IN_DEBUG:
-            print(f'Image saved as {newImageName}.png')
+            print(f'Image queued as {newImageName}')
 
         # Delete old image
         if current_user.picture != 'DEFAULT':
             try:
-                os.remove(f'{profile_folder/{current_user.picture}.png}')
+                remove_avatar(profile_folder, current_user.picture)
                 if IN_DEBUG:
                     print(f'Deleted {current_user.picture}.png')
             except Exception as e:
@@ -399,7 +819,6 @@ def update_user_data():
     # Update user
     newData = User(
         name=username,
-        email=email,
         phash=phash,
         picture=picture
     )
@@ -407,10 +826,13 @@ def update_user_data():
     if IN_DEBUG:
         print('Updating user data')
         print(f'Name: {username}')
-        print(f'Email: {email}')
         print(f'Picture: {picture}')
 
-    db.Update.user(uid,newData)
+    db.update.user(uid,newData)
+
+    # Other sessions of this user load the new profile when they next need it
+    forgetSessionData(uid, 'profile')
+    session['profile'] = {'name':username, 'picture':picture}
 
     return '',200
 
@@ -426,8 +848,8 @@ def validate_password():
     if not password:
         return '',400
 
-    user = db.Read.user(uid=uid)
-    if not check_password_hash(user.phash,password):
+    user = db.read.user(uid=uid, fresh=True)
+    if not hasher.check(user.phash,password):
         return '',400
 
     return '',200
@@ -442,8 +864,8 @@ def delete_user():
         print(f'Received delete request for user {uid}')
 
     password = request.form.get('password')
-    user = db.Read.user(uid=uid)
-    if not check_password_hash(user.phash,password):
+    user = db.read.user(uid=uid, fresh=True)
+    if not hasher.check(user.phash,password):
         if IN_DEBUG:
             print('Invalid password')
         return '',400
@@ -452,7 +874,7 @@ def delete_user():
     # Delete image
     if user.picture != 'DEFAULT':
         try:
-            os.remove(f'{profile_folder/{user.picture}.png}')
+            remove_avatar(profile_folder, user.picture)
             if IN_DEBUG:
                 print(f'Deleted {user.picture}.png')
         except Exception as e:
@@ -460,24 +882,24 @@ def delete_user():
             if IN_DEBUG:
                 print('Failed to delete profile image') 
 
-    # Delete all user orders
-    ## TODO: Delete all user orders
-
-    ## TODO: Update orders that were taken by user
+    # Delete user, the orders they placed go with them and the ones they took are open again
+    db.delete.user(uid)
 
-    # Delete user
-    db.Delete.user(uid)
+    # Logged out on every device
+    revokeSessions(uid)
+    session.clear()
 
     return '',200
 
 
 @app.route('/get-username',methods=['GET'])
 def get_username():
-    uid = request.args.get('id')
-    if not id:
+    try:
+        uid = int(request.args.get('id', ''))
+    except ValueError:
         return '',400
 
-    data = db.Read.user(uid=uid)
+    data = db.read.user(uid=uid)
     if not data:
         return '',400
 
@@ -485,6 +907,29 @@ def get_username():
         'username':data.name
     }),200
 
+# Resolve many usernames in one request, ids=1,2,3 or ids=1&ids=2
+USERNAMES_MAX = 200
+
+@app.route('/get-usernames',methods=['GET'])
+def get_usernames():
+    ids = []
+    for arg in request.args.getlist('ids'):
+        ids.extend(arg.split(','))
+
+    try:
+        uids = [int(uid) for uid in ids if uid]
+    except ValueError:
+        return '',400
+
+    if not uids or len(uids) > USERNAMES_MAX:
+        return '',400
+
+    names = db.read.usernames(uids)
+
+    return jsonify({
+        'usernames':{str(uid):name for uid, name in names.items()}
+    }),200
+
 ####### Order Management
 
 @app.route('/place-order',methods=['POST'])
@@ -510,83 +955,366 @@ def place_order():
             print('No description')
         if not deadline_str:
             print('No deadline')
-        if not placed_str:
-            print('No placed')
         print()
 
     if not name or not description or not deadline_str:
         return '',400
 
     deadline = datetime.strptime(deadline_str, '%Y-%m-%d')
-    recipient = uid
 
-    order = Order(name,description,deadline,recipient)
+    order = Order(
+        name=name,
+        description=description,
+        deadline=deadline
+    )
 
     if IN_DEBUG:
         print('Order object created')
         print(f'Name: {order.name}')
         print(f'Desc: {order.description}')
         print(f'Deadline: {order.deadline}')
-        print(f'Placed:{order.placed}')
-        print(f'Creator: {order.recipient}')
+        print(f'Creator: {uid}')
 
         print()
 
-    db.Create.order(order)
+    db.create.order(order, uid)
     return '',200
 
+#### Place many orders at once
+# JSON array, or NDJSON (one order per line) with Content-Type application/x-ndjson
+BULK_MAX_ORDERS = int(os.getenv('BULK_MAX_ORDERS', 5000))
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', 500))
+
+@app.route('/place-orders',methods=['POST'])
+@login_required
+def place_orders():
+    uid = session.get("user")
+
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            rows = []
+            for line in request.stream:
+                if not line.strip():
+                    continue
+                rows.append(json.loads(line))
+                if len(rows) > BULK_MAX_ORDERS:
+                    break
+        else:
+            rows = request.get_json(silent=False)
+    except ValueError:
+        return '',400
+
+    if not isinstance(rows, list) or not rows:
+        return '',400
+
+    if len(rows) > BULK_MAX_ORDERS:
+        return '',413
+
+    # Everything is checked before anything is inserted, one bad row rejects the whole import
+    values = []
+    results = []
+    for row in rows:
+        value, error = validateOrder(row)
+        values.append(value)
+        results.append({'ok':error is None, 'error':error})
+
+    if IN_DEBUG:
+        print(f'Received {len(rows)} orders from user {uid}')
+
+    if any(not result['ok'] for result in results):
+        return jsonify({
+            'inserted':0,
+            'results':results
+        }),400
+
+    oids = db.create.orders_bulk(values, uid, batch_size=BULK_BATCH_SIZE)
+
+    return jsonify({
+        'inserted':len(oids),
+        'results':[{'ok':True, 'id':oid} for oid in oids]
+    }),200
+
+#### Session helpers
+def sessionProfile():
+    """
+    Name and picture of the logged in user, read from the database once
+    and then kept in the session until the user changes them.
+    """
+    profile = session.get('profile')
+    if profile is None:
+        user = db.read.user(uid=session.get('user'))
+        if not user:
+            return None
+
+        profile = {'name':user.name, 'picture':user.picture}
+        session['profile'] = profile
+    return profile
+
+def revokeSessions(uid):
+    # Cookie sessions have nothing server side to revoke
+    if isinstance(app.session_interface, ServerSessionInterface):
+        app.session_interface.revoke_user(uid)
+
+def forgetSessionData(uid, key):
+    if isinstance(app.session_interface, ServerSessionInterface):
+        app.session_interface.forget(uid, key)
+
+
 #### Get all available orders
+ORDERS_PAGE_SIZE = 50
+ORDERS_PAGE_MAX = 200
+
+# Feed cursors are the (placed, oid) of the last order sent, opaque to the client
+def encodeCursor(cursor):
+    placed, oid = cursor
+    return urlsafe_b64encode(f'{placed.isoformat()}|{oid}'.encode()).decode()
+
+def decodeCursor(token:str):
+    placed, oid = urlsafe_b64decode(token.encode()).decode().split('|')
+    return isoparse(placed), int(oid)
+
+def argFlag(name:str, args=None):
+    args = request.args if args is None else args
+    return args.get(name, '').lower() in ('1', 'true', 'yes')
+
+# Query string of /get-all-orders to Read.orders_page arguments, ValueError on bad input
+# Also used by the async routes in asgi.py
+def feedArgs(args):
+    limit = min(int(args.get('limit', ORDERS_PAGE_SIZE)), ORDERS_PAGE_MAX)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+
+    cursor = args.get('cursor')
+    deadline_from = args.get('deadline_from')
+    deadline_to = args.get('deadline_to')
+
+    # Everything by default, not_expired=1 and not_taken=1 leave out expired and taken orders
+    return {
+        'limit':limit,
+        'cursor':decodeCursor(cursor) if cursor else None,
+        'deadline_from':isoparse(deadline_from) if deadline_from else None,
+        'deadline_to':isoparse(deadline_to) if deadline_to else None,
+        'not_expired':argFlag('not_expired', args),
+        'not_taken':argFlag('not_taken', args),
+        'with_names':argFlag('names', args),
+    }
+
+# Dates are left to the serializer, deadline as YYYY-MM-DD and placed as ISO 8601
+def feedOrder(order):
+    item = {
+        'id':order.oid,
+        'name':order.name,
+        'deadline':order.deadline.date(),
+        'placed':order.placed,
+        'recipient':order.recipient,
+    }
+    if 'recipient_name' in order._fields:
+        item['recipientName'] = order.recipient_name
+    return item
+
+def takenOrder(order):
+    item = {
+        'id':order.oid,
+        'name':order.name,
+        'description':order.description,
+        'deadline':order.deadline.date(),
+        'placed':order.placed,
+        'recipient':order.recipient,
+        'taken':True,
+        'completed':False # Completion is not tracked yet
+    }
+    if 'recipient_name' in order._fields:
+        item['recipientName'] = order.recipient_name
+    return item
+
+#### Order set versions
+# Every order created, taken or deleted bumps the version (Read.orders_version).
+# Lists carry it in their ETag, so an unchanged list is a 304 after one cheap query,
+# and since=<version> returns only what changed: orders to add or replace, and ids to drop.
+# Orders that expire are not changes, clients that hide expired orders drop them by deadline.
+DELTA_MAX = 1000
+
+def sinceArg(args):
+    since = args.get('since')
+    if since is None:
+        return None
+    since = int(since)
+    if since < 0:
+        raise ValueError('since must not be negative')
+    return since
+
+def ordersETag(version, uid=None, expiring=None):
+    """
+    uid for lists that belong to a user.
+    expiring are the orders of a list that hides expired ones,
+    it goes stale when the first of them expires even without a new version.
+    """
+    parts = [str(version)]
+    if uid is not None:
+        parts.append(f'u{uid}')
+    if expiring:
+        # Expired once its due day is over
+        parts.append(f'e{int((min(order.deadline for order in expiring) + timedelta(days=1)).timestamp())}')
+    return '"' + '-'.join(parts) + '"'
+
+def ordersFresh(header, version, uid=None):
+    """The ETag from If-None-Match that still matches, or None"""
+    if not header:
+        return None
+
+    now = datetime.now().timestamp()
+    # Weak too, compressed responses carry a weak ETag
+    for tag in parse_etags(header).as_set(include_weak=True):
+        parts = tag.split('-')
+        if parts[0] != str(version):
+            continue
+        if uid is not None and f'u{uid}' not in parts:
+            continue
+        if any(part.startswith('e') and int(part[1:]) <= now for part in parts[1:]):
+            continue
+        return f'"{tag}"'
+    return None
+
+def ordersDelta(rows, oids, version, serialize):
+    present = {row.oid for row in rows}
+    return {
+        'orders':[serialize(row) for row in rows],
+        'removed':sorted(oids - present),
+        'version':version,
+    }
+
+def versionHeaders(response, version, etag=None):
+    if etag:
+        response.headers['ETag'] = etag
+    response.headers['X-Order-Version'] = str(version)
+    response.headers['Cache-Control'] = 'no-cache' # Browsers revalidate with If-None-Match every time
+    return response
+
+def notModified(etag, version):
+    return versionHeaders(make_response('', 304), version, etag)
+
+def placedOrder(order):
+    return {
+        'id':order.oid,
+        'name':order.name,
+        'description':order.description,
+        'deadline':order.deadline.date(),
+        'placed':order.placed,
+        'recipient':order.recipient,
+        'taken':bool(order.taken),
+        'completed':False # Completion is not tracked yet
+    }
+
 @app.route('/get-all-orders',methods=['GET'])
 @login_required
 def get_all_orders():
-    orders = db.Read.allOrders()
+    try:
+        options = feedArgs(request.args)
+        since = sinceArg(request.args)
+    except ValueError:
+        return '',400
 
-    if not orders:
+    # Read before the orders, a write landing in between shows up again in the next delta
+    version = db.read.orders_version()
+
+    if since is not None:
+        oids = db.read.order_changes(since)
+        if oids is None or len(oids) > DELTA_MAX:
+            return '',410 # Too far behind, reload the list
+
+        filters = {key:value for key, value in options.items() if key not in ('limit', 'cursor')}
+        rows = db.read.orders_by_id(list(oids), **filters) if oids else []
+        with metrics.timed('serialize'):
+            response = jsonify(ordersDelta(rows, oids, version, feedOrder))
+        return versionHeaders(response, version),200
+
+    # stream=1 sends the whole feed from cursor on, encoded as rows come off the cursor
+    if argFlag('stream'):
+        filters = {key:value for key, value in options.items() if key != 'limit'}
+        body = stream_list(
+            serializer, db.read.orders_stream(**filters), feedOrder,
+            head=b'{"orders":[', tail=b'],"next":null,"version":%d}' % version,
+        )
+        return versionHeaders(Response(body, mimetype='application/json'), version),200
+
+    etag = ordersFresh(request.headers.get('If-None-Match'), version)
+    if etag:
+        return notModified(etag, version)
+
+    orders, next_cursor = db.read.orders_page(**options)
+
+    order_list = [feedOrder(order) for order in orders]
+
+    with metrics.timed('serialize'):
+        response = jsonify({
+            'orders':order_list,
+            'next':encodeCursor(next_cursor) if next_cursor else None,
+            'version':version,
+        })
+    etag = ordersETag(version, expiring=orders if options['not_expired'] else None)
+    return versionHeaders(response, version, etag),200
+
+#### Search orders by name and description
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 50
+
+@app.route('/search-orders',methods=['GET'])
+@login_required
+def search_orders():
+    query = request.args.get('q', '').strip()
+    if not query:
         return '',400
 
-    order_list = []
+    try:
+        limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_PAGE_MAX)
+        page = int(request.args.get('page', 0))
+    except ValueError:
+        return '',400
+
+    if limit < 1 or page < 0:
+        return '',400
 
-    #TODO: Remove expired orders
+    results = db.read.search(query, limit=limit, offset=page * limit)
 
-    for order in orders:
+    order_list = []
+
+    for order in results:
         order_list.append({
             'id':order.oid,
             'name':order.name,
-            'description':order.description,
-            'deadline':order.deadline.strftime('%Y-%m-%d'),
-            'placed':order.placed.isoformat(),
+            'deadline':order.deadline.date(),
+            'placed':order.placed,
             'recipient':order.recipient,
+            'score':order.score,
         })
 
-    return jsonify(order_list),200
+    return jsonify({
+        'orders':order_list,
+        'page':page,
+        'more':len(order_list) == limit
+    }),200
 
 #### Get specific order
 @app.route('/get-order',methods=['GET'])
 def get_order():
-    oid = request.args['id']
+    oid = request.args.get('id', type=int)
     if not oid:
         return '',400
 
-    order = db.Read.order(oid=oid)
+    # Expired orders are found in the archive
+    order, archived = db.read.order_details(oid)
     if not order:
         return '',400
 
-    return jsonify({
-        'id'         :order.oid,
-        'name'        :order.name,
-        'description' :order.description,
-        'deadline'    :order.deadline.strftime('%Y-%m-%d'),
-        'placed'      :order.placed.isoformat(),
-        'recipient'   :order.recipient,
-        'taken'       :order.taken,
-        'completed'   :order.completed
-    }),200
+    details = placedOrder(order)
+    details['archived'] = archived
+    return jsonify(details),200
 
 #### Assign order to user
 @app.route('/take-in-order',methods=['POST'])
 @login_required
 def take_in_order():
-    oid = request.form.get('oid')
+    oid = request.form.get('oid', type=int)
     uid = session.get("user")
 
     if not oid:
@@ -597,50 +1325,103 @@ def take_in_order():
     if IN_DEBUG:
         print(f'Received request to assign order {oid} to user {uid}')
 
-    order = db.Read.order(oid)
+    order = db.read.order(oid)
     if not order:
         return '',400
 
-    userOrder = TakenOrder(
-        uid=uid,
-        oid=oid
-    )
-
-    db.Create.takenOrder(userOrder)
+    if not db.create.taken_order(uid, oid):
+        return '',409 # Already taken
 
     return  '',200
 
 
+#### Live order changes
+# Server-Sent Events: order.created, order.taken and order.deleted, reset when the client should refetch
+# Here every open stream holds a worker thread, asgi.py serves it on the event loop instead
+@app.route('/order-events',methods=['GET'])
+@login_required
+def order_events():
+    if events is None:
+        return '',404
+    # The threads are for requests, past the limit clients are told to come back later
+    subscription = events.try_subscribe(events_max_sync_streams, request.headers.get('Last-Event-ID'))
+    if subscription is None:
+        return '',503,{'Retry-After':'30'}
+
+    response = Response(events.stream_sync(subscription), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Don't let a proxy buffer the stream
+    return response
+
+
 #### Get all orders assigned to user
 @app.route('/get-user-orders',methods=['GET'])
 @login_required
 def get_user_orders():
     uid = session.get("user")
 
-    orders = db.Read.userTakenOrders(uid)
+    try:
+        since = sinceArg(request.args)
+    except ValueError:
+        return '',400
+
+    version = db.read.orders_version()
+
+    if since is not None:
+        oids = db.read.order_changes(since)
+        if oids is None or len(oids) > DELTA_MAX:
+            return '',410
+
+        rows = db.read.user_taken_orders(uid, with_names=argFlag('names'), oids=list(oids)) if oids else []
+        with metrics.timed('serialize'):
+            response = jsonify(ordersDelta(rows, oids, version, takenOrder))
+        return versionHeaders(response, version),200
+
+    if argFlag('stream'):
+        body = stream_list(serializer, db.read.user_taken_orders_stream(uid, with_names=argFlag('names')), takenOrder)
+        return versionHeaders(Response(body, mimetype='application/json'), version),200
+
+    etag = ordersFresh(request.headers.get('If-None-Match'), version, uid=uid)
+    if etag:
+        return notModified(etag, version)
+
+    orders = db.read.user_taken_orders(uid, with_names=argFlag('names'))
     if not orders:
         return '',400
 
-    order_list = []
+    order_list = [takenOrder(order) for order in orders]
 
-    for order in orders:
-        order_list.append({
-            'id':order.oid,
-            'name':order.name,
-            'description':order.description,
-            'deadline':order.deadline.strftime('%Y-%m-%d'),
-            'placed':order.placed.isoformat(),
-            'recipient':order.recipient,
-            'taken':order.taken,
-            'completed':order.completed
-        })
+    with metrics.timed('serialize'):
+        response = jsonify(order_list)
+    return versionHeaders(response, version, ordersETag(version, uid=uid)),200
 
-    return jsonify(order_list),200
+
+#### Get all orders placed by user
+@app.route('/get-placed-orders',methods=['GET'])
+@login_required
+def get_placed_orders():
+    uid = session.get("user")
+
+    # Encoded as the rows come in, however many orders the user placed
+    body = stream_list(serializer, db.read.user_placed_orders_stream(uid), placedOrder)
+    return Response(body, mimetype='application/json'),200
+
+
+#### Get orders placed by user that expired and were archived
+@app.route('/get-archived-orders',methods=['GET'])
+@login_required
+def get_archived_orders():
+    uid = session.get("user")
+
+    body = stream_list(serializer, db.read.archived_orders_stream(uid), placedOrder)
+    return Response(body, mimetype='application/json'),200
 
 
 #### Submit file to order
 @app.route('/submit-order',methods=['POST'])
 @login_required
+@limiter.limit('submit', by=('ip', 'uid'))
+@admission.uploading
 def submit_order():
     uid = session.get("user")
 
@@ -651,31 +1432,57 @@ def submit_order():
             print(f'{key}:{request.form.get(key)}')
         print()
 
-    document = request.files.get('file',None)
-    if not document:
-        return '',400
+    # Multipart form with a 'file' field, or the raw file as the body with order and filename in the query
+    if request.mimetype == 'multipart/form-data':
+        document = request.files.get('file',None)
+        if not document:
+            return '',400
+
+        oid = request.form.get('order')
+        title = document.filename
+        upload = document.stream # Already on disk and hashed by UploadRequest
+    else:
+        oid = request.args.get('order')
+        title = request.args.get('filename')
+        if not title:
+            return '',400
+        # Unparseable Content-Length, werkzeug would read it as an empty body
+        if not request.headers.get('Content-Length', '0').isdigit():
+            return '',400
+
+        upload = HashingFile(upload_folder, upload_max_size)
+        try:
+            copy_stream(request.stream, upload, upload_chunk_size)
+        except Exception:
+            upload.close()
+            raise
 
-    oid = request.form.get('order')
     if not oid:
+        upload.close()
         return '',400
 
     # Validate file
     #TODO: Validate file
 
-    # Upload file
-    extension = document.filename.split('.')[-1]
-
-    newFileName = str(uuid.uuid4())
-    document.save(f'{submission_folder}/{newFileName}.{extension}')
+    # Identical files are stored once, named after their hash
+    size = upload.size
+    digest = upload.digest
+    with metrics.timed('file_io'):
+        filename, created = commit(upload, submission_folder, clean_extension(title))
 
     if IN_DEBUG:
-        print(f'File saved as {newFileName}.pdf')
+        if created:
+            print(f'File saved as {filename}')
+        else:
+            print(f'File already stored as {filename}')
 
     doc = Document(
-        title=document.filename,
-        filename=newFileName,
+        title=title,
+        filename=filename,
+        sha256=digest,
+        size=size,
     )
-    db.Create.document(doc)
+    db.create.document(doc)
 
     sub = Submission(
         uid=uid,
@@ -683,17 +1490,43 @@ def submit_order():
         did=doc.did
     )
 
-    db.Create.submission(sub)
+    db.create.submission(sub)
 
     return '',200
 
 
 ####### Static file serving
 
+# size=N picks the smallest resized variant at least N pixels wide, webp when the client accepts it
 @app.route('/prof-pic/<path:filename>',methods=['GET'])
 def serve_image(filename):
-    return send_from_directory(profile_folder,filename)
+    size = request.args.get('size', type=int)
+    if not size:
+        return profile_files.serve(filename)
+
+    accept_webp = any(mimetype == 'image/webp' for mimetype, _ in request.accept_mimetypes)
+    variant = pick_variant(size, accept_webp)
+
+    name = filename.rsplit('.', 1)[0]
+    if variant and os.path.exists(os.path.join(profile_folder, variant_name(name, *variant))):
+        filename = variant_name(name, *variant)
+
+    response = profile_files.serve(filename)
+    response.vary.add('Accept')
+    return response
+
+@app.route('/submission/<path:filename>',methods=['GET'])
+@login_required
+def serve_submission(filename):
+    # Only the one who submitted the file and the one who placed the order get it
+    uid = session.get("user")
+    if not db.read.submission_access(uid, filename):
+        return '',404
+    return submission_files.serve(filename, as_attachment=True)
 
 
 if __name__ == "__main__":
+    # Development server, production runs gunicorn with gunicorn.conf.py
+    setup()
+    create_app()
     app.run(host='0.0.0.0', debug=True, ssl_context=(cert_pem, key_pem), port=5000)
\ No newline at end of file
@@ -0,0 +1,431 @@
+# ASGI entry point
+#
+# SERVER_MODE=async serves the hot routes below natively on the event loop, with an async
+# SQLAlchemy engine and uploads written off the loop, so one worker can hold hundreds of
+# slow uploads and DB waits. Every other route (and every route with SERVER_MODE=sync)
+# runs the Flask app as is in a pool of WSGI_THREADS threads, for comparison.
+# /order-events is native in both modes, an open stream would hold one of those threads.
+#
+#   python src/asgi.py    (runs setup() once, then WEB_WORKERS uvicorn workers)
+#   uvicorn asgi:application --workers 4 ...    (run app.setup() yourself first)
+
+# Python standard library imports
+import asyncio
+import os
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+
+# Library imports
+from a2wsgi import WSGIMiddleware
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Project imports
+import app as flask_app
+from helpers.async_sql import AsyncMySQL
+from helpers.limits import Overloaded, RateLimited, request_keys
+from helpers.replicas import begin_routing, wrote
+from helpers.serializer import stream_list_async
+from helpers.sessions import ServerSessionInterface
+from helpers.sql_helper import Document, Submission
+from helpers.uploads import HashingFile, clean_extension, commit
+
+SERVER_MODE = os.getenv('SERVER_MODE', 'async')
+
+COMPRESS_INLINE_MAX = 256 * 1024 # Bytes compressed on the event loop, bigger bodies go to a thread
+
+IN_DEBUG = flask_app.IN_DEBUG
+if IN_DEBUG:
+    print = flask_app.print # Same red DEBUG: prefix
+
+# Every uvicorn worker imports this module, so this is per process
+flask_app.create_app()
+
+# Flask requests run side by side in a thread pool, with bodies streamed to them as they arrive
+wsgi = WSGIMiddleware(flask_app.app, workers=int(os.getenv('WSGI_THREADS', 16)))
+adb = AsyncMySQL(flask_app.dbConnection, cache=flask_app.db.cache, replicas=flask_app.db.replicas)
+
+# Sessions are read through Flask's session interface, so both paths see the same ones
+session_interface = flask_app.app.session_interface
+session_cookie = flask_app.app.config['SESSION_COOKIE_NAME']
+if isinstance(session_interface, ServerSessionInterface):
+    session_serializer = None
+else:
+    session_serializer = session_interface.get_signing_serializer(flask_app.app)
+
+if IN_DEBUG:
+    print(f'ASGI server in {SERVER_MODE} mode')
+
+
+#### Request and response helpers
+
+async def off_loop(f, *args):
+    """f(*args), in a thread when it may wait on the shared store, a redis call would stall the loop"""
+    if flask_app.shared_store is None:
+        return f(*args)
+    return await asyncio.to_thread(f, *args)
+
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.client = (scope.get('client') or ('',))[0]
+        self.args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1')))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+    async def session(self):
+        cookie = SimpleCookie(self.headers.get('cookie', ''))
+        morsel = cookie.get(session_cookie)
+        if morsel is None:
+            return {}
+
+        # Read only, these routes never change the session
+        if session_serializer is None:
+            return await off_loop(session_interface.lookup, morsel.value) or {}
+        try:
+            return session_serializer.loads(morsel.value)
+        except Exception:
+            return {}
+
+    async def chunks(self):
+        while True:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('client disconnected')
+            if message.get('body'):
+                yield message['body']
+            if not message.get('more_body'):
+                return
+
+    async def disconnected(self):
+        while (await self.receive())['type'] != 'http.disconnect':
+            pass
+
+
+def response_headers(request, content_type, *extra):
+    headers = [(b'content-type', content_type.encode()), *extra]
+
+    # Same answer flask-cors gives: any origin, with credentials
+    origin = request.headers.get('origin')
+    if origin:
+        headers.append((b'access-control-allow-origin', origin.encode('latin-1')))
+        headers.append((b'access-control-allow-credentials', b'true'))
+        headers.append((b'access-control-expose-headers', b'ETag, X-Order-Version'))
+        headers.append((b'vary', b'Origin'))
+
+    # Same cookie as app.stickyReads, the client's next reads go to the primary
+    if adb.replicas is not None and wrote():
+        cookie = SimpleCookie()
+        cookie[flask_app.STICKY_COOKIE] = '1'
+        cookie[flask_app.STICKY_COOKIE]['max-age'] = flask_app.read_sticky_seconds
+        cookie[flask_app.STICKY_COOKIE]['path'] = '/'
+        cookie[flask_app.STICKY_COOKIE]['httponly'] = True
+        headers.append((b'set-cookie', cookie[flask_app.STICKY_COOKIE].OutputString().encode('latin-1')))
+    return headers
+
+
+def compressed_headers(headers, encoding, vary):
+    """headers with Content-Encoding and Vary, like app.compress_responses"""
+    headers = list(headers)
+    if vary:
+        headers.append((b'vary', b'Accept-Encoding'))
+    if encoding is not None:
+        headers.append((b'content-encoding', encoding.encode()))
+        # Weak, as for Flask responses
+        headers = [(name, b'W/' + value if name == b'etag' and not value.startswith(b'W/') else value) for name, value in headers]
+    return headers
+
+
+async def respond(request, send, status, body=b'', content_type='application/json', headers=()):
+    if flask_app.compressor is not None and 200 <= status < 300:
+        mimetype = content_type.split(';')[0]
+        encoding, vary = flask_app.compressor.choose(mimetype, request.headers.get('accept-encoding'), len(body))
+        if encoding is not None:
+            # Large bodies are compressed off the loop
+            if len(body) > COMPRESS_INLINE_MAX:
+                compressed = await asyncio.to_thread(flask_app.compressor.compress, body, encoding, mimetype)
+            else:
+                compressed = flask_app.compressor.compress(body, encoding, mimetype)
+            if len(compressed) < len(body):
+                body = compressed
+            else:
+                encoding = None
+        headers = compressed_headers(headers, encoding, vary)
+
+    headers = response_headers(request, content_type, (b'content-length', str(len(body)).encode()), *headers)
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def respond_json(request, send, data, status=200, headers=()):
+    await respond(request, send, status, flask_app.serializer.dumps(data), headers=headers)
+
+
+async def respond_stream(request, send, chunks, content_type='application/json', headers=()):
+    if flask_app.compressor is not None:
+        encoding, vary = flask_app.compressor.choose(content_type, request.headers.get('accept-encoding'))
+        if encoding is not None:
+            chunks = flask_app.compressor.compress_stream_async(chunks, encoding, content_type)
+        headers = compressed_headers(headers, encoding, vary)
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers(request, content_type, *headers)})
+    async for chunk in chunks:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def version_headers(version, etag=None):
+    headers = [(b'x-order-version', str(version).encode()), (b'cache-control', b'no-cache')]
+    if etag:
+        headers.append((b'etag', etag.encode()))
+    return headers
+
+
+#### Async routes
+
+# Same versioning as the Flask routes, see "Order set versions" in app.py
+
+async def get_all_orders(request, send, uid):
+    try:
+        options = flask_app.feedArgs(request.args)
+        since = flask_app.sinceArg(request.args)
+    except ValueError:
+        return await respond(request, send, 400)
+
+    version = await adb.read.orders_version()
+
+    if since is not None:
+        oids = await adb.read.order_changes(since)
+        if oids is None or len(oids) > flask_app.DELTA_MAX:
+            return await respond(request, send, 410)
+
+        filters = {key:value for key, value in options.items() if key not in ('limit', 'cursor')}
+        rows = await adb.read.orders_by_id(list(oids), **filters) if oids else []
+        return await respond_json(
+            request, send, flask_app.ordersDelta(rows, oids, version, flask_app.feedOrder),
+            headers=version_headers(version),
+        )
+
+    if flask_app.argFlag('stream', request.args):
+        filters = {key:value for key, value in options.items() if key != 'limit'}
+        return await respond_stream(request, send, stream_list_async(
+            flask_app.serializer, adb.read.orders_stream(**filters), flask_app.feedOrder,
+            head=b'{"orders":[', tail=b'],"next":null,"version":%d}' % version,
+        ), headers=version_headers(version))
+
+    etag = flask_app.ordersFresh(request.headers.get('if-none-match'), version)
+    if etag:
+        return await respond(request, send, 304, headers=version_headers(version, etag))
+
+    orders, next_cursor = await adb.read.orders_page(**options)
+
+    etag = flask_app.ordersETag(version, expiring=orders if options['not_expired'] else None)
+    await respond_json(request, send, {
+        'orders':[flask_app.feedOrder(order) for order in orders],
+        'next':flask_app.encodeCursor(next_cursor) if next_cursor else None,
+        'version':version,
+    }, headers=version_headers(version, etag))
+
+
+async def get_user_orders(request, send, uid):
+    try:
+        since = flask_app.sinceArg(request.args)
+    except ValueError:
+        return await respond(request, send, 400)
+
+    with_names = flask_app.argFlag('names', request.args)
+    version = await adb.read.orders_version()
+
+    if since is not None:
+        oids = await adb.read.order_changes(since)
+        if oids is None or len(oids) > flask_app.DELTA_MAX:
+            return await respond(request, send, 410)
+
+        rows = await adb.read.user_taken_orders(uid, with_names=with_names, oids=list(oids)) if oids else []
+        return await respond_json(
+            request, send, flask_app.ordersDelta(rows, oids, version, flask_app.takenOrder),
+            headers=version_headers(version),
+        )
+
+    if flask_app.argFlag('stream', request.args):
+        return await respond_stream(request, send, stream_list_async(
+            flask_app.serializer, adb.read.user_taken_orders_stream(uid, with_names=with_names), flask_app.takenOrder,
+        ), headers=version_headers(version))
+
+    etag = flask_app.ordersFresh(request.headers.get('if-none-match'), version, uid=uid)
+    if etag:
+        return await respond(request, send, 304, headers=version_headers(version, etag))
+
+    orders = await adb.read.user_taken_orders(uid, with_names=with_names)
+    if not orders:
+        return await respond(request, send, 400)
+
+    await respond_json(
+        request, send, [flask_app.takenOrder(order) for order in orders],
+        headers=version_headers(version, flask_app.ordersETag(version, uid=uid)),
+    )
+
+
+async def submit_order(request, send, uid):
+    # Raw body uploads only, multipart forms are parsed by the Flask route
+    oid = request.args.get('order')
+    title = request.args.get('filename')
+    if not oid or not title:
+        return await respond(request, send, 400)
+
+    length = request.headers.get('content-length')
+    if length is not None and not length.isdigit():
+        return await respond(request, send, 400)
+    if length and int(length) > flask_app.upload_max_size:
+        return await respond(request, send, 413)
+
+    # Disk writes happen in a thread, the loop only waits on the network
+    upload = await asyncio.to_thread(HashingFile, flask_app.upload_folder, flask_app.upload_max_size)
+    try:
+        async for chunk in request.chunks():
+            await asyncio.to_thread(upload.write, chunk)
+    except RequestEntityTooLarge:
+        await asyncio.to_thread(upload.close)
+        return await respond(request, send, 413)
+    except ConnectionError:
+        await asyncio.to_thread(upload.close)
+        return
+
+    size = upload.size
+    digest = upload.digest
+    filename, created = await asyncio.to_thread(
+        commit, upload, flask_app.submission_folder, clean_extension(title)
+    )
+
+    if IN_DEBUG:
+        print(f'File {"saved" if created else "already stored"} as {filename}')
+
+    doc = Document(
+        title=title,
+        filename=filename,
+        sha256=digest,
+        size=size,
+    )
+    await adb.create.document(doc)
+    await adb.create.submission(Submission(uid=uid, oid=oid, did=doc.did))
+
+    await respond(request, send, 200)
+
+
+async def order_events(request, send, uid):
+    # An open stream is a queue on this loop, thousands of idle clients cost no threads
+    events = flask_app.events
+    if events is None:
+        return await respond(request, send, 404)
+    subscription = events.subscribe(request.headers.get('last-event-id'), loop=asyncio.get_running_loop())
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers(
+        request, 'text/event-stream', (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no'),
+    )})
+
+    async def pump():
+        async for frame in events.stream(subscription):
+            await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+
+    streaming = asyncio.ensure_future(pump())
+    disconnect = asyncio.ensure_future(request.disconnected())
+    try:
+        await asyncio.wait((streaming, disconnect), return_when=asyncio.FIRST_COMPLETED)
+        if streaming.done():
+            # Dropped for falling behind, the client reconnects and catches up
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        streaming.cancel()
+        disconnect.cancel()
+        events.unsubscribe(subscription)
+
+
+# (method, path) -> handler, all of these require login
+ROUTES = {
+    ('GET', '/get-all-orders'): get_all_orders,
+    ('GET', '/get-user-orders'): get_user_orders,
+    ('POST', '/submit-order'): submit_order,
+    ('GET', '/order-events'): order_events,
+}
+
+
+def async_handler(scope):
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if SERVER_MODE != 'async' and handler is not order_events:
+        return None
+
+    if handler is submit_order:
+        # Multipart goes to Flask, which knows how to parse it
+        for name, value in scope['headers']:
+            if name.lower() == b'content-type' and value.startswith(b'multipart/'):
+                return None
+    return handler
+
+
+#### Application
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await adb.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http':
+        handler = async_handler(scope)
+        if handler is not None:
+            request = Request(scope, receive)
+            begin_routing(sticky=flask_app.STICKY_COOKIE in SimpleCookie(request.headers.get('cookie', '')))
+
+            uid = (await request.session()).get('user')
+            if uid is None:
+                return await respond(request, send, 401)
+
+            # Same limits as the Flask routes, the event stream holds no connection while it waits
+            try:
+                if handler is not order_events:
+                    flask_app.admission.check_pool()
+                if handler is submit_order:
+                    await off_loop(flask_app.limiter.check, 'submit', request_keys(('ip', 'uid'), request.client, uid))
+                    flask_app.admission.begin_upload()
+            except RateLimited as e:
+                return await respond(request, send, 429, headers=[(b'retry-after', str(e.retry_after).encode())])
+            except Overloaded as e:
+                return await respond(request, send, 503, headers=[(b'retry-after', str(e.retry_after).encode())])
+
+            if handler is submit_order:
+                try:
+                    return await handler(request, send, uid)
+                finally:
+                    flask_app.admission.end_upload()
+            return await handler(request, send, uid)
+
+    await wsgi(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    flask_app.setup()
+
+    # Workers import asgi:application themselves, after the server forks them
+    uvicorn.run(
+        'asgi:application',
+        host='0.0.0.0',
+        port=5000,
+        workers=int(os.getenv('WEB_WORKERS', 1)),
+        ssl_certfile=flask_app.cert_pem,
+        ssl_keyfile=flask_app.key_pem,
+    )
@@ -0,0 +1,57 @@
+# Production pre-fork server
+#
+#   cd src && gunicorn -c gunicorn.conf.py app:app
+#
+# The master imports app.py (no side effects) and runs setup() once,
+# each worker builds its own database engine and pools with create_app() after fork.
+import os
+import multiprocessing
+
+app_dir = os.path.abspath(os.path.dirname(__file__))
+
+bind = os.getenv('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+os.environ['WEB_WORKERS'] = str(workers) # app.py picks stores that work across this many processes
+threads = int(os.getenv('WEB_THREADS', 4))
+os.environ['WEB_THREADS'] = str(threads) # Caps /order-events streams per worker
+worker_class = 'gthread'
+
+timeout = int(os.getenv('WEB_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so a slow leak can't grow forever
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+# Import the app once in the master, workers share its code pages
+preload_app = True
+
+certfile = os.path.join(app_dir, 'localhost.pem')
+keyfile = os.path.join(app_dir, 'localhost.key')
+if not os.path.exists(certfile):
+    certfile = keyfile = None
+
+
+def on_starting(server):
+    import app
+    app.setup()
+
+
+def post_fork(server, worker):
+    import app
+    app.create_app()
+
+
+def worker_exit(server, worker):
+    import app
+    if app.hasher is not None:
+        app.hasher.shutdown()
+    if app.image_workers is not None:
+        app.image_workers.shutdown(wait=False)
+    if app.sweeper is not None:
+        app.sweeper.stop()
+    if app.events is not None:
+        app.events.broker.close()
+    if app.db is not None and app.db.replicas is not None:
+        app.db.replicas.stop()
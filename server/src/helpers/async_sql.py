@@ -0,0 +1,187 @@
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from helpers.cache import MISS, NullCache, SharedCache
+from helpers.replicas import mark_write
+from helpers.sql_helper import (
+    Order,
+    Document,
+    Submission,
+    orders_page_statement,
+    split_page,
+    taken_orders_statement,
+    orders_version_statement,
+    change_bounds_statement,
+    changed_oids_statement,
+    order_changes,
+    order_key,
+)
+
+
+def async_url(url):
+    """Same urls MySQL() takes, with the async driver swapped in"""
+    if "://" not in url:
+        return "mysql+aiomysql://" + url + "?charset=utf8"
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    if url.startswith("mysql://"):
+        return "mysql+aiomysql://" + url[len("mysql://"):]
+    return url
+
+
+def make_async_engine(url, pool_size=10, max_overflow=20):
+    fullUrl = async_url(url)
+
+    if fullUrl.startswith("sqlite"):
+        return create_async_engine(fullUrl)
+    return create_async_engine(
+        fullUrl,
+        pool_recycle=3600,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=30,
+    )
+
+
+class AsyncMySQL:
+    """
+    Non-blocking counterpart of MySQL for the routes served by asgi.py.
+
+    Only covers what those routes need, schema creation and everything else stay with MySQL.
+    Pass the sync wrapper's cache so both see the same entries and invalidations,
+    and its replicas so both route reads with the same health checks.
+    """
+    def __init__(self, url, cache=None, pool_size=10, max_overflow=20, replicas=None):
+        engine = make_async_engine(url, pool_size, max_overflow)
+
+        self.engine = engine
+        self.factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+        self.cache = cache if cache is not None else NullCache()
+
+        self.replicas = replicas
+        self.replica_engines = []
+        if replicas is not None:
+            self.replica_engines = [
+                make_async_engine(replica.url, pool_size, max_overflow) for replica in replicas.replicas
+            ]
+        self.__replica_factories = [
+            async_sessionmaker(bind=replica_engine, expire_on_commit=False) for replica_engine in self.replica_engines
+        ]
+
+        self.create = self.Create(self)
+        self.read = self.Read(self)
+
+    async def close(self):
+        await self.engine.dispose()
+        for engine in self.replica_engines:
+            await engine.dispose()
+
+    def reader(self):
+        """Session for reads, see MySQL.reader"""
+        if self.replicas is not None:
+            replica = self.replicas.pick()
+            if replica is not None:
+                return self.__replica_factories[replica.index]()
+        return self.factory()
+
+    async def cached(self, method, *args):
+        """Call a cache method, in a thread when the cache is a round trip to the shared store"""
+        if isinstance(self.cache, SharedCache):
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def stream(self, statement, batch_size):
+        async with self.reader() as session:
+            result = await session.stream(statement.execution_options(yield_per=batch_size))
+            async for row in result:
+                yield row
+
+    #### CRUD ####
+
+    class Create:
+        def __init__(self, parent):
+            self.parent = parent
+
+        async def document(self, document):
+            if not isinstance(document, Document):
+                raise ValueError("document must be an instance of Document")
+
+            async with self.parent.factory() as session:
+                session.add(document)
+                await session.commit()
+            mark_write()
+
+        async def submission(self, submission):
+            if not isinstance(submission, Submission):
+                raise ValueError("submission must be an instance of Submission")
+
+            async with self.parent.factory() as session:
+                session.add(submission)
+                await session.commit()
+            mark_write()
+
+    class Read:
+        def __init__(self, parent):
+            self.parent = parent
+
+        async def order(self, oid=None):
+            if oid is None:
+                raise ValueError("oid must be provided")
+
+            order = await self.parent.cached(self.parent.cache.get, order_key(oid))
+            if order is not MISS:
+                return order
+
+            async with self.parent.reader() as session:
+                order = (await session.execute(select(Order).where(Order.oid == oid))).scalars().first()
+
+            if order is not None:
+                await self.parent.cached(self.parent.cache.set, order_key(oid), order)
+            return order
+
+        async def orders_page(
+            self,
+            limit=50,
+            cursor=None,
+            deadline_from=None,
+            deadline_to=None,
+            not_expired=False,
+            not_taken=False,
+            with_names=False,
+        ):
+            statement = orders_page_statement(
+                limit, cursor, deadline_from, deadline_to, not_expired, not_taken, with_names
+            )
+            async with self.parent.reader() as session:
+                rows = (await session.execute(statement)).all()
+
+            return split_page(rows, limit)
+
+        async def orders_version(self):
+            async with self.parent.reader() as session:
+                return (await session.execute(orders_version_statement())).scalar() or 0
+
+        async def order_changes(self, since):
+            async with self.parent.reader() as session:
+                bounds = (await session.execute(change_bounds_statement())).one()
+                oids = (await session.execute(changed_oids_statement(since))).scalars().all()
+            return order_changes(bounds, since, oids)
+
+        async def user_taken_orders_stream(self, uid, with_names=False, batch_size=500):
+            async for row in self.parent.stream(taken_orders_statement(uid, with_names), batch_size):
+                yield row
+
+        async def orders_stream(self, batch_size=500, **filters):
+            async for row in self.parent.stream(orders_page_statement(None, **filters), batch_size):
+                yield row
+
+        async def orders_by_id(self, oids, **filters):
+            async with self.parent.reader() as session:
+                return (await session.execute(orders_page_statement(None, oids=oids, **filters))).all()
+
+        async def user_taken_orders(self, uid, with_names=False, oids=None):
+            async with self.parent.reader() as session:
+                orders = (await session.execute(taken_orders_statement(uid, with_names, oids))).all()
+            return orders
@@ -0,0 +1,194 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Returned by get() when a key is not cached, None is a valid cached value
+MISS = object()
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def as_dict(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+
+##### BACKENDS #####
+
+class LRUCache:
+    """
+    In-process LRU cache with a per-entry time to live.
+
+    Entries past their ttl count as misses and are dropped on access,
+    the least recently used entry is evicted when max_size is reached.
+    """
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return MISS
+
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.__entries[key]
+                self.stats.misses += 1
+                self.stats.evictions += 1
+                return MISS
+
+            self.__entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__entries[key] = (value, time.monotonic() + self.ttl)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, *keys):
+        with self.__lock:
+            for key in keys:
+                if self.__entries.pop(key, None) is not None:
+                    self.stats.invalidations += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class LocalStore:
+    """
+    Stand-in for a shared key-value server (redis/memcached style client).
+
+    Only implements the calls SharedCache makes, values are bytes
+    so anything that works here also works against a real server.
+    """
+    def __init__(self):
+        self.__data = {}
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__data.get(key)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.__data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        if not isinstance(value, bytes):
+            raise ValueError("value must be bytes")
+
+        with self.__lock:
+            expires = time.monotonic() + ex if ex else None
+            self.__data[key] = (value, expires)
+
+    def delete(self, *keys):
+        with self.__lock:
+            removed = 0
+            for key in keys:
+                if self.__data.pop(key, None) is not None:
+                    removed += 1
+            return removed
+
+
+class SharedCache:
+    """
+    Cache kept in a store shared between processes.
+
+    client is anything with get(key), set(key, value, ex=seconds) and delete(*keys),
+    a redis.Redis instance works as is, LocalStore is used when none is given.
+    Expiry and eviction are left to the store, so evictions are not counted here.
+    """
+    def __init__(self, client=None, ttl=60, prefix='cs50:'):
+        self.client = client if client is not None else LocalStore()
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats = CacheStats()
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            self.stats.misses += 1
+            return MISS
+
+        self.stats.hits += 1
+        return pickle.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        removed = self.client.delete(*[self.prefix + key for key in keys])
+        self.stats.invalidations += removed or 0
+
+
+class NullCache:
+    """Cache that never stores anything, used when caching is turned off"""
+    def __init__(self):
+        self.stats = CacheStats()
+
+    def get(self, key):
+        self.stats.misses += 1
+        return MISS
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+
+def connect_store(url):
+    """Client for the key-value server at url (redis://host:port/db), shared by every process that uses it"""
+    if redis is None:
+        raise RuntimeError("A shared store needs the redis package, pip install redis")
+    return redis.Redis.from_url(url)
+
+
+def make_cache(kind='memory', max_size=1024, ttl=60, client=None):
+    if kind == 'memory':
+        return LRUCache(max_size=max_size, ttl=ttl)
+    if kind == 'shared':
+        return SharedCache(client=client, ttl=ttl)
+    if kind == 'none':
+        return NullCache()
+    raise ValueError(f"Unknown cache type: {kind}")
@@ -0,0 +1,271 @@
+import gzip
+import os
+import threading
+import zlib
+
+from flask import request
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Text formats, everything else (images, archives, PDFs) is already compressed
+COMPRESSIBLE = {
+    'application/json',
+    'application/x-ndjson',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+}
+NEVER = {'text/event-stream'} # Each event has to reach the client as it is sent
+
+DEFAULT_LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3} # Cheap enough to run on every response
+# For files compressed once and kept. Still made on a request thread, br 10-11 and zstd 16+
+# are many times slower for a few percent more
+STORED_LEVELS = {'gzip': 9, 'br': 9, 'zstd': 15}
+
+
+##### ENCODERS #####
+# compress(data, level) -> bytes, stream(level) -> (compress(chunk), finish()) where every
+# compress() returns whatever is ready, so a streamed response doesn't stall
+
+def _gzip_stream(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # 31: gzip header
+    return (
+        lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH),
+        compressor.flush,
+    )
+
+def _brotli_stream(level):
+    compressor = brotli.Compressor(quality=level)
+    return (
+        lambda chunk: compressor.process(chunk) + compressor.flush(),
+        compressor.finish,
+    )
+
+def _zstd_stream(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return (
+        lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+        compressor.flush,
+    )
+
+ENCODERS = {'gzip': (lambda data, level: gzip.compress(data, compresslevel=level, mtime=0), _gzip_stream)}
+if brotli is not None:
+    ENCODERS['br'] = (lambda data, level: brotli.compress(data, quality=level), _brotli_stream)
+if zstandard is not None:
+    ENCODERS['zstd'] = (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data), _zstd_stream)
+
+
+def parse_levels(spec):
+    """'application/json=br:5,gzip:6;image/svg+xml=br:11' -> {mimetype: {encoding: level}}"""
+    levels = {}
+    for entry in filter(None, (part.strip() for part in spec.split(';'))):
+        mimetype, _, settings = entry.partition('=')
+        levels[mimetype.strip()] = {
+            encoding.strip(): int(level)
+            for encoding, _, level in (setting.partition(':') for setting in settings.split(','))
+        }
+    return levels
+
+
+class CompressionStats:
+    def __init__(self):
+        self.__counts = {} # encoding -> [responses, bytes in, bytes out]
+
+    def add(self, encoding, size_in, size_out, responses=0):
+        counts = self.__counts.setdefault(encoding, [0, 0, 0])
+        counts[0] += responses
+        counts[1] += size_in
+        counts[2] += size_out
+
+    def as_dict(self):
+        return {
+            (encoding, stat): value
+            for encoding, counts in list(self.__counts.items())
+            for stat, value in zip(('responses', 'bytes_in', 'bytes_out'), counts)
+        }
+
+
+class Compressor:
+    """
+    Picks a Content-Encoding for a response and compresses it.
+
+    encodings are tried in this order of preference among the ones the client accepts
+    (and that are installed, br needs brotli and zstd zstandard). Bodies under threshold
+    bytes go out as they are. levels overrides DEFAULT_LEVELS per mimetype.
+    """
+    def __init__(self, threshold=1024, encodings=('zstd', 'br', 'gzip'), levels=None):
+        self.threshold = threshold
+        self.encodings = [encoding for encoding in encodings if encoding in ENCODERS]
+        self.levels = levels or {}
+        self.stats = CompressionStats()
+
+    def compressible(self, mimetype):
+        if mimetype in NEVER:
+            return False
+        return mimetype.startswith('text/') or mimetype in COMPRESSIBLE or mimetype.endswith(('+json', '+xml'))
+
+    def negotiate(self, accept_encoding):
+        """Best encoding the client takes, None for identity"""
+        if not accept_encoding:
+            return None
+
+        accept = parse_accept_header(accept_encoding)
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = accept.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def choose(self, mimetype, accept_encoding, size=None):
+        """
+        (encoding, vary) for a response, size is None for a streamed one.
+
+        vary tells if the response depends on Accept-Encoding, even when it is sent as is.
+        """
+        if not mimetype or not self.encodings or not self.compressible(mimetype):
+            return None, False
+        if size is not None and size < self.threshold:
+            return None, False
+        return self.negotiate(accept_encoding), True
+
+    def level(self, mimetype, encoding, levels=DEFAULT_LEVELS):
+        return self.levels.get(mimetype, {}).get(encoding, levels[encoding])
+
+    def compress(self, data, encoding, mimetype, levels=DEFAULT_LEVELS):
+        compressed = ENCODERS[encoding][0](data, self.level(mimetype, encoding, levels))
+        self.stats.add(encoding, len(data), len(compressed), responses=1)
+        return compressed
+
+    def compress_stream(self, chunks, encoding, mimetype):
+        compress, finish = ENCODERS[encoding][1](self.level(mimetype, encoding))
+        self.stats.add(encoding, 0, 0, responses=1)
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                compressed = compress(chunk)
+                self.stats.add(encoding, len(chunk), len(compressed))
+                if compressed:
+                    yield compressed
+            tail = finish()
+            self.stats.add(encoding, 0, len(tail))
+            yield tail
+        finally:
+            # Streams hold database cursors, they are closed with the response
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    async def compress_stream_async(self, chunks, encoding, mimetype):
+        """compress_stream over an async iterator of bytes"""
+        compress, finish = ENCODERS[encoding][1](self.level(mimetype, encoding))
+        self.stats.add(encoding, 0, 0, responses=1)
+        try:
+            async for chunk in chunks:
+                compressed = compress(chunk)
+                self.stats.add(encoding, len(chunk), len(compressed))
+                if compressed:
+                    yield compressed
+            tail = finish()
+            self.stats.add(encoding, 0, len(tail))
+            yield tail
+        finally:
+            await chunks.aclose()
+
+
+class PrecompressedFiles:
+    """
+    Compressed copies of static files, made on first request and kept in folder.
+
+    Copies are named by content hash and encoding, identical files share them and a
+    changed file gets new ones. Compressed at STORED_LEVELS, since it only happens once.
+    Files that don't get smaller leave an empty marker so they aren't tried again.
+    Files over max_size are always sent as they are, compressing them would hold
+    the request for too long.
+    """
+    def __init__(self, folder, compressor, max_size=1024 * 1024):
+        self.folder = folder
+        self.compressor = compressor
+        self.max_size = max_size
+        # One file being compressed doesn't hold up the others, only those sharing its lock
+        self.__locks = [threading.Lock() for _ in range(16)]
+
+    def variant(self, path, digest, encoding, mimetype):
+        """Path of the compressed copy, None if compressing doesn't pay off"""
+        if os.path.getsize(path) > self.max_size:
+            return None
+
+        target = os.path.join(self.folder, f'{digest}.{encoding}')
+        skip = target + '.skip'
+        if os.path.exists(target):
+            return target
+        if os.path.exists(skip):
+            return None
+
+        with self.__locks[hash(digest) % len(self.__locks)]:
+            if os.path.exists(target):
+                return target
+            if os.path.exists(skip):
+                return None
+
+            with open(path, 'rb') as file:
+                data = file.read()
+            compressed = self.compressor.compress(data, encoding, mimetype, STORED_LEVELS)
+
+            # Written aside and renamed, other processes never see half a file
+            partial = f'{target}.{os.getpid()}.tmp'
+            if len(compressed) >= len(data) * 0.9:
+                target, compressed = skip, b''
+            with open(partial, 'wb') as file:
+                file.write(compressed)
+            os.replace(partial, target)
+
+        return target if compressed else None
+
+
+##### FLASK #####
+
+def compress_responses(app, compressor):
+    """Compress Flask responses as they leave, files are left to StaticFolder"""
+    @app.after_request
+    def compress_response(response):
+        if request.method == 'HEAD' or response.direct_passthrough:
+            return response
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return response
+        if 'Content-Encoding' in response.headers or response.cache_control.no_transform:
+            return response
+
+        size = None if response.is_streamed else response.calculate_content_length()
+        encoding, vary = compressor.choose(response.mimetype, request.headers.get('Accept-Encoding'), size)
+        if vary:
+            response.vary.add('Accept-Encoding')
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compressor.compress_stream(response.response, encoding, response.mimetype)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            compressed = compressor.compress(data, encoding, response.mimetype)
+            if len(compressed) >= len(data):
+                return response
+            response.set_data(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        # Same content, different bytes, a strong ETag would claim they are identical
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,256 @@
+import asyncio
+import itertools
+import json
+import os
+import queue
+import threading
+import traceback
+from collections import deque
+
+KEEPALIVE = 15 # Seconds between comments on an idle stream, so proxies keep it open
+RETRY_MS = 3000
+
+RESET = b'event: reset\ndata: {}\n\n'
+PING = b': keepalive\n\n'
+
+
+class LocalBroker:
+    """
+    Stand-in for a pub/sub server (redis PUBLISH/SUBSCRIBE style).
+
+    Messages only reach this process, with several workers a shared broker is
+    needed for every subscriber to see changes made in the other workers.
+    """
+    def __init__(self):
+        # Ids carry a token so ids from another process or an earlier run are never taken for ours
+        self.token = os.urandom(4).hex()
+
+        self.__ids = itertools.count(1)
+        self.__listeners = []
+
+    def next_id(self):
+        return next(self.__ids)
+
+    def publish(self, message):
+        for listener in list(self.__listeners):
+            listener(message)
+
+    def listen(self, callback):
+        self.__listeners.append(callback)
+
+    def close(self):
+        pass
+
+
+class SharedBroker:
+    """
+    Pub/sub through a redis server, every process listening on channel gets every message.
+
+    Ids come from a counter on the server and the token is stored next to it,
+    so a client that reconnects to another worker resumes from its Last-Event-ID.
+    A thread per process reads the subscription and hands messages to the listeners.
+    """
+    def __init__(self, client, channel='cs50:order-events'):
+        self.client = client
+        self.channel = channel
+
+        self.client.set(f'{channel}:token', os.urandom(4).hex().encode(), nx=True)
+        self.token = self.client.get(f'{channel}:token').decode()
+
+        self.__listeners = []
+        self.__pubsub = None
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    def next_id(self):
+        return self.client.incr(f'{self.channel}:id')
+
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+    def listen(self, callback):
+        self.__listeners.append(callback)
+        if self.__thread is None:
+            self.__pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self.__pubsub.subscribe(self.channel)
+            self.__thread = threading.Thread(target=self.__run, name='event-broker', daemon=True)
+            self.__thread.start()
+
+    def close(self):
+        self.__stop.set()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                message = self.__pubsub.get_message(timeout=1.0)
+            except Exception:
+                # Lost the server, the client subscribes again when it reconnects
+                traceback.print_exc()
+                self.__stop.wait(1.0)
+                continue
+
+            if message is not None:
+                for listener in list(self.__listeners):
+                    listener(message['data'])
+
+
+class Subscription:
+    def __init__(self, size, loop=None):
+        self.loop = loop
+        self.queue = asyncio.Queue(size) if loop is not None else queue.Queue(size)
+        self.pending = [] # Frames missed since Last-Event-ID, sent first
+        self.closed = False
+
+
+class EventHub:
+    """
+    Fans change events out to Server-Sent Events streams.
+
+    Each event is encoded once and the same bytes go to every subscriber.
+    Async subscribers cost a queue each, not a thread: a publish schedules one
+    callback per event loop, which fills the queues of all that loop's subscribers.
+    A subscriber whose queue is full is dropped, its client reconnects with
+    Last-Event-ID and catches up from the backlog, or gets a reset event if it fell too far behind.
+    """
+    def __init__(self, broker=None, backlog=512, queue_size=256):
+        self.broker = broker if broker is not None else LocalBroker()
+        self.queue_size = queue_size
+
+        self.token = self.broker.token
+        self.published = 0
+        self.dropped = 0
+
+        self.__backlog = deque(maxlen=backlog) # (sequence, frame)
+        self.__loops = {} # loop -> {Subscription}
+        self.__threads = set()
+        self.__lock = threading.Lock()
+
+        self.broker.listen(self.__deliver)
+
+    def publish(self, kind, data):
+        """Safe from any thread, data has to be JSON serializable"""
+        self.broker.publish(json.dumps({'id': self.broker.next_id(), 'kind': kind, 'data': data}).encode())
+
+    #### Subscribers ####
+
+    def subscribe(self, last_id=None, loop=None):
+        """loop is the running event loop for async consumers, None for a consumer thread"""
+        subscription = Subscription(self.queue_size, loop)
+        with self.__lock:
+            subscription.pending = self.__missed(last_id)
+            if loop is not None:
+                self.__loops.setdefault(loop, set()).add(subscription)
+            else:
+                self.__threads.add(subscription)
+        return subscription
+
+    def try_subscribe(self, limit, last_id=None):
+        """Subscribe a consumer thread, None when limit threads are already subscribed"""
+        subscription = Subscription(self.queue_size, None)
+        with self.__lock:
+            # Checked and added under one lock, concurrent requests can't both take the last place
+            if len(self.__threads) >= limit:
+                return None
+            subscription.pending = self.__missed(last_id)
+            self.__threads.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.__lock:
+            if subscription.loop is None:
+                self.__threads.discard(subscription)
+                return
+
+            subscriptions = self.__loops.get(subscription.loop)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.__loops[subscription.loop]
+
+    def subscribers(self):
+        with self.__lock:
+            return len(self.__threads) + sum(len(subscriptions) for subscriptions in self.__loops.values())
+
+    async def stream(self, subscription):
+        """SSE body for an async subscription"""
+        try:
+            yield f'retry: {RETRY_MS}\n\n'.encode()
+            for frame in subscription.pending:
+                yield frame
+
+            while not subscription.closed:
+                try:
+                    yield await asyncio.wait_for(subscription.queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield PING
+        finally:
+            self.unsubscribe(subscription)
+
+    def stream_sync(self, subscription):
+        """SSE body for a thread subscription, holds the thread for as long as the client stays"""
+        try:
+            yield f'retry: {RETRY_MS}\n\n'.encode()
+            for frame in subscription.pending:
+                yield frame
+
+            while not subscription.closed:
+                try:
+                    yield subscription.queue.get(timeout=KEEPALIVE)
+                except queue.Empty:
+                    yield PING
+        finally:
+            self.unsubscribe(subscription)
+
+    #### Delivery ####
+
+    def __deliver(self, message):
+        payload = json.loads(message)
+        data = json.dumps(payload['data'], separators=(',', ':'))
+
+        with self.__lock:
+            sequence = payload['id']
+            frame = f'id: {self.token}-{sequence}\nevent: {payload["kind"]}\ndata: {data}\n\n'.encode()
+            self.__backlog.append((sequence, frame))
+            self.published += 1
+
+            loops = list(self.__loops)
+            threads = list(self.__threads)
+
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self.__dispatch, loop, frame)
+            except RuntimeError:
+                # Loop closed without unsubscribing
+                with self.__lock:
+                    self.__loops.pop(loop, None)
+
+        for subscription in threads:
+            self.__offer(subscription, frame)
+
+    def __dispatch(self, loop, frame):
+        # Runs on loop, once per event for all its subscribers
+        with self.__lock:
+            subscriptions = list(self.__loops.get(loop, ()))
+        for subscription in subscriptions:
+            self.__offer(subscription, frame)
+
+    def __offer(self, subscription, frame):
+        try:
+            subscription.queue.put_nowait(frame)
+        except (asyncio.QueueFull, queue.Full):
+            subscription.closed = True
+            self.unsubscribe(subscription)
+            self.dropped += 1
+
+    def __missed(self, last_id):
+        if not last_id:
+            return []
+
+        token, _, sequence = last_id.partition('-')
+        if token != self.token or not sequence.isdigit():
+            return [RESET]
+
+        sequence = int(sequence)
+        if self.__backlog and self.__backlog[0][0] > sequence + 1:
+            return [RESET] # Older than the backlog, some events are gone
+        return [frame for number, frame in self.__backlog if number > sequence]
@@ -0,0 +1,110 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Square variants generated for every avatar, in pixels
+AVATAR_SIZES = (64, 128, 256)
+AVATAR_FORMATS = ('png', 'webp')
+
+# The full size avatar is capped too, nobody needs a 4000px profile picture
+AVATAR_MAX_SIZE = 1024
+
+
+def is_image(path):
+    # verify() reads the whole file and checks its structure (PNG chunk checksums and the like)
+    # without decoding pixels. The route records the new picture before the worker decodes it,
+    # so a truncated upload has to be refused here, a header check alone would let it through
+    try:
+        with Image.open(path) as image:
+            image.verify()
+        return True
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        return False
+
+
+def variant_name(name, size, extension):
+    return f'{name}-{size}.{extension}'
+
+
+def pick_variant(size, accept_webp=False):
+    """Smallest variant at least size pixels wide, None if bigger than all of them"""
+    extension = 'webp' if accept_webp else 'png'
+    for variant in AVATAR_SIZES:
+        if variant >= size:
+            return variant, extension
+    return None
+
+
+def _save(image, path, extension):
+    # Written next to the target and renamed so a half written file is never served
+    temp = f'{path}.part'
+    if extension == 'webp':
+        image.save(temp, 'WEBP', quality=85, method=4)
+    else:
+        image.save(temp, 'PNG', optimize=True)
+    os.replace(temp, path)
+
+
+def process_avatar(source, folder, name):
+    """
+    Decode an uploaded avatar once and write the cleaned image and all its variants.
+
+    The source file is removed afterwards. Metadata (EXIF, text chunks, ICC)
+    is dropped since only the pixel data is copied over.
+    """
+    try:
+        with Image.open(source) as upload:
+            upload = ImageOps.exif_transpose(upload)
+            image = Image.new('RGBA', upload.size)
+            image.paste(upload.convert('RGBA'))
+
+        image.thumbnail((AVATAR_MAX_SIZE, AVATAR_MAX_SIZE), Image.LANCZOS)
+
+        # Variants are cropped square from the center
+        square = ImageOps.fit(image, (max(AVATAR_SIZES),) * 2, Image.LANCZOS)
+        for size in sorted(AVATAR_SIZES, reverse=True):
+            variant = square if size == square.width else square.resize((size, size), Image.LANCZOS)
+            for extension in AVATAR_FORMATS:
+                _save(variant, os.path.join(folder, variant_name(name, size, extension)), extension)
+
+        # Full size last, the route uses it to know the avatar is ready
+        _save(image, os.path.join(folder, f'{name}.png'), 'png')
+    finally:
+        try:
+            os.remove(source)
+        except FileNotFoundError:
+            pass
+
+
+def remove_avatar(folder, name):
+    paths = [os.path.join(folder, f'{name}.png')]
+    for size in AVATAR_SIZES:
+        for extension in AVATAR_FORMATS:
+            paths.append(os.path.join(folder, variant_name(name, size, extension)))
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _report(future):
+    error = future.exception()
+    if error is not None:
+        print(f'Avatar processing failed: {error!r}')
+
+
+class ImageWorkers:
+    """Runs avatar processing off the request thread, Pillow releases the GIL while resizing and encoding"""
+    def __init__(self, workers=2):
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+
+    def submit(self, source, folder, name):
+        future = self.__pool.submit(process_avatar, source, folder, name)
+        future.add_done_callback(_report)
+        return future
+
+    def shutdown(self, wait=True):
+        self.__pool.shutdown(wait=wait)
@@ -0,0 +1,230 @@
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import request, session
+
+from helpers.cache import LocalStore
+
+SWEEP_INTERVAL = 60
+
+
+class RateLimited(Exception):
+    """A client went over its rate, retry_after is when it has a token again"""
+    def __init__(self, retry_after):
+        super().__init__(f'Rate limited, retry in {retry_after}s')
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    """The server is shedding load, the request should be retried later"""
+    def __init__(self, retry_after):
+        super().__init__(f'Overloaded, retry in {retry_after}s')
+        self.retry_after = retry_after
+
+
+def parse_rate(spec):
+    """'10/60', 10 requests per 60 seconds with bursts of up to 10 -> Rate"""
+    count, _, seconds = spec.partition('/')
+    return Rate(int(count) / float(seconds or 1), int(count))
+
+
+class Rate:
+    def __init__(self, per_second, burst):
+        self.per_second = per_second
+        self.burst = burst
+
+
+##### STORES #####
+# take(key, rate, cost) -> seconds until cost tokens are there, 0 when they were taken
+
+class MemoryBucketStore:
+    """Token buckets kept in this process, each worker counts its own requests"""
+    def __init__(self):
+        self.__buckets = {} # key -> (tokens, updated, full)
+        self.__lock = threading.Lock()
+        self.__next_sweep = time.monotonic() + SWEEP_INTERVAL
+
+    def take(self, key, rate, cost=1):
+        now = time.monotonic()
+        with self.__lock:
+            tokens, updated, _ = self.__buckets.get(key, (rate.burst, now, now))
+            tokens = min(rate.burst, tokens + (now - updated) * rate.per_second)
+
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate.per_second
+            self.__buckets[key] = (tokens, now, now + (rate.burst - tokens) / rate.per_second)
+
+            # A full bucket is the same as none, they are dropped here, not on a timer
+            if now >= self.__next_sweep:
+                self.__next_sweep = now + SWEEP_INTERVAL
+                for old in [key for key, (_, _, full) in self.__buckets.items() if full <= now]:
+                    del self.__buckets[old]
+
+            return wait
+
+    def __len__(self):
+        return len(self.__buckets)
+
+
+class SharedBucketStore:
+    """
+    Token buckets kept in a store shared between processes.
+
+    client is anything with get(key) and set(key, value, ex=seconds), as in SharedSessionStore.
+    Read-modify-write, requests of one key at the same instant can both get the last token.
+    """
+    def __init__(self, client=None, prefix='cs50:rate:'):
+        self.client = client if client is not None else LocalStore()
+        self.prefix = prefix
+
+    def take(self, key, rate, cost=1):
+        now = time.time()
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            tokens, updated = rate.burst, now
+        else:
+            tokens, updated = (float(part) for part in (raw.decode() if isinstance(raw, bytes) else raw).split(':'))
+        tokens = min(rate.burst, tokens + (now - updated) * rate.per_second)
+
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate.per_second
+
+        # Expires once it would be full again
+        expires = max(1, math.ceil((rate.burst - tokens) / rate.per_second))
+        self.client.set(self.prefix + key, f'{tokens}:{now}', ex=expires)
+        return wait
+
+
+def make_bucket_store(kind='memory', client=None):
+    if kind == 'memory':
+        return MemoryBucketStore()
+    if kind == 'shared':
+        return SharedBucketStore(client=client)
+    raise ValueError(f"Unknown rate limit store: {kind}")
+
+
+##### RATE LIMITER #####
+
+class RateLimiter:
+    """
+    Token bucket per rule and client.
+
+    A client is its IP address (request.remote_addr, put ProxyFix in front behind a proxy)
+    and, when logged in, its uid, each with a bucket of its own. A request has to find a
+    token in all of them. enabled=False lets everything through, for benchmarks.
+    """
+    def __init__(self, store, rates, enabled=True):
+        self.store = store
+        self.rates = rates # rule -> Rate
+        self.enabled = enabled
+
+        self.allowed = {rule: 0 for rule in rates}
+        self.limited = {rule: 0 for rule in rates}
+
+    def check(self, rule, keys, cost=1):
+        """Raises RateLimited when any of keys is out of tokens"""
+        if not self.enabled:
+            return
+
+        rate = self.rates[rule]
+        wait = max(self.store.take(f'{rule}:{key}', rate, cost) for key in keys)
+        if wait > 0:
+            self.limited[rule] += 1
+            raise RateLimited(math.ceil(wait))
+        self.allowed[rule] += 1
+
+    def limit(self, rule, by=('ip',)):
+        """Decorate a Flask route, by picks the buckets: 'ip', 'uid' or both"""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                self.check(rule, request_keys(by))
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    def stats(self):
+        return {
+            **{(rule, 'allowed'): count for rule, count in self.allowed.items()},
+            **{(rule, 'limited'): count for rule, count in self.limited.items()},
+        }
+
+
+def request_keys(by, remote_addr=None, uid=None):
+    """Bucket keys of the current request, or of remote_addr and uid outside Flask"""
+    if remote_addr is None:
+        remote_addr = request.remote_addr
+        uid = session.get('user')
+
+    keys = []
+    if 'ip' in by:
+        keys.append(f'ip:{remote_addr}')
+    if 'uid' in by and uid is not None:
+        keys.append(f'uid:{uid}')
+    return keys
+
+
+##### ADMISSION CONTROL #####
+
+class AdmissionControl:
+    """
+    Turns requests away while the server is saturated, instead of letting them queue.
+
+    waiting is what the database pool reports (metrics.pool_waiting): a request is shed
+    when a checkout has been waiting longer than max_pool_wait seconds. Uploads are
+    counted as they run, one over max_uploads is shed before its body is read.
+    """
+    def __init__(self, waiting, max_pool_wait=1.0, max_uploads=16, retry_after=1, enabled=True):
+        self.waiting = waiting
+        self.max_pool_wait = max_pool_wait
+        self.max_uploads = max_uploads
+        self.retry_after = retry_after
+        self.enabled = enabled
+
+        self.uploads = 0
+        self.shed = {'pool': 0, 'uploads': 0}
+        self.__lock = threading.Lock()
+
+    def check_pool(self):
+        if self.enabled and self.waiting.longest() > self.max_pool_wait:
+            self.shed['pool'] += 1
+            raise Overloaded(self.retry_after)
+
+    def begin_upload(self):
+        with self.__lock:
+            if self.enabled and self.uploads >= self.max_uploads:
+                self.shed['uploads'] += 1
+                raise Overloaded(self.retry_after)
+            self.uploads += 1
+
+    def end_upload(self):
+        with self.__lock:
+            self.uploads -= 1
+
+    def uploading(self, f):
+        """Decorate a Flask route that takes an upload"""
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            self.begin_upload()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.end_upload()
+        return decorated_function
+
+    def stats(self):
+        return {
+            ('shed_pool',): self.shed['pool'],
+            ('shed_uploads',): self.shed['uploads'],
+            ('uploads',): self.uploads,
+            ('pool_waiting',): self.waiting.count(),
+            ('pool_wait_longest',): self.waiting.longest(),
+        }
@@ -0,0 +1,300 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+##### METRIC TYPES #####
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = 'counter'
+
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.__lock:
+            self.__values[labels] = self.__values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.__lock:
+            values = dict(self.__values)
+        for labels, value in values.items():
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Gauge:
+    """Value read when scraped, function returns {label values tuple: value}"""
+    def __init__(self, name, help, function, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = 'gauge'
+        self.function = function
+
+    def samples(self):
+        for labels, value in self.function().items():
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = 'histogram'
+        self.buckets = tuple(buckets)
+
+        self.__values = {} # labels -> [bucket counts..., sum, count]
+        self.__lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.__lock:
+            entry = self.__values.get(labels)
+            if entry is None:
+                entry = self.__values[labels] = [0] * len(self.buckets) + [0.0, 0]
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        with self.__lock:
+            values = {labels: list(entry) for labels, entry in self.__values.items()}
+
+        names = self.labels + ('le',)
+        for labels, entry in values.items():
+            for bound, count in zip(self.buckets, entry):
+                yield f'{self.name}_bucket', _labels(names, labels + (bound,)), count
+            yield f'{self.name}_bucket', _labels(names, labels + ('+Inf',)), entry[-1]
+            yield f'{self.name}_sum', _labels(self.labels, labels), entry[-2]
+            yield f'{self.name}_count', _labels(self.labels, labels), entry[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_latency = registry.add(Histogram(
+    'http_request_duration_seconds', 'Request latency by route',
+    labels=('route', 'method', 'status'),
+))
+request_queries = registry.add(Histogram(
+    'http_request_sql_queries', 'SQL queries run per request',
+    labels=('route',), buckets=COUNT_BUCKETS,
+))
+request_sql_time = registry.add(Histogram(
+    'http_request_sql_duration_seconds', 'Time spent in SQL per request',
+    labels=('route',),
+))
+stage_time = registry.add(Histogram(
+    'stage_duration_seconds', 'Time spent in a stage of request handling (serialize, file_io...)',
+    labels=('stage',),
+))
+sql_queries = registry.add(Counter(
+    'sql_queries_total', 'SQL queries run, in and out of requests',
+))
+pool_wait = registry.add(Histogram(
+    'db_pool_checkout_wait_seconds', 'Time waited for a connection from the pool',
+))
+
+
+##### SQL #####
+
+class Waiting:
+    """Checkouts waiting for a connection right now, and for how long"""
+    def __init__(self):
+        self.__started = {} # token -> perf_counter when it started waiting
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def wait(self):
+        token = object()
+        with self.__lock:
+            self.__started[token] = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.__lock:
+                del self.__started[token]
+
+    def count(self):
+        return len(self.__started)
+
+    def longest(self):
+        with self.__lock:
+            oldest = min(self.__started.values(), default=None)
+        return 0.0 if oldest is None else time.perf_counter() - oldest
+
+pool_waiting = Waiting()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            with pool_waiting.wait():
+                return super()._do_get()
+        finally:
+            pool_wait.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        sql_queries.inc()
+
+        if has_request_context() and 'metrics_queries' in g:
+            g.metrics_queries += 1
+            g.metrics_sql_time += elapsed
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_time.observe(time.perf_counter() - started, stage)
+
+
+##### SAMPLING PROFILER #####
+
+class SlowRequestProfiler:
+    """
+    Samples the stacks of threads serving requests every interval seconds.
+
+    When a request takes longer than threshold seconds its samples are written to folder
+    in folded format (frame;frame;frame count), which flamegraph.pl and speedscope read as is.
+    """
+    def __init__(self, folder, threshold=1.0, interval=0.005):
+        self.folder = folder
+        self.threshold = threshold
+        self.interval = interval
+
+        self.__active = {} # thread id -> StackCounter
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+        os.makedirs(folder, exist_ok=True)
+
+    def begin(self):
+        with self.__lock:
+            # Started on the first request, after the server forked its workers
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='profiler', daemon=True)
+                self.__thread.start()
+            self.__active[threading.get_ident()] = StackCounter()
+
+    def end(self, route, elapsed):
+        with self.__lock:
+            samples = self.__active.pop(threading.get_ident(), None)
+
+        if samples and elapsed >= self.threshold:
+            name = route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'root'
+            path = os.path.join(self.folder, f'{int(time.time() * 1000)}-{name}.folded')
+            with open(path, 'w') as file:
+                for stack, count in samples.items():
+                    file.write(f'{stack} {count}\n')
+
+    def __run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.__lock:
+                for ident, samples in self.__active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_fold(frame)] += 1
+
+
+def _fold(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+##### FLASK #####
+
+def instrument_app(app, profiler=None):
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_sql_time = 0.0
+        if profiler is not None:
+            profiler.begin()
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_started' not in g:
+            return response
+
+        elapsed = time.perf_counter() - g.metrics_started
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+        request_latency.observe(elapsed, route, request.method, response.status_code)
+        request_queries.observe(g.metrics_queries, route)
+        request_sql_time.observe(g.metrics_sql_time, route)
+
+        return response
+
+    if profiler is not None:
+        # Teardown runs even when the view raised, so no sampled thread is left behind
+        @app.teardown_request
+        def end_profile(error):
+            if 'metrics_started' in g:
+                route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+                profiler.end(route, time.perf_counter() - g.metrics_started)
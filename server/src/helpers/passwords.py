@@ -0,0 +1,126 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Werkzeug's default, the work factor is part of the method string
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+
+class HasherBusy(Exception):
+    """Too many hashes waiting, the request should be retried later"""
+
+
+##### Worker side, runs in the pool processes #####
+
+def _timed(function, *args):
+    started = time.time()
+    result = function(*args)
+    return result, started, time.time() - started
+
+
+def _generate(password, method):
+    return _timed(generate_password_hash, password, method)
+
+
+def _check(phash, password):
+    return _timed(check_password_hash, phash, password)
+
+
+def _pool_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class HashStats:
+    def __init__(self):
+        self.count = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hash_total = 0.0
+        self.hash_max = 0.0
+
+    def record(self, wait, duration):
+        self.count += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.hash_total += duration
+        self.hash_max = max(self.hash_max, duration)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'rejected': self.rejected,
+            'wait_avg': self.wait_total / self.count if self.count else 0.0,
+            'wait_max': self.wait_max,
+            'hash_avg': self.hash_total / self.count if self.count else 0.0,
+            'hash_max': self.hash_max,
+        }
+
+
+class PasswordHasher:
+    """
+    Password hashing in a process pool, so the CPU cost is paid outside the request thread and the GIL.
+
+    At most max_pending hashes are queued or running, past that callers wait up to
+    queue_timeout seconds for a slot and then get HasherBusy.
+    The pool is started on first use, after the server has forked its workers. Its processes
+    come from a forkserver (spawn where there is none), forking a process that runs
+    threads can copy a lock some other thread holds and hang the child.
+    """
+    def __init__(self, workers=2, max_pending=32, queue_timeout=1.0, method=DEFAULT_METHOD):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.method = method
+        self.stats = HashStats()
+
+        self.__slots = threading.BoundedSemaphore(max_pending)
+        self.__lock = threading.Lock()
+        self.__pool = None
+        self.__prefix = None
+
+    def __run(self, function, *args):
+        if not self.__slots.acquire(timeout=self.queue_timeout):
+            with self.__lock:
+                self.stats.rejected += 1
+            raise HasherBusy()
+
+        try:
+            with self.__lock:
+                if self.__pool is None:
+                    self.__pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+                pool = self.__pool
+
+            submitted = time.time()
+            result, started, duration = pool.submit(function, *args).result()
+        finally:
+            self.__slots.release()
+
+        with self.__lock:
+            self.stats.record(max(started - submitted, 0.0), duration)
+        return result
+
+    def hash(self, password):
+        return self.__run(_generate, password, self.method)
+
+    def check(self, phash, password):
+        return self.__run(_check, phash, password)
+
+    def needs_rehash(self, phash):
+        # Hashes look like method$salt$hash, anything made with other parameters is redone on login
+        return phash.split('$', 1)[0] != self.__method_prefix()
+
+    def __method_prefix(self):
+        # Werkzeug fills in what method leaves out (scrypt -> scrypt:32768:8:1), a hash shows the full form
+        if self.__prefix is None:
+            self.__prefix = self.hash('').split('$', 1)[0]
+        return self.__prefix
+
+    def shutdown(self):
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown()
+                self.__pool = None
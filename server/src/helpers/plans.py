@@ -0,0 +1,104 @@
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from helpers.sql_helper import (
+    Order,
+    PlacedOrders,
+    User,
+    orders_page_statement,
+    orders_statement,
+    taken_orders_statement,
+    archived_orders_statement,
+    expired_orders_statement,
+    submission_access_statement,
+    changed_oids_statement,
+)
+
+# Reading all of one of these means a missing index, they grow with every order
+WATCHED = {"users", "orders", "placed_orders", "taken_orders", "submissions", "order_changes", "archived_orders"}
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kwargs):
+    prefix = "EXPLAIN QUERY PLAN " if compiler.dialect.name == "sqlite" else "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kwargs)
+
+
+def hot_queries():
+    """
+    (name, statement) behind the busy routes, the parameters are made up, plans don't depend on them.
+
+    The full listings (/get-all-orders?stream=1 without filters) read every order on purpose and aren't here.
+    """
+    now = datetime.now()
+    return [
+        ("feed page", orders_page_statement(50)),
+        ("feed next page", orders_page_statement(50, cursor=(now, 1))),
+        ("open orders page", orders_page_statement(50, not_expired=True, not_taken=True, with_names=True)),
+        ("orders by id", orders_page_statement(None, oids=[1, 2, 3])),
+        ("order", select(Order).where(Order.oid == 1)),
+        ("order recipient", select(PlacedOrders.uid).where(PlacedOrders.oid == 1)),
+        ("user by name", select(User).where(User.name == "name")),
+        ("placed orders", orders_statement(uid=1)),
+        ("taken orders", taken_orders_statement(1, with_names=True)),
+        ("archived orders", archived_orders_statement(uid=1)),
+        ("order changes", changed_oids_statement(0)),
+        ("expired orders", expired_orders_statement(now, 200)),
+        ("submission access", submission_access_statement(1, "0" * 64 + ".pdf")),
+    ]
+
+
+def full_scans(connection, statement):
+    """Plan lines of statement that read a whole watched table"""
+    result = connection.execute(Explain(statement))
+    # Named from the cursor, the result would otherwise expect the explained statement's columns
+    names = [column[0] for column in result.cursor.description]
+    rows = [dict(zip(names, row)) for row in result]
+
+    if connection.dialect.name == "sqlite":
+        # SCAN t reads the table, SCAN t USING (COVERING) INDEX walks an index in order
+        # An AUTOMATIC index is one SQLite builds for this query because there is none
+        found = []
+        for row in rows:
+            detail = row["detail"]
+            words = detail.split()
+            if "AUTOMATIC" in words:
+                found.append(detail)
+            elif len(words) >= 2 and words[0] == "SCAN" and words[1] in WATCHED and "USING" not in words:
+                found.append(detail)
+        return found
+
+    # MySQL, type ALL is a full table scan
+    return [
+        f"{row['table']}: type ALL, {row['rows']} rows"
+        for row in rows if row["type"] == "ALL" and row["table"] in WATCHED
+    ]
+
+
+def analyze(connection):
+    """Refresh the planner's statistics, without them SQLite guesses join orders"""
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("ANALYZE")
+    else:
+        connection.exec_driver_sql("ANALYZE TABLE " + ", ".join(f"`{table}`" for table in sorted(WATCHED)))
+    connection.commit()
+
+
+def check_plans(connection):
+    """{name: [full scans]} for the hot queries that have any"""
+    problems = {}
+    for name, statement in hot_queries():
+        found = full_scans(connection, statement)
+        if found:
+            problems[name] = found
+    return problems
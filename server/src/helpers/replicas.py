@@ -0,0 +1,136 @@
+import itertools
+import threading
+import traceback
+from contextvars import ContextVar
+
+from sqlalchemy import text
+
+# Routing state of the current request (or asyncio task), reset by begin_routing()
+_sticky = ContextVar("reads_sticky", default=False) # The client wrote a moment ago
+_wrote = ContextVar("reads_wrote", default=False) # This request wrote
+_replica = ContextVar("reads_replica", default=None) # Replica picked for this request
+
+
+def begin_routing(sticky=False):
+    """
+    Start of a request. sticky sends its reads to the primary,
+    for clients whose last write may not have reached the replicas yet.
+    """
+    _sticky.set(sticky)
+    _wrote.set(False)
+    _replica.set(None)
+
+
+def mark_write():
+    # Reads after a write see it, replicas may not have it yet
+    _wrote.set(True)
+
+
+def wrote():
+    return _wrote.get()
+
+
+def reads_on_primary():
+    return _sticky.get() or _wrote.get()
+
+
+class Replica:
+    def __init__(self, index, url, engine):
+        self.index = index
+        self.name = f"replica{index}"
+        self.url = url
+        self.engine = engine
+
+        self.healthy = True
+        self.lag = None
+        self.reads = 0
+        self.failures = 0
+        self.last_error = None
+
+
+class ReplicaSet:
+    """
+    Read replicas of one process and their health.
+
+    A thread checks every replica each interval seconds with SELECT 1 and, on MySQL,
+    its replication lag. A replica that fails, or lags more than max_lag seconds,
+    gets no reads until it passes again. Reads go round robin over the healthy ones,
+    and to the primary when there are none.
+    """
+    def __init__(self, replicas, interval=5.0, max_lag=None):
+        self.replicas = replicas
+        self.interval = interval
+        self.max_lag = max_lag
+
+        self.__turn = itertools.count()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def pick(self):
+        """Replica for this request's reads, the same one for the whole request, None for the primary"""
+        if reads_on_primary():
+            return None
+
+        replica = _replica.get()
+        if replica is not None and replica.healthy:
+            return replica
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+
+        replica = healthy[next(self.__turn) % len(healthy)]
+        replica.reads += 1
+        _replica.set(replica)
+        return replica
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='replica-health', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def check(self):
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+                    replica.lag = _replication_lag(connection)
+            except Exception as error:
+                replica.healthy = False
+                replica.failures += 1
+                replica.last_error = str(error)
+                continue
+
+            replica.healthy = self.max_lag is None or replica.lag is None or replica.lag <= self.max_lag
+            replica.last_error = None if replica.healthy else f"lagging {replica.lag}s"
+
+    def stats(self):
+        return {replica.name: {
+            'healthy': replica.healthy,
+            'lag': replica.lag,
+            'reads': replica.reads,
+            'failures': replica.failures,
+            'last_error': replica.last_error,
+        } for replica in self.replicas}
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+
+def _replication_lag(connection):
+    """Seconds the replica is behind, None when it is not replicating (or not MySQL)"""
+    if connection.dialect.name != "mysql":
+        return None
+
+    row = connection.exec_driver_sql("SHOW SLAVE STATUS").mappings().first()
+    if row is None:
+        return None # Not set up as a replica, a local test copy for example
+    lag = row.get("Seconds_Behind_Master")
+    return float(lag) if lag is not None else float("inf") # NULL when replication is stopped
@@ -0,0 +1,110 @@
+import math
+import re
+import threading
+from bisect import bisect_left, insort
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+MIN_TOKEN_LENGTH = 2
+
+# Matches in the title count more than matches in the description
+NAME_WEIGHT = 2.0
+
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(text.lower()) if len(token) >= MIN_TOKEN_LENGTH]
+
+
+class InvertedIndex:
+    """
+    In-process full-text index over order names and descriptions.
+
+    Stands in for the MySQL FULLTEXT index when running on another database (SQLite tests).
+    Every query term has to match, as a prefix of an indexed term, results are ranked by tf-idf.
+    Filled from the database on first use and kept in sync by the write paths after that.
+    """
+    def __init__(self):
+        self.loaded = False
+
+        self.__postings = {} # term -> {oid: weight}
+        self.__terms = [] # sorted, for prefix lookups
+        self.__documents = {} # oid -> terms, to remove a document
+        self.__lock = threading.Lock()
+
+    def load(self, rows):
+        with self.__lock:
+            if self.loaded:
+                return
+            for oid, name, description in rows:
+                self.__add(oid, name, description)
+            self.loaded = True
+
+    def add(self, oid, name, description):
+        with self.__lock:
+            # Until loaded the database is the source, the order will come in with the load
+            if self.loaded:
+                self.__remove(oid)
+                self.__add(oid, name, description)
+
+    def remove(self, oid):
+        with self.__lock:
+            if self.loaded:
+                self.__remove(oid)
+
+    def search(self, terms, limit=20, offset=0):
+        """Returns [(oid, score)] best first"""
+        with self.__lock:
+            total = len(self.__documents)
+            scores = None
+
+            for term in terms:
+                matches = {}
+                for indexed in self.__prefixed(term):
+                    postings = self.__postings[indexed]
+                    idf = math.log(1 + total / len(postings))
+                    for oid, weight in postings.items():
+                        matches[oid] = matches.get(oid, 0.0) + weight * idf
+
+                # Every term has to match
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {oid: score + matches[oid] for oid, score in scores.items() if oid in matches}
+
+                if not scores:
+                    return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return ranked[offset:offset + limit]
+
+    #### Call with the lock held ####
+
+    def __prefixed(self, prefix):
+        index = bisect_left(self.__terms, prefix)
+        while index < len(self.__terms) and self.__terms[index].startswith(prefix):
+            yield self.__terms[index]
+            index += 1
+
+    def __add(self, oid, name, description):
+        weights = {}
+        for token in tokenize(name):
+            weights[token] = weights.get(token, 0.0) + NAME_WEIGHT
+        for token in tokenize(description):
+            weights[token] = weights.get(token, 0.0) + 1.0
+
+        for term, weight in weights.items():
+            postings = self.__postings.get(term)
+            if postings is None:
+                postings = self.__postings[term] = {}
+                insort(self.__terms, term)
+            # Dampen repeated words so one long description doesn't win everything
+            postings[oid] = 1 + math.log(weight)
+
+        self.__documents[oid] = list(weights)
+
+    def __remove(self, oid):
+        for term in self.__documents.pop(oid, ()):
+            postings = self.__postings[term]
+            postings.pop(oid, None)
+            if not postings:
+                del self.__postings[term]
+                del self.__terms[bisect_left(self.__terms, term)]
@@ -0,0 +1,128 @@
+import json
+import uuid
+from datetime import date, datetime
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STREAM_CHUNK = 64 * 1024 # Bytes gathered before a streamed response writes
+
+
+##### SERIALIZERS #####
+# dumps(obj) -> bytes. datetimes come out as ISO 8601 and dates as YYYY-MM-DD with both,
+# so rows can be handed over without formatting every field in Python first.
+
+class OrjsonSerializer:
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+class StdlibSerializer:
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=_default, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def make_serializer(kind='auto'):
+    if kind == 'auto':
+        kind = 'orjson' if orjson is not None else 'json'
+    if kind == 'orjson':
+        if orjson is None:
+            raise ValueError("orjson is not installed")
+        return OrjsonSerializer()
+    if kind == 'json':
+        return StdlibSerializer()
+    raise ValueError(f"Unknown serializer: {kind}")
+
+
+class ListEncoder:
+    """
+    Encodes a JSON array one item at a time, into chunks of about STREAM_CHUNK bytes.
+
+    head and tail wrap the array, to put it inside an object.
+    """
+    def __init__(self, serializer, convert, head=b'[', tail=b']'):
+        self.serializer = serializer
+        self.convert = convert
+        self.tail = tail
+
+        self.__parts = [head]
+        self.__size = len(head)
+        self.__first = True
+
+    def add(self, row):
+        """A chunk when enough was gathered, None otherwise"""
+        encoded = self.serializer.dumps(self.convert(row))
+        if not self.__first:
+            self.__parts.append(b',')
+        self.__parts.append(encoded)
+        self.__size += len(encoded) + 1
+        self.__first = False
+
+        if self.__size < STREAM_CHUNK:
+            return None
+        chunk = b''.join(self.__parts)
+        self.__parts = []
+        self.__size = 0
+        return chunk
+
+    def finish(self):
+        self.__parts.append(self.tail)
+        return b''.join(self.__parts)
+
+
+def stream_list(serializer, rows, convert, head=b'[', tail=b']'):
+    """
+    JSON array of convert(row) for each row, as chunks.
+
+    rows is consumed as it goes, so a server-side cursor is never held in memory as a whole.
+    """
+    encoder = ListEncoder(serializer, convert, head, tail)
+    for row in rows:
+        chunk = encoder.add(row)
+        if chunk:
+            yield chunk
+    yield encoder.finish()
+
+
+async def stream_list_async(serializer, rows, convert, head=b'[', tail=b']'):
+    """stream_list over an async iterator"""
+    encoder = ListEncoder(serializer, convert, head, tail)
+    async for row in rows:
+        chunk = encoder.add(row)
+        if chunk:
+            yield chunk
+    yield encoder.finish()
+
+
+##### FLASK #####
+
+class SerializerJSONProvider(DefaultJSONProvider):
+    """Makes jsonify() and friends go through a serializer"""
+    def __init__(self, app, serializer):
+        super().__init__(app)
+        self.serializer = serializer
+
+    def dumps(self, obj, **kwargs):
+        return self.serializer.dumps(obj).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.serializer.dumps(obj), mimetype=self.mimetype)
@@ -0,0 +1,251 @@
+import pickle
+import secrets
+import threading
+import time
+
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+
+from helpers.cache import LocalStore
+
+SWEEP_INTERVAL = 60
+
+
+##### STORES #####
+
+class MemorySessionStore:
+    """
+    Sessions kept in this process.
+
+    The fastest option, but every worker process has its own,
+    so it only fits a single process server (or sticky load balancing).
+    """
+    def __init__(self, ttl=86400):
+        self.ttl = ttl
+
+        self.__sessions = {} # sid -> (data, expires)
+        self.__users = {} # uid -> {sid}
+        self.__lock = threading.Lock()
+        self.__next_sweep = time.monotonic() + SWEEP_INTERVAL
+
+    def load(self, sid):
+        with self.__lock:
+            entry = self.__sessions.get(sid)
+            if entry is None:
+                return None
+
+            data, expires = entry
+            if expires < time.monotonic():
+                self.__drop(sid)
+                return None
+            return dict(data)
+
+    def save(self, sid, data):
+        now = time.monotonic()
+        with self.__lock:
+            self.__sessions[sid] = (dict(data), now + self.ttl)
+            if data.get('user') is not None:
+                self.__users.setdefault(data['user'], set()).add(sid)
+
+            # Sessions nobody comes back for are dropped here, not on a timer
+            if now >= self.__next_sweep:
+                self.__next_sweep = now + SWEEP_INTERVAL
+                for old in [sid for sid, (_, expires) in self.__sessions.items() if expires < now]:
+                    self.__drop(old)
+
+    def delete(self, sid):
+        with self.__lock:
+            self.__drop(sid)
+
+    def user_sessions(self, uid):
+        with self.__lock:
+            return list(self.__users.get(uid, ()))
+
+    def revoke_user(self, uid):
+        with self.__lock:
+            sids = self.__users.pop(uid, set())
+            for sid in sids:
+                self.__sessions.pop(sid, None)
+            return len(sids)
+
+    def __drop(self, sid):
+        entry = self.__sessions.pop(sid, None)
+        if entry is not None:
+            uid = entry[0].get('user')
+            sids = self.__users.get(uid)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self.__users[uid]
+
+    def __len__(self):
+        return len(self.__sessions)
+
+
+class SharedSessionStore:
+    """
+    Sessions kept in a store shared between processes.
+
+    client is anything with get(key), set(key, value, ex=seconds) and delete(*keys),
+    a redis.Redis instance works as is. LocalStore is used when none is given,
+    which is only shared by the threads of one process. Each user also has a key listing their session ids, so all of them can be revoked.
+    """
+    def __init__(self, client=None, ttl=86400, prefix='cs50:session:'):
+        self.client = client if client is not None else LocalStore()
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def load(self, sid):
+        raw = self.client.get(self.prefix + sid)
+        if raw is None:
+            return None
+        return pickle.loads(raw)
+
+    def save(self, sid, data):
+        self.client.set(self.prefix + sid, pickle.dumps(dict(data)), ex=self.ttl)
+
+        uid = data.get('user')
+        if uid is not None:
+            # Read-modify-write, two logins of one user at the same instant can lose an id
+            sids = self.user_sessions(uid)
+            if sid not in sids:
+                sids.append(sid)
+                self.client.set(self.__user_key(uid), pickle.dumps(sids), ex=self.ttl)
+
+    def delete(self, sid):
+        # The id stays in the user's list until it expires, revoking a missing session is harmless
+        self.client.delete(self.prefix + sid)
+
+    def user_sessions(self, uid):
+        raw = self.client.get(self.__user_key(uid))
+        return pickle.loads(raw) if raw is not None else []
+
+    def revoke_user(self, uid):
+        sids = self.user_sessions(uid)
+        self.client.delete(self.__user_key(uid), *[self.prefix + sid for sid in sids])
+        return len(sids)
+
+    def __user_key(self, uid):
+        return f'{self.prefix}user:{uid}'
+
+
+##### FLASK #####
+
+class ServerSession(SessionMixin):
+    """
+    Session whose data lives in a store, the cookie only holds its id.
+
+    Nothing is read from the store until a route touches the session,
+    so requests that never look at it (static files, health checks) cost nothing.
+    """
+    def __init__(self, store, sid=None):
+        self.store = store
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self.rotate = False
+
+        self.__data = None
+
+    def __load(self):
+        if self.__data is None:
+            self.accessed = True
+            data = self.store.load(self.sid) if self.sid else None
+            if data is None:
+                # Unknown, expired or revoked id, start a new session
+                self.sid = None
+                self.new = True
+                data = {}
+            self.__data = data
+        return self.__data
+
+    def __getitem__(self, key):
+        return self.__load()[key]
+
+    def __setitem__(self, key, value):
+        self.__load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.__load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.__load())
+
+    def __len__(self):
+        return len(self.__load())
+
+    def clear(self):
+        # Cleared on login and logout, whatever comes next gets a new id
+        self.__load().clear()
+        self.modified = True
+        self.rotate = True
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        return ServerSession(self.store, request.cookies.get(self.get_cookie_name(app)) or None)
+
+    def lookup(self, sid):
+        """Session data for a cookie value, for code serving requests outside Flask"""
+        return self.store.load(sid) if sid else None
+
+    def save_session(self, app, session, response):
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session.modified:
+            return # The cookie already holds the id
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.sid is None or session.rotate:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+
+        self.store.save(session.sid, dict(session))
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def revoke_user(self, uid):
+        """Log a user out everywhere"""
+        return self.store.revoke_user(uid)
+
+    def forget(self, uid, key):
+        """Drop key from every session of a user, so it is loaded again next time"""
+        for sid in self.store.user_sessions(uid):
+            data = self.store.load(sid)
+            if data is not None and key in data:
+                del data[key]
+                self.store.save(sid, data)
+
+
+def make_session_interface(kind='memory', ttl=86400, client=None):
+    if kind == 'memory':
+        return ServerSessionInterface(MemorySessionStore(ttl=ttl))
+    if kind == 'shared':
+        return ServerSessionInterface(SharedSessionStore(client=client, ttl=ttl))
+    if kind == 'cookie':
+        # Flask's signed cookie, works across processes without a store but can't be revoked
+        return SecureCookieSessionInterface()
+    raise ValueError(f"Unknown session store: {kind}")
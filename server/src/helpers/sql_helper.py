@@ -8,7 +8,21 @@ from sqlalchemy import (
     ForeignKey,
     DateTime,
     Table,
+    Index,
+    and_,
+    or_,
+    delete,
+    exists,
+    func,
+    insert,
+    literal,
+    select,
+    text,
 )
+from sqlalchemy import event
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import (
     sessionmaker,
     registry,
@@ -18,7 +32,11 @@ from sqlalchemy.orm import (
     DeclarativeBase
 )
 
-from datetime import datetime
+from datetime import date, datetime, time
+
+from helpers.cache import MISS, NullCache
+from helpers.search import InvertedIndex, tokenize
+from helpers.replicas import Replica, ReplicaSet, mark_write
 
 class BaseModel(DeclarativeBase):
     __abstract__ = True
@@ -29,6 +47,7 @@ class BaseModel(DeclarativeBase):
 
 
 ##### SCHEMA #####
+# Changes here need a matching script in migrations/
 
 class User(BaseModel):
     __tablename__ = "users"
@@ -43,6 +62,14 @@ class User(BaseModel):
 
 class Order(BaseModel):
     __tablename__ = "orders"
+    __table_args__ = (
+        # Keyset pagination walks (placed, oid) newest first, deadline and name make it
+        # cover the feed's columns so pages are read from the index alone
+        Index("ix_orders_feed", "placed", "oid", "deadline", "name"),
+        Index("ix_orders_deadline", "deadline"),
+        # MySQL only, as in migration 0003, other databases search with the in-process index
+        Index("ft_orders_name_description", "name", "description", mysql_prefix="FULLTEXT").ddl_if(dialect="mysql"),
+    )
 
     oid = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(VARCHAR(50), nullable=False)
@@ -55,28 +82,368 @@ class Order(BaseModel):
 
 class PlacedOrders(BaseModel):
     __tablename__ = "placed_orders"
+    __table_args__ = (
+        # The primary key serves by uid, this the joins from orders (oid -> recipient)
+        Index("ix_placed_orders_oid", "oid", "uid"),
+    )
 
-    uid = Column(Integer, ForeignKey("users.uid"), primary_key=True)
-    oid = Column(Integer, ForeignKey("orders.oid"), primary_key=True)
+    uid = Column(Integer, ForeignKey("users.uid", ondelete="CASCADE"), primary_key=True)
+    oid = Column(Integer, ForeignKey("orders.oid", ondelete="CASCADE"), primary_key=True)
     
     user = relationship("User", back_populates="placed_orders")
     order = relationship("Order", back_populates="placed_by")
 
+
+class TakenOrders(BaseModel):
+    __tablename__ = "taken_orders"
+    __table_args__ = (
+        Index("ux_taken_orders_oid", "oid", unique=True), # One taker per order, and "is it taken" checks
+    )
+
+    uid = Column(Integer, ForeignKey("users.uid", ondelete="CASCADE"), primary_key=True)
+    oid = Column(Integer, ForeignKey("orders.oid", ondelete="CASCADE"), primary_key=True)
+
+
+class Document(BaseModel):
+    __tablename__ = "documents"
+
+    did = Column(Integer, primary_key=True, autoincrement=True)
+    title = Column(VARCHAR(255), nullable=False) # Name the file was uploaded with
+    filename = Column(VARCHAR(255), nullable=False) # Content addressed, shared by identical uploads
+    sha256 = Column(VARCHAR(64), nullable=False, index=True)
+    size = Column(Integer, nullable=False)
+    uploaded = Column(DateTime, nullable=False, default=datetime.now)
+
+
+class Submission(BaseModel):
+    __tablename__ = "submissions"
+    __table_args__ = (
+        Index("ix_submissions_oid", "oid"),
+    )
+
+    uid = Column(Integer, ForeignKey("users.uid", ondelete="CASCADE"), primary_key=True)
+    oid = Column(Integer, ForeignKey("orders.oid", ondelete="CASCADE"), primary_key=True)
+    did = Column(Integer, ForeignKey("documents.did"), primary_key=True)
+
+
+class OrderChange(BaseModel):
+    """
+    Log of writes to the order set, version is the order set's change counter.
+
+    Written in the same transaction as the change, so every process sees the same versions.
+    """
+    __tablename__ = "order_changes"
+    __table_args__ = (
+        Index("ix_order_changes_changed", "changed"), # Pruning
+    )
+
+    version = Column(Integer, primary_key=True, autoincrement=True)
+    oid = Column(Integer, nullable=False) # No foreign key, deleted orders stay in the log
+    kind = Column(VARCHAR(16), nullable=False) # created, taken, deleted
+    changed = Column(DateTime, nullable=False, default=datetime.now)
+
+class ArchivedOrder(BaseModel):
+    """Orders moved out of orders by the sweeper once their deadline passed"""
+    __tablename__ = "archived_orders"
+    __table_args__ = (
+        Index("ix_archived_orders_recipient_placed", "recipient", "placed"),
+    )
+
+    oid = Column(Integer, primary_key=True, autoincrement=False) # Same oid it had in orders
+    name = Column(VARCHAR(50), nullable=False)
+    description = Column(Text, nullable=False)
+    deadline = Column(DateTime, nullable=False)
+    placed = Column(DateTime, nullable=False)
+    recipient = Column(Integer, nullable=False) # uid from placed_orders, no foreign key so users can still be deleted
+    archived = Column(DateTime, nullable=False, default=datetime.now)
+
+##### CACHE KEYS #####
+
+def user_uid_key(uid):
+    return f"user:uid:{uid}"
+
+def user_name_key(name):
+    return f"user:name:{name}"
+
+def order_key(oid):
+    return f"order:{oid}"
+
+def placed_key(uid):
+    return f"placed:{uid}"
+
+class SearchResult:
+    __slots__ = ("oid", "name", "deadline", "placed", "recipient", "score")
+
+    def __init__(self, oid, name, deadline, placed, recipient, score):
+        self.oid = oid
+        self.name = name
+        self.deadline = deadline
+        self.placed = placed
+        self.recipient = recipient
+        self.score = score
+
+##### STATEMENTS #####
+# Shared by the sync wrapper below and the async one in async_sql.py
+
+def orders_page_statement(
+    limit,
+    cursor=None,
+    deadline_from=None,
+    deadline_to=None,
+    not_expired=False,
+    not_taken=False,
+    with_names=False,
+    oids=None,
+):
+    statement = (
+        select(
+            Order.oid,
+            Order.name,
+            Order.deadline,
+            Order.placed,
+            PlacedOrders.uid.label("recipient"),
+        )
+        .join(PlacedOrders, PlacedOrders.oid == Order.oid)
+    )
+
+    if with_names:
+        statement = (
+            statement.join(User, User.uid == PlacedOrders.uid)
+            .add_columns(User.name.label("recipient_name"))
+        )
+
+    if oids is not None:
+        statement = statement.where(Order.oid.in_(oids))
+
+    if cursor is not None:
+        placed, oid = cursor
+        statement = statement.where(or_(
+            Order.placed < placed,
+            and_(Order.placed == placed, Order.oid < oid),
+        ))
+
+    if deadline_from is not None:
+        statement = statement.where(Order.deadline >= deadline_from)
+    if deadline_to is not None:
+        statement = statement.where(Order.deadline <= deadline_to)
+    if not_expired:
+        # Deadlines are dates stored as midnight, an order is open through its whole due day
+        statement = statement.where(Order.deadline >= datetime.combine(date.today(), time.min))
+    if not_taken:
+        statement = statement.where(~exists().where(TakenOrders.oid == Order.oid))
+
+    statement = statement.order_by(Order.placed.desc(), Order.oid.desc())
+    if limit is None:
+        return statement
+
+    # One extra row to know if there is a next page
+    return statement.limit(limit + 1)
+
+def split_page(rows, limit):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1].placed, rows[-1].oid)
+    return rows, next_cursor
+
+def taken_orders_statement(uid, with_names=False, oids=None):
+    statement = (
+        select(
+            Order.oid,
+            Order.name,
+            Order.description,
+            Order.deadline,
+            Order.placed,
+            PlacedOrders.uid.label("recipient"),
+        )
+        .join(TakenOrders, TakenOrders.oid == Order.oid)
+        .join(PlacedOrders, PlacedOrders.oid == Order.oid)
+        .where(TakenOrders.uid == uid)
+    )
+
+    if oids is not None:
+        statement = statement.where(Order.oid.in_(oids))
+
+    if with_names:
+        statement = (
+            statement.join(User, User.uid == PlacedOrders.uid)
+            .add_columns(User.name.label("recipient_name"))
+        )
+
+    return statement.order_by(Order.deadline)
+
+def orders_statement(uid=None):
+    """
+    Every order, or every order placed by uid, newest first.
+
+    Columns only, rows are (oid, name, description, deadline, placed, recipient, taken)
+    tuples, so no ORM objects are built or tracked.
+    """
+    statement = (
+        select(
+            Order.oid,
+            Order.name,
+            Order.description,
+            Order.deadline,
+            Order.placed,
+            PlacedOrders.uid.label("recipient"),
+            exists().where(TakenOrders.oid == Order.oid).label("taken"),
+        )
+        .join(PlacedOrders, PlacedOrders.oid == Order.oid)
+    )
+
+    if uid is not None:
+        statement = statement.where(PlacedOrders.uid == uid)
+
+    return statement.order_by(Order.placed.desc(), Order.oid.desc())
+
+def archived_orders_statement(uid=None):
+    # Same columns as orders_statement, archived orders were never taken
+    statement = select(
+        ArchivedOrder.oid,
+        ArchivedOrder.name,
+        ArchivedOrder.description,
+        ArchivedOrder.deadline,
+        ArchivedOrder.placed,
+        ArchivedOrder.recipient,
+        literal(False).label("taken"),
+    )
+
+    if uid is not None:
+        statement = statement.where(ArchivedOrder.recipient == uid)
+
+    return statement.order_by(ArchivedOrder.placed.desc(), ArchivedOrder.oid.desc())
+
+def expired_orders_statement(before, limit):
+    # Oldest deadline first, walks ix_orders_deadline
+    # Taken orders stay, their taken_orders and submissions rows still point at them
+    return (
+        select(Order.oid, PlacedOrders.uid)
+        .join(PlacedOrders, PlacedOrders.oid == Order.oid)
+        .where(Order.deadline < before)
+        .where(~exists().where(TakenOrders.oid == Order.oid))
+        .where(~exists().where(Submission.oid == Order.oid))
+        .order_by(Order.deadline)
+        .limit(limit)
+    )
+
+def submission_access_statement(uid, filename):
+    # Files are named after their hash, the lookup walks documents.sha256 and the keys of submissions
+    dids = select(Document.did).where(Document.sha256 == filename.split(".")[0]).where(Document.filename == filename)
+    submitted = exists().where(Submission.uid == uid).where(Submission.did.in_(dids))
+    received = (
+        exists()
+        .where(PlacedOrders.uid == uid)
+        .where(Submission.oid == PlacedOrders.oid)
+        .where(Submission.did.in_(dids))
+    )
+    return select(or_(submitted, received))
+
+def orders_version_statement():
+    return select(func.max(OrderChange.version))
+
+def change_bounds_statement():
+    # Oldest and latest version kept, so a since older than the log can be told apart from no changes
+    return select(func.min(OrderChange.version), func.max(OrderChange.version))
+
+def changed_oids_statement(since):
+    return select(OrderChange.oid).where(OrderChange.version > since).distinct()
+
+def order_changes(bounds, since, oids):
+    """
+    Oids changed after since, from the results of the two statements above.
+
+    None when since can't be answered from the log, newer than the latest version
+    or older than the oldest one kept, the client has to reload everything.
+    """
+    oldest, latest = bounds
+    latest = latest or 0
+    if since > latest:
+        return None
+    if oldest is not None and since < oldest - 1:
+        return None
+    return set(oids)
+
+def order_event(oid, name, deadline, placed, uid):
+    # Same fields as an order in the /get-all-orders feed
+    return {
+        "id": oid,
+        "name": name,
+        "deadline": deadline.strftime("%Y-%m-%d"),
+        "placed": placed.isoformat(),
+        "recipient": uid,
+    }
+
 ##### WRAPPER ##### 
 
+def full_url(url):
+    # user:pass@host:port/db for MySQL, or a full SQLAlchemy url (sqlite:///test.db)
+    if "://" in url:
+        return url
+    return "mysql://" + url + "?charset=utf8"
+
+def make_engine(url, poolclass=QueuePool):
+    fullUrl = full_url(url)
+
+    if fullUrl.startswith("sqlite"):
+        return create_engine(fullUrl)
+    return create_engine(
+        fullUrl,
+        poolclass=poolclass,
+        pool_recycle=3600,
+        pool_size=10,
+        max_overflow=20,
+        pool_timeout=30,
+    )
+
 class MySQL:
-    def __init__(self, url):
-        fullUrl = "mysql://" + url + "?charset=utf8"
-        engine = create_engine(
-            fullUrl,
-            pool_recycle=3600,
-            pool_size=10,
-            max_overflow=20,
-            pool_timeout=30,
-        )
-        BaseModel.metadata.create_all(bind=engine)
+    """
+    replicas are urls of read replicas of url. Read goes to one of them, everything else
+    to the primary, and so do the reads of a request after it wrote (see helpers/replicas.py).
+    """
+    def __init__(
+        self,
+        url,
+        cache=None,
+        poolclass=QueuePool,
+        events=None,
+        replicas=(),
+        replica_check_interval=5.0,
+        replica_max_lag=None,
+    ):
+        engine = make_engine(url, poolclass)
+        # The schema is owned by migrations/, see migrate.py
+        self.engine = engine
+
+        # MySQL searches its FULLTEXT index, other databases use an in-process one
+        self.dialect = engine.dialect.name
+        self.search_index = None if self.dialect == "mysql" else InvertedIndex()
+        # Rows pointing at orders and users delete with them on MySQL (migration 0006),
+        # SQLite doesn't enforce foreign keys so Delete removes them itself
+        self.cascades = self.dialect == "mysql"
 
         self.__factory = sessionmaker(bind=engine, expire_on_commit=False)
+        event.listen(self.__factory, "after_commit", lambda session: mark_write())
+
+        self.replicas = None
+        self.__replica_factories = []
+        if replicas:
+            self.replicas = ReplicaSet(
+                [Replica(index, url, make_engine(url, poolclass)) for index, url in enumerate(replicas)],
+                interval=replica_check_interval,
+                max_lag=replica_max_lag,
+            )
+            self.__replica_factories = [
+                sessionmaker(bind=replica.engine, expire_on_commit=False) for replica in self.replicas.replicas
+            ]
+
+        # Read results are cached, writes invalidate the keys they touch
+        self.cache = cache if cache is not None else NullCache()
+
+        # Order changes are published here (an EventHub) after they commit
+        self.events = events
+
+        self.__consecutive_ids = None
 
         self.create = self.Create(self)
         self.read = self.Read(self)
@@ -101,10 +468,109 @@ class MySQL:
             if not isinstance(order, Order):
                 raise ValueError("order must be an instance of Order")
 
+            # Plain INSERTs by key, the user doesn't have to be loaded to be linked
+            order.placed = order.placed or datetime.now()
+            order.deadline = order.deadline or order.placed
             with self.parent.factory() as session:
-                user = session.query(User).filter(User.uid == uid).first()
-                placed_order = PlacedOrders(user=user, order=order)
-                session.add_all([order,placed_order])
+                order.oid = session.execute(insert(Order.__table__).values(
+                    name=order.name,
+                    description=order.description,
+                    deadline=order.deadline,
+                    placed=order.placed,
+                )).inserted_primary_key[0]
+                session.execute(insert(PlacedOrders.__table__).values(uid=uid, oid=order.oid))
+                session.execute(insert(OrderChange.__table__).values(oid=order.oid, kind="created", changed=order.placed))
+                session.commit()
+
+            self.parent.cache.delete(placed_key(uid))
+            self.parent.index_order(order.oid, order.name, order.description)
+            self.parent.publish("order.created", order_event(order.oid, order.name, order.deadline, order.placed, uid))
+
+        def orders_bulk(self, rows, uid, batch_size=500):
+            """
+            Insert many orders placed by one user in a single transaction.
+
+            rows are already validated dicts with name, description and deadline.
+            Orders go in with multi-row INSERTs of batch_size rows, then their placed_orders rows.
+            Returns the new oids in the same order as rows.
+            """
+            placed = datetime.now()
+            values = [dict(row, placed=placed) for row in rows]
+
+            oids = []
+            with self.parent.factory() as session:
+                for start in range(0, len(values), batch_size):
+                    oids.extend(self.__insert_orders(session, values[start:start + batch_size]))
+
+                placed_rows = [{"uid": uid, "oid": oid} for oid in oids]
+                for start in range(0, len(placed_rows), batch_size):
+                    session.execute(insert(PlacedOrders.__table__), placed_rows[start:start + batch_size])
+
+                change_rows = [{"oid": oid, "kind": "created", "changed": placed} for oid in oids]
+                for start in range(0, len(change_rows), batch_size):
+                    session.execute(insert(OrderChange.__table__), change_rows[start:start + batch_size])
+
+                session.commit()
+
+            self.parent.cache.delete(placed_key(uid))
+            for oid, row in zip(oids, rows):
+                self.parent.index_order(oid, row["name"], row["description"])
+                self.parent.publish("order.created", order_event(oid, row["name"], row["deadline"], placed, uid))
+            return oids
+
+        def __insert_orders(self, session, batch):
+            table = Order.__table__
+            dialect = session.get_bind().dialect
+
+            # SQLite and MariaDB hand the new ids back directly
+            if dialect.insert_executemany_returning_sort_by_parameter_order:
+                statement = insert(table).returning(table.c.oid, sort_by_parameter_order=True)
+                return list(session.execute(statement, batch).scalars())
+
+            # MySQL: ids of one multi-row INSERT are consecutive from LAST_INSERT_ID()
+            # unless innodb_autoinc_lock_mode is 2 (interleaved), then insert row by row
+            if self.parent.consecutive_ids(session):
+                session.execute(insert(table).values(batch))
+                first = session.execute(text("SELECT LAST_INSERT_ID()")).scalar()
+                return list(range(first, first + len(batch)))
+
+            return [session.execute(insert(table).values(row)).inserted_primary_key[0] for row in batch]
+
+        def taken_order(self, uid, oid):
+            """False when someone (uid too) already took the order"""
+            taken = exists().where(TakenOrders.oid == oid)
+            with self.parent.factory() as session:
+                try:
+                    inserted = session.execute(
+                        insert(TakenOrders).from_select(["uid", "oid"], select(literal(uid), literal(oid)).where(~taken))
+                    ).rowcount
+                    if inserted:
+                        session.add(OrderChange(oid=oid, kind="taken"))
+                        session.commit()
+                except IntegrityError:
+                    # Taken by a concurrent request between the check and the insert
+                    session.rollback()
+                    inserted = 0
+
+            if not inserted:
+                return False
+            self.parent.publish("order.taken", {"id": oid, "taker": uid})
+            return True
+
+        def document(self, document):
+            if not isinstance(document, Document):
+                raise ValueError("document must be an instance of Document")
+
+            with self.parent.factory() as session:
+                session.add(document)
+                session.commit()
+
+        def submission(self, submission):
+            if not isinstance(submission, Submission):
+                raise ValueError("submission must be an instance of Submission")
+
+            with self.parent.factory() as session:
+                session.add(submission)
                 session.commit()
 
 
@@ -112,62 +578,428 @@ class MySQL:
         def __init__(self, parent):
             self.parent = parent
 
-        def user(self, uid=None, username=None):
+        def user(self, uid=None, username=None, fresh=False):
+            """
+            fresh skips the cache and the replicas, for password checks: a worker with
+            an older copy would still take a changed password or a deleted user's.
+            """
             if uid is None and username is None:
                 raise ValueError("uid or username must be provided")
 
-            with self.parent.factory() as session:
+            key = user_uid_key(uid) if uid is not None else user_name_key(username)
+            if fresh:
+                with self.parent.factory() as session:
+                    if uid is not None:
+                        return session.query(User).filter(User.uid == uid).first()
+                    return session.query(User).filter(User.name == username).first()
+
+            user = self.parent.cache.get(key)
+            if user is not MISS:
+                return user
+
+            with self.parent.reader() as session:
                 if uid is not None:
                     user = session.query(User).filter(User.uid == uid).first()
                 else:
                     user = session.query(User).filter(User.name == username).first()
+
+            # Misses are not cached, a name checked before registering has to show up right after
+            if user is not None:
+                self.parent.cache.set(key, user)
             return user
 
         def order(self, oid=None):
             if oid is None:
                 raise ValueError("oid must be provided")
 
-            with self.parent.factory() as session:
+            order = self.parent.cache.get(order_key(oid))
+            if order is not MISS:
+                return order
+
+            with self.parent.reader() as session:
                 order = session.query(Order).filter(Order.oid == oid).first()
 
+            if order is not None:
+                self.parent.cache.set(order_key(oid), order)
             return order
 
         def all_orders(self):
-            with self.parent.factory() as session:
+            with self.parent.reader() as session:
                 orders = session.query(Order).all()
             return orders
 
+        def all_orders_stream(self, batch_size=500):
+            """
+            all_orders as a generator of column tuples (see orders_statement),
+            read through a server-side cursor batch_size rows at a time so memory stays flat.
+            """
+            yield from self.parent.stream(orders_statement(), batch_size)
+
+        def orders_page(
+            self,
+            limit=50,
+            cursor=None,
+            deadline_from=None,
+            deadline_to=None,
+            not_expired=False,
+            not_taken=False,
+            with_names=False,
+        ):
+            """
+            One page of the order feed, newest first.
+
+            Rows are (oid, name, deadline, placed, recipient) tuples, description is left out.
+            with_names adds recipient_name, joined in from users.
+            cursor is the (placed, oid) of the last row of the previous page.
+            Returns (rows, next_cursor), next_cursor is None on the last page.
+            """
+            statement = orders_page_statement(
+                limit, cursor, deadline_from, deadline_to, not_expired, not_taken, with_names
+            )
+            with self.parent.reader() as session:
+                rows = session.execute(statement).all()
+
+            return split_page(rows, limit)
+
         def user_placed_orders(self, uid):
-            with self.parent.factory() as session:
+            orders = self.parent.cache.get(placed_key(uid))
+            if orders is not MISS:
+                return orders
+
+            with self.parent.reader() as session:
                 orders = session.query(Order).join(PlacedOrders).filter(PlacedOrders.uid == uid).all()
+
+            self.parent.cache.set(placed_key(uid), orders)
+            return orders
+
+        def orders_version(self):
+            """Change counter of the order set, goes up with every order created, taken or deleted"""
+            with self.parent.reader() as session:
+                return session.execute(orders_version_statement()).scalar() or 0
+
+        def order_changes(self, since):
+            """Oids created, taken or deleted after version since, None if the log can't tell"""
+            with self.parent.reader() as session:
+                bounds = session.execute(change_bounds_statement()).one()
+                oids = session.execute(changed_oids_statement(since)).scalars().all()
+            return order_changes(bounds, since, oids)
+
+        def orders_stream(self, batch_size=500, **filters):
+            """
+            The whole feed from cursor on, as orders_page rows without paging.
+
+            Rows come from a server-side cursor batch_size at a time, this is a generator
+            that holds a connection until it is exhausted or closed.
+            """
+            yield from self.parent.stream(orders_page_statement(None, **filters), batch_size)
+
+        def orders_by_id(self, oids, **filters):
+            """Feed rows of the given orders that pass the orders_page filters, newest first"""
+            with self.parent.reader() as session:
+                return session.execute(orders_page_statement(None, oids=oids, **filters)).all()
+
+        def order_details(self, oid):
+            """
+            (row, archived) for one order, row shaped like orders_statement,
+            looked up in the archive when it is not live. (None, False) if it exists in neither.
+            """
+            with self.parent.reader() as session:
+                row = session.execute(orders_statement().where(Order.oid == oid)).first()
+                if row is not None:
+                    return row, False
+
+                row = session.execute(archived_orders_statement().where(ArchivedOrder.oid == oid)).first()
+                return row, row is not None
+
+        def submission_access(self, uid, filename):
+            """Whether uid submitted the file stored as filename, or placed an order it was submitted to"""
+            with self.parent.reader() as session:
+                return bool(session.execute(submission_access_statement(uid, filename)).scalar())
+
+        def archived_orders_stream(self, uid, batch_size=500):
+            """Archived orders placed by uid, newest first, as a generator like all_orders_stream"""
+            yield from self.parent.stream(archived_orders_statement(uid), batch_size)
+
+        def user_placed_orders_stream(self, uid, batch_size=500):
+            """user_placed_orders as a generator of column tuples, like all_orders_stream"""
+            yield from self.parent.stream(orders_statement(uid), batch_size)
+
+        def user_taken_orders(self, uid, with_names=False, oids=None):
+            """
+            Orders taken in by a user, as (oid, name, description, deadline, placed, recipient) tuples.
+            with_names adds recipient_name, joined in from users, oids limits it to those orders.
+            """
+            with self.parent.reader() as session:
+                orders = session.execute(taken_orders_statement(uid, with_names, oids)).all()
             return orders
 
+        def user_taken_orders_stream(self, uid, with_names=False, batch_size=500):
+            """user_taken_orders as a generator over a server-side cursor, like orders_stream"""
+            yield from self.parent.stream(taken_orders_statement(uid, with_names), batch_size)
+
+        def search(self, query, limit=20, offset=0):
+            """
+            Orders matching every word of query, as a word or word prefix, best match first.
+
+            Returns SearchResults (oid, name, deadline, placed, recipient, score), description is left out.
+            """
+            terms = tokenize(query)
+            if not terms:
+                return []
+
+            columns = (
+                Order.oid,
+                Order.name,
+                Order.deadline,
+                Order.placed,
+                PlacedOrders.uid.label("recipient"),
+            )
+
+            with self.parent.reader() as session:
+                if self.parent.search_index is None:
+                    # +word* requires every word and matches it as a prefix
+                    against = " ".join(f"+{term}*" for term in terms)
+                    score = match(Order.name, Order.description, against=against).in_boolean_mode()
+
+                    rows = (
+                        session.query(*columns, score.label("score"))
+                        .join(PlacedOrders, PlacedOrders.oid == Order.oid)
+                        .filter(score > 0)
+                        .order_by(score.desc(), Order.oid.desc())
+                        .offset(offset)
+                        .limit(limit)
+                        .all()
+                    )
+                    return [SearchResult(*row) for row in rows]
+
+                index = self.parent.search_index
+                if not index.loaded:
+                    index.load(session.query(Order.oid, Order.name, Order.description).yield_per(1000))
+
+                hits = index.search(terms, limit=limit, offset=offset)
+                if not hits:
+                    return []
+
+                rows = (
+                    session.query(*columns)
+                    .join(PlacedOrders, PlacedOrders.oid == Order.oid)
+                    .filter(Order.oid.in_([oid for oid, _ in hits]))
+                    .all()
+                )
+
+            found = {row.oid: row for row in rows}
+            return [SearchResult(*found[oid], score) for oid, score in hits if oid in found]
+
+        def usernames(self, uids):
+            """
+            Names for many users at once, as a {uid: name} dict.
+
+            Cached users are answered from the cache, the rest with a single IN query.
+            Unknown uids are left out.
+            """
+            names = {}
+            missing = []
+            for uid in set(uids):
+                user = self.parent.cache.get(user_uid_key(uid))
+                if user is not MISS:
+                    names[user.uid] = user.name
+                else:
+                    missing.append(uid)
+
+            if missing:
+                with self.parent.reader() as session:
+                    rows = session.query(User.uid, User.name).filter(User.uid.in_(missing)).all()
+                for uid, name in rows:
+                    names[uid] = name
+
+            return names
+
     class Update:
         def __init__(self, parent):
             self.parent = parent
 
+        def user(self, uid, data):
+            if not isinstance(data, User):
+                raise ValueError("data must be an instance of User")
+
+            with self.parent.factory() as session:
+                user = session.query(User).filter(User.uid == uid).first()
+                if user is None:
+                    return
+
+                old_name = user.name
+                user.name = data.name
+                user.phash = data.phash
+                user.picture = data.picture
+                session.commit()
+
+            self.parent.cache.delete(user_uid_key(uid), user_name_key(old_name), user_name_key(data.name))
+
     class Delete:
         def __init__(self, parent):
             self.parent = parent
 
         def user(self, uid):
+            """
+            Delete a user, the orders they placed and their archive.
+
+            Orders they took go back to being open, their taken_orders and submissions rows
+            go with the user. Returns False when there is no such user.
+            """
+            now = datetime.now()
+            placed = select(PlacedOrders.oid).where(PlacedOrders.uid == uid)
+            # Orders they took from someone else
+            released_where = (TakenOrders.uid == uid, TakenOrders.oid.not_in(placed))
             with self.parent.factory() as session:
-                user = session.query(User).filter(User.uid == uid).first()
-                session.delete(user)
+                name = session.execute(select(User.name).where(User.uid == uid)).scalar()
+                if name is None:
+                    return False
+
+                oids = self.__watched(session, placed)
+                released = []
+                if self.parent.events is not None:
+                    released = session.execute(select(TakenOrders.oid).where(*released_where)).scalars().all()
+
+                session.execute(insert(OrderChange).from_select(
+                    ["oid", "kind", "changed"], select(TakenOrders.oid, literal("released"), literal(now)).where(*released_where),
+                ))
+                self.__delete_orders(session, uid, now)
+                if not self.parent.cascades:
+                    for table in (TakenOrders, Submission):
+                        session.execute(delete(table).where(table.uid == uid))
+                session.execute(delete(ArchivedOrder).where(ArchivedOrder.recipient == uid))
+                session.execute(delete(User).where(User.uid == uid))
                 session.commit()
 
-        def order(self, oid):
+            self.parent.cache.delete(user_uid_key(uid), user_name_key(name), placed_key(uid))
+            self.__deleted(oids)
+            for oid in released:
+                self.parent.publish("order.released", {"id": oid, "taker": uid})
+            return True
+
+        def orders(self, uid):
+            """Delete every order uid placed, returns how many"""
             with self.parent.factory() as session:
-                order = session.query(Order).filter(Order.oid == oid).first()
+                oids = self.__watched(session, select(PlacedOrders.oid).where(PlacedOrders.uid == uid))
+                deleted = self.__delete_orders(session, uid, datetime.now())
+                session.commit()
+
+            self.parent.cache.delete(placed_key(uid))
+            self.__deleted(oids)
+            return deleted
+
+        def __watched(self, session, oids):
+            # The ids are only read when the cache, search index or event stream has to hear about them
+            if self.parent.events is None and self.parent.search_index is None and isinstance(self.parent.cache, NullCache):
+                return []
+            return session.execute(oids).scalars().all()
+
+        def __delete_orders(self, session, uid, now):
+            # A handful of statements on a subquery, however many orders uid placed
+            placed = select(PlacedOrders.oid).where(PlacedOrders.uid == uid)
+            session.execute(insert(OrderChange).from_select(
+                ["oid", "kind", "changed"], select(PlacedOrders.oid, literal("deleted"), literal(now)).where(PlacedOrders.uid == uid),
+            ))
+            if not self.parent.cascades:
+                # What ON DELETE CASCADE does on MySQL, placed_orders last as the others select through it
+                for table in (TakenOrders, Submission):
+                    session.execute(delete(table).where(table.oid.in_(placed)))
+            deleted = session.execute(delete(Order).where(Order.oid.in_(placed))).rowcount
+            if not self.parent.cascades:
+                session.execute(delete(PlacedOrders).where(PlacedOrders.uid == uid))
+            return deleted
+
+        def __deleted(self, oids):
+            # After commit
+            self.parent.cache.delete(*[order_key(oid) for oid in oids])
+            for oid in oids:
+                self.parent.unindex_order(oid)
+                self.parent.publish("order.deleted", {"id": oid})
+
+        def expired_orders(self, before, limit=200):
+            """
+            Move up to limit orders with a deadline before before, and their placed_orders rows,
+            to archived_orders in one transaction. Returns how many were moved.
+
+            Orders someone took in are left where they are.
+            Two sweepers picking the same orders can't both succeed, the archive's
+            primary key fails the second one and its transaction rolls back.
+            """
+            now = datetime.now()
+            with self.parent.factory() as session:
+                rows = session.execute(expired_orders_statement(before, limit)).all()
+                if not rows:
+                    return 0
+                oids = [row.oid for row in rows]
+
+                session.execute(insert(ArchivedOrder).from_select(
+                    ["oid", "name", "description", "deadline", "placed", "recipient", "archived"],
+                    select(
+                        Order.oid, Order.name, Order.description, Order.deadline, Order.placed,
+                        PlacedOrders.uid, literal(now),
+                    )
+                    .join(PlacedOrders, PlacedOrders.oid == Order.oid)
+                    .where(Order.oid.in_(oids)),
+                ))
+                session.execute(delete(PlacedOrders).where(PlacedOrders.oid.in_(oids)))
+                session.execute(delete(Order).where(Order.oid.in_(oids)))
+                session.execute(insert(OrderChange), [{"oid": oid, "kind": "archived", "changed": now} for oid in oids])
+                session.commit()
 
-                # Delete associated records
-                placed_orders = session.query(PlacedOrders).filter(PlacedOrders.oid == oid).first() # There should only be one
-                session.delete(placed_orders)
+            uids = {row.uid for row in rows}
+            self.parent.cache.delete(*[order_key(oid) for oid in oids], *[placed_key(uid) for uid in uids])
+            for oid in oids:
+                self.parent.unindex_order(oid)
+                self.parent.publish("order.deleted", {"id": oid, "archived": True})
+            return len(oids)
 
-                session.delete(order)
+        def order_changes(self, before):
+            """Forget changes older than before, since= deltas from before that get a 410"""
+            with self.parent.factory() as session:
+                # The latest change always stays, it is the current version
+                latest = session.execute(orders_version_statement()).scalar() or 0
+                removed = session.execute(
+                    delete(OrderChange)
+                    .where(OrderChange.changed < before)
+                    .where(OrderChange.version < latest)
+                ).rowcount
                 session.commit()
+            return removed
 
     ########
+
+    def index_order(self, oid, name, description):
+        if self.search_index is not None:
+            self.search_index.add(oid, name, description)
+
+    def unindex_order(self, oid):
+        if self.search_index is not None:
+            self.search_index.remove(oid)
+
+    def reader(self):
+        """Session for reads, on a replica unless this request has to see the primary"""
+        if self.replicas is not None:
+            replica = self.replicas.pick()
+            if replica is not None:
+                return self.__replica_factories[replica.index]()
+        return self.__factory()
+
+    def stream(self, statement, batch_size):
+        # yield_per turns on stream_results, MySQL drivers then use an unbuffered cursor
+        with self.reader() as session:
+            yield from session.execute(statement, execution_options={"yield_per": batch_size})
+
+    def publish(self, kind, data):
+        if self.events is not None:
+            self.events.publish(kind, data)
+
+    def consecutive_ids(self, session):
+        # Checked once, it's a server setting that needs a restart to change
+        if self.__consecutive_ids is None:
+            mode = session.execute(text("SELECT @@innodb_autoinc_lock_mode")).scalar()
+            self.__consecutive_ids = int(mode) in (0, 1)
+        return self.__consecutive_ids
+
     #### Enforce read-only session factory ####
 
     @property
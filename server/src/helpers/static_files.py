@@ -0,0 +1,141 @@
+import hashlib
+import mimetypes
+import os
+import re
+import time
+from functools import lru_cache
+
+from flask import current_app, request, make_response
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file, send_from_directory
+
+# Files named by uuid4 or by content hash never change, anything else (DEFAULT.png) might
+# Resized avatars add a -<size> suffix to the uuid
+IMMUTABLE_NAME = re.compile(
+    r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(-\d+)?|[0-9a-f]{64})(\.[a-z0-9]+)?$'
+)
+CONTENT_HASH_NAME = re.compile(r'^([0-9a-f]{64})(\.[a-z0-9]+)?$')
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@lru_cache(maxsize=4096)
+def _file_hash(path, mtime_ns, size):
+    # mtime and size are part of the key so a replaced file is hashed again
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_etag(path, filename):
+    # Content addressed files carry their hash in the name, no need to read them
+    match = CONTENT_HASH_NAME.match(filename)
+    if match:
+        return match.group(1)
+
+    stat = os.stat(path)
+    return _file_hash(path, stat.st_mtime_ns, stat.st_size)
+
+
+class StaticFolder:
+    """
+    Serves files from one folder with strong content-hash ETags.
+
+    Range and conditional requests (If-None-Match, If-Range) are handled by Werkzeug.
+    offload is None to send the file from Python, 'sendfile' to let the front server
+    send it through X-Sendfile, or 'accel' for nginx X-Accel-Redirect under accel_prefix.
+    precompressed (PrecompressedFiles) serves compressed copies of text files to clients
+    that accept them, except with accel where nginx does that itself (gzip_static).
+    private keeps shared caches (proxies, CDNs) from storing files that need a login.
+    """
+    def __init__(self, folder, offload=None, accel_prefix=None, max_age=0, precompressed=None, private=False):
+        if offload not in (None, 'sendfile', 'accel'):
+            raise ValueError(f"Unknown offload mode: {offload}")
+        if offload == 'accel' and not accel_prefix:
+            raise ValueError("accel_prefix must be provided for accel offload")
+
+        self.folder = folder
+        self.offload = offload
+        self.accel_prefix = accel_prefix.rstrip('/') if accel_prefix else None
+        self.max_age = max_age
+        self.precompressed = precompressed if offload != 'accel' else None
+        self.private = private
+
+    def serve(self, filename, as_attachment=False):
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+
+        etag = content_etag(path, os.path.basename(filename))
+        immutable = IMMUTABLE_NAME.match(os.path.basename(filename)) is not None
+        max_age = IMMUTABLE_MAX_AGE if immutable else self.max_age
+        mimetype, encoding, vary = self.__encoding(path, etag)
+
+        if encoding is not None:
+            # The compressed copy is its own representation, with its own ETag and ranges
+            response = send_file(
+                self.precompressed.variant(path, etag, encoding, mimetype),
+                request.environ,
+                mimetype=mimetype,
+                etag=f'{etag}-{encoding}',
+                conditional=True,
+                as_attachment=as_attachment,
+                download_name=os.path.basename(filename),
+                max_age=max_age,
+                use_x_sendfile=self.offload == 'sendfile',
+                response_class=current_app.response_class,
+            )
+            response.headers['Content-Encoding'] = encoding
+        elif self.offload == 'accel':
+            # nginx sends the body and handles ranges, we only answer revalidations
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = f'{self.accel_prefix}/{filename}'
+            del response.headers['Content-Type'] # Let nginx pick it from the file
+            response.set_etag(etag)
+            response.make_conditional(request)
+        else:
+            response = send_from_directory(
+                self.folder,
+                filename,
+                request.environ,
+                etag=etag,
+                conditional=True,
+                as_attachment=as_attachment,
+                max_age=max_age,
+                use_x_sendfile=self.offload == 'sendfile',
+                response_class=current_app.response_class,
+            )
+
+        if vary:
+            response.vary.add('Accept-Encoding')
+
+        if immutable:
+            response.cache_control.no_cache = None
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+            response.expires = int(time.time() + IMMUTABLE_MAX_AGE)
+        else:
+            response.cache_control.no_cache = True
+
+        if self.private:
+            response.cache_control.public = False
+            response.cache_control.private = True
+        elif immutable:
+            response.cache_control.public = True
+
+        return response
+
+    def __encoding(self, path, etag):
+        """(mimetype, encoding, vary), encoding is None to send the file as it is"""
+        if self.precompressed is None:
+            return None, None, False
+
+        mimetype = mimetypes.guess_type(path)[0]
+        compressor = self.precompressed.compressor
+        encoding, vary = compressor.choose(mimetype, request.headers.get('Accept-Encoding'), os.path.getsize(path))
+        if encoding is None or self.precompressed.variant(path, etag, encoding, mimetype) is None:
+            return mimetype, None, vary
+        return mimetype, encoding, vary
@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+try:
+    import fcntl
+except ImportError: # Windows, every process sweeps and the archive's primary key sorts it out
+    fcntl = None
+
+
+class SweepStats:
+    def __init__(self):
+        self.runs = 0
+        self.archived = 0
+        self.conflicts = 0
+        self.changes_pruned = 0
+        self.last_run = None
+        self.last_duration = 0.0
+
+    def as_dict(self):
+        return {
+            'runs': self.runs,
+            'archived': self.archived,
+            'conflicts': self.conflicts,
+            'changes_pruned': self.changes_pruned,
+            'last_duration': self.last_duration,
+        }
+
+
+class OrderSweeper:
+    """
+    Moves orders past their deadline to the archive in the background, batch_size at a time.
+
+    Orders get grace past their deadline before they go. Batches are small so no
+    transaction holds locks on orders for long, a run stops after max_batches and
+    continues on the next one. The order change log is pruned to changes_ttl on each run.
+
+    Every worker process gets one, lock_path (a file) makes sure only one per host sweeps.
+    """
+    def __init__(
+        self,
+        db,
+        interval=300,
+        batch_size=200,
+        max_batches=50,
+        grace=timedelta(0),
+        changes_ttl=timedelta(days=7),
+        lock_path=None,
+    ):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.grace = grace
+        self.changes_ttl = changes_ttl
+        self.lock_path = lock_path
+        self.stats = SweepStats()
+
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__lock_file = None
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='order-sweeper', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__lock_file is not None:
+            self.__lock_file.close()
+            self.__lock_file = None
+
+    def sweep(self):
+        """One run, returns how many orders were archived"""
+        started = time.perf_counter()
+        before = datetime.now() - self.grace
+
+        archived = 0
+        for _ in range(self.max_batches):
+            try:
+                moved = self.db.delete.expired_orders(before, limit=self.batch_size)
+            except IntegrityError:
+                # Another host archived this batch first, or someone took an order meanwhile
+                self.stats.conflicts += 1
+                break
+
+            archived += moved
+            if moved < self.batch_size:
+                break
+
+        self.stats.changes_pruned += self.db.delete.order_changes(datetime.now() - self.changes_ttl)
+
+        self.stats.runs += 1
+        self.stats.archived += archived
+        self.stats.last_run = datetime.now()
+        self.stats.last_duration = time.perf_counter() - started
+        return archived
+
+    def __run(self):
+        # Jitter so workers started together don't all wake at once
+        if self.__stop.wait(random.uniform(0, self.interval)):
+            return
+
+        while True:
+            if self.__leader():
+                try:
+                    self.sweep()
+                except Exception:
+                    traceback.print_exc()
+
+            if self.__stop.wait(self.interval):
+                return
+
+    def __leader(self):
+        if fcntl is None or self.lock_path is None:
+            return True
+        if self.__lock_file is not None:
+            return True
+
+        # Held for the life of the process, the OS releases it if the process dies
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self.__lock_file = lock_file
+        return True
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+CHUNK_SIZE = 64 * 1024
+
+
+class HashingFile:
+    """
+    Temporary file that hashes what is written to it.
+
+    Uploads are written straight here while the request body is parsed,
+    so the content is read once and never copied to a second spool file.
+    The file is deleted on close unless it was moved with commit().
+    """
+    def __init__(self, folder, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self.committed = False
+
+        self.__hash = hashlib.sha256()
+        self.__file = tempfile.NamedTemporaryFile(dir=folder, prefix='.upload-', delete=False)
+
+    @property
+    def path(self):
+        return self.__file.name
+
+    @property
+    def digest(self):
+        return self.__hash.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge()
+
+        self.__hash.update(data)
+        return self.__file.write(data)
+
+    def close(self):
+        self.__file.close()
+        if not self.committed:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    # Everything else (read, seek, tell, flush...) goes to the real file
+    def __getattr__(self, name):
+        return getattr(self.__file, name)
+
+
+class UploadRequest(Request):
+    """
+    Request that streams file uploads into HashingFiles.
+
+    upload_folder has to be on the same filesystem as the final folders
+    so committing an upload is a rename and not a copy.
+    Every upload it made is closed with the request, so the ones left behind by
+    a failed parse (a file over max_file_size) or never committed are deleted.
+    """
+    upload_folder = None
+    max_file_size = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = HashingFile(self.upload_folder, self.max_file_size)
+        self.__dict__.setdefault('_uploads', []).append(upload)
+        return upload
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for upload in self.__dict__.pop('_uploads', ()):
+                upload.close()
+
+
+def copy_stream(stream, target, chunk_size=CHUNK_SIZE):
+    """Copy a raw body stream into a HashingFile in fixed size chunks"""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        target.write(chunk)
+
+
+def clean_extension(filename):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return re.sub(r'[^a-z0-9]', '', extension)[:10]
+
+
+def keep(upload, destination):
+    """Move an upload to destination as is, so it outlives the request"""
+    upload.flush()
+    os.replace(upload.path, destination)
+    upload.committed = True
+    upload.close()
+
+
+def commit(upload, folder, extension=''):
+    """
+    Store an upload under the name of its content hash.
+
+    Returns (filename, created), when a file with the same content
+    already exists the upload is dropped and created is False.
+    """
+    upload.flush()
+
+    name = upload.digest
+    if extension:
+        name = f'{name}.{extension}'
+    destination = os.path.join(folder, name)
+
+    if os.path.exists(destination):
+        upload.close()
+        return name, False
+
+    os.replace(upload.path, destination)
+    upload.committed = True
+    upload.close()
+
+    return name, True
@@ -1,4 +1,5 @@
 from functools import wraps
+from datetime import datetime
 from flask import session
 
 def login_required(f):
@@ -23,4 +24,39 @@ def validadePassword(password):
     return True
 
 def validateEmail(password):
-    return True
\ No newline at end of file
+    return True
+
+ORDER_NAME_MAX = 50
+
+def validateOrder(order):
+    """
+    Check one order from a bulk import.
+
+    Returns (values, None) with values ready to insert, or (None, error).
+    """
+    if not isinstance(order, dict):
+        return None, 'order must be an object'
+
+    name = order.get('name')
+    description = order.get('description')
+    deadline = order.get('deadline')
+
+    if not isinstance(name, str) or not name.strip():
+        return None, 'missing name'
+    if len(name) > ORDER_NAME_MAX:
+        return None, f'name longer than {ORDER_NAME_MAX} characters'
+    if not isinstance(description, str) or not description.strip():
+        return None, 'missing description'
+    if not isinstance(deadline, str):
+        return None, 'missing deadline'
+
+    try:
+        deadline = datetime.strptime(deadline, '%Y-%m-%d')
+    except ValueError:
+        return None, 'deadline must be YYYY-MM-DD'
+
+    return {
+        'name': name,
+        'description': description,
+        'deadline': deadline,
+    }, None
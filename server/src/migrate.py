@@ -0,0 +1,109 @@
+"""
+Database migrations, against the same database the app connects to (DB_* or DB_URL).
+
+    python migrate.py status             # applied and pending versions
+    python migrate.py upgrade            # apply everything pending
+    python migrate.py upgrade --to 2     # stop after version 2
+    python migrate.py new add_something  # write an empty migrations/NNNN_add_something.py
+    python migrate.py plans              # EXPLAIN the hot queries, fails if one reads a whole table
+    python migrate.py plans --analyze    # refresh the planner's statistics first
+
+Check plans against a database with realistic data, on a near empty one MySQL
+rightly prefers scanning, bench.py --workdir leaves a seeded SQLite database behind.
+"""
+import argparse
+import os
+import re
+import sys
+
+from sqlalchemy import create_engine
+
+import migrations
+from helpers.sql_helper import full_url
+
+TEMPLATE = '''# {description}
+from sqlalchemy import MetaData, Table
+
+from migrations.ops import create_tables, create_index
+
+
+def upgrade(connection):
+    pass
+'''
+
+
+def status(engine):
+    with engine.connect() as connection:
+        current = migrations.current(connection)
+
+    for version, name, _ in migrations.scripts():
+        print(f'{"applied" if version <= current else "pending"}  {version:04d} {name}')
+    print(f'\nDatabase at version {current}, latest is {migrations.head()}')
+
+
+def upgrade(engine, target):
+    applied = migrations.upgrade(engine, target=target)
+    if applied:
+        print(f'Now at version {applied[-1]}')
+    else:
+        print('Nothing to apply')
+
+
+def plans(engine, refresh):
+    from helpers.plans import analyze, check_plans, hot_queries
+
+    with engine.connect() as connection:
+        if refresh:
+            analyze(connection)
+        problems = check_plans(connection)
+
+    for name, _ in hot_queries():
+        print(f'{"SCAN" if name in problems else "ok  "}  {name}')
+        for line in problems.get(name, ()):
+            print(f'        {line}')
+
+    if problems:
+        sys.exit(f'\n{len(problems)} queries read a whole table')
+
+
+def new(name):
+    if not re.fullmatch(r'[a-z0-9_]+', name):
+        sys.exit('Use lowercase letters, digits and underscores for the name')
+
+    path = os.path.join(migrations.migrations_dir, f'{migrations.head() + 1:04d}_{name}.py')
+    with open(path, 'w') as file:
+        file.write(TEMPLATE.format(description=name.replace('_', ' ').capitalize()))
+    print(f'Created {path}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the database schema')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status')
+    plans_parser = commands.add_parser('plans')
+    plans_parser.add_argument('--analyze', action='store_true', help='refresh table statistics first')
+    upgrade_parser = commands.add_parser('upgrade')
+    upgrade_parser.add_argument('--to', type=int, help='stop after this version')
+    new_parser = commands.add_parser('new')
+    new_parser.add_argument('name')
+    args = parser.parse_args()
+
+    if args.command == 'new':
+        return new(args.name)
+
+    # app.py only reads its settings on import
+    from app import dbConnection
+    engine = create_engine(full_url(dbConnection))
+    try:
+        if args.command == 'status':
+            status(engine)
+        elif args.command == 'plans':
+            plans(engine, args.analyze)
+        else:
+            upgrade(engine, args.to)
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
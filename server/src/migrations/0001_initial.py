@@ -0,0 +1,33 @@
+# users, orders and placed_orders as the app first created them
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, MetaData, Table, Text, VARCHAR
+
+from migrations.ops import create_tables
+
+
+def upgrade(connection):
+    metadata = MetaData()
+
+    users = Table(
+        'users', metadata,
+        Column('uid', Integer, primary_key=True, autoincrement=True),
+        Column('name', VARCHAR(50), unique=True, nullable=False),
+        Column('phash', VARCHAR(255), nullable=False),
+        Column('picture', VARCHAR(255), nullable=True, default='DEFAULT'),
+    )
+    orders = Table(
+        'orders', metadata,
+        Column('oid', Integer, primary_key=True, autoincrement=True),
+        Column('name', VARCHAR(50), nullable=False),
+        Column('description', Text, nullable=False),
+        Column('deadline', DateTime, nullable=False, default=datetime.now),
+        Column('placed', DateTime, nullable=False, default=datetime.now),
+    )
+    placed_orders = Table(
+        'placed_orders', metadata,
+        Column('uid', Integer, ForeignKey('users.uid'), primary_key=True),
+        Column('oid', Integer, ForeignKey('orders.oid'), primary_key=True),
+    )
+
+    create_tables(connection, users, orders, placed_orders)
@@ -0,0 +1,38 @@
+# Orders taken by users and the documents they submit for them
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, MetaData, Table, VARCHAR
+
+from migrations.ops import create_tables, create_index
+
+
+def upgrade(connection):
+    metadata = MetaData()
+    # Referenced by the foreign keys below
+    Table('users', metadata, autoload_with=connection)
+    Table('orders', metadata, autoload_with=connection)
+
+    taken_orders = Table(
+        'taken_orders', metadata,
+        Column('uid', Integer, ForeignKey('users.uid'), primary_key=True),
+        Column('oid', Integer, ForeignKey('orders.oid'), primary_key=True),
+    )
+    documents = Table(
+        'documents', metadata,
+        Column('did', Integer, primary_key=True, autoincrement=True),
+        Column('title', VARCHAR(255), nullable=False),
+        Column('filename', VARCHAR(255), nullable=False),
+        Column('sha256', VARCHAR(64), nullable=False),
+        Column('size', Integer, nullable=False),
+        Column('uploaded', DateTime, nullable=False, default=datetime.now),
+    )
+    submissions = Table(
+        'submissions', metadata,
+        Column('uid', Integer, ForeignKey('users.uid'), primary_key=True),
+        Column('oid', Integer, ForeignKey('orders.oid'), primary_key=True),
+        Column('did', Integer, ForeignKey('documents.did'), primary_key=True),
+    )
+
+    create_tables(connection, taken_orders, documents, submissions)
+    # Uploads are deduplicated by hash
+    create_index(connection, documents, 'ix_documents_sha256', 'sha256')
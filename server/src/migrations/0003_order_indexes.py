@@ -0,0 +1,19 @@
+# Indexes behind the order feed, the deadline filters and search
+from sqlalchemy import MetaData, Table
+
+from migrations.ops import create_index
+
+
+def upgrade(connection):
+    orders = Table('orders', MetaData(), autoload_with=connection)
+
+    # Keyset pagination walks (placed, oid)
+    create_index(connection, orders, 'ix_orders_placed_oid', 'placed', 'oid')
+    create_index(connection, orders, 'ix_orders_deadline', 'deadline')
+
+    # Other databases search with the in-process index instead
+    if connection.dialect.name == 'mysql':
+        create_index(
+            connection, orders, 'ft_orders_name_description', 'name', 'description',
+            mysql_prefix='FULLTEXT',
+        )
@@ -0,0 +1,18 @@
+# Change log behind the order set version, ETags and since= deltas
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, VARCHAR
+
+from migrations.ops import create_tables
+
+
+def upgrade(connection):
+    order_changes = Table(
+        'order_changes', MetaData(),
+        Column('version', Integer, primary_key=True, autoincrement=True),
+        Column('oid', Integer, nullable=False),
+        Column('kind', VARCHAR(16), nullable=False),
+        Column('changed', DateTime, nullable=False, default=datetime.now),
+    )
+
+    create_tables(connection, order_changes)
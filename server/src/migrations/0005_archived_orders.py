@@ -0,0 +1,21 @@
+# Archive the expired order sweeper moves orders into
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, Text, VARCHAR
+
+from migrations.ops import create_tables, create_index
+
+
+def upgrade(connection):
+    archived_orders = Table(
+        'archived_orders', MetaData(),
+        Column('oid', Integer, primary_key=True, autoincrement=False),
+        Column('name', VARCHAR(50), nullable=False),
+        Column('description', Text, nullable=False),
+        Column('deadline', DateTime, nullable=False),
+        Column('placed', DateTime, nullable=False),
+        Column('recipient', Integer, nullable=False),
+        Column('archived', DateTime, nullable=False),
+    )
+
+    create_tables(connection, archived_orders)
+    # A user's archived orders, newest first
+    create_index(connection, archived_orders, 'ix_archived_orders_recipient_placed', 'recipient', 'placed')
@@ -0,0 +1,12 @@
+# Rows pointing at an order or a user go with it, so deletes are a single statement
+from migrations.ops import cascade_foreign_key
+
+
+def upgrade(connection):
+    # SQLite doesn't enforce foreign keys unless asked to, MySQL.Delete removes those rows itself there
+    if connection.dialect.name != 'mysql':
+        return
+
+    for table in ('placed_orders', 'taken_orders', 'submissions'):
+        cascade_foreign_key(connection, table, 'oid', 'orders', 'oid')
+        cascade_foreign_key(connection, table, 'uid', 'users', 'uid')
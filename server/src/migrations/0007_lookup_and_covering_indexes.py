@@ -0,0 +1,24 @@
+# Lookups by oid on the link tables, and a covering index for the order feed
+from sqlalchemy import MetaData, Table
+
+from migrations.ops import create_index, drop_index
+
+
+def upgrade(connection):
+    metadata = MetaData()
+    orders = Table('orders', metadata, autoload_with=connection)
+    placed_orders = Table('placed_orders', metadata, autoload_with=connection)
+    taken_orders = Table('taken_orders', metadata, autoload_with=connection)
+    submissions = Table('submissions', metadata, autoload_with=connection)
+    order_changes = Table('order_changes', metadata, autoload_with=connection)
+
+    # Their primary keys start with uid, joins and checks by oid scanned them
+    create_index(connection, placed_orders, 'ix_placed_orders_oid', 'oid', 'uid')
+    create_index(connection, taken_orders, 'ix_taken_orders_oid', 'oid')
+    create_index(connection, submissions, 'ix_submissions_oid', 'oid')
+
+    # Same order as ix_orders_placed_oid with the feed's other columns, which it replaces
+    create_index(connection, orders, 'ix_orders_feed', 'placed', 'oid', 'deadline', 'name')
+    drop_index(connection, orders, 'ix_orders_placed_oid')
+
+    create_index(connection, order_changes, 'ix_order_changes_changed', 'changed')
@@ -0,0 +1,20 @@
+# An order has at most one taker, enforced by a unique index on taken_orders.oid
+from sqlalchemy import MetaData, Table, text
+
+from migrations.ops import create_index, drop_index
+
+
+def upgrade(connection):
+    # Orders taken twice before this keep their lowest uid, the derived table lets MySQL read the table it deletes from
+    connection.execute(text(
+        "DELETE FROM taken_orders WHERE EXISTS ("
+        "SELECT 1 FROM (SELECT oid, MIN(uid) AS uid FROM taken_orders GROUP BY oid) AS first "
+        "WHERE first.oid = taken_orders.oid AND first.uid < taken_orders.uid)"
+    ))
+
+    metadata = MetaData()
+    taken_orders = Table('taken_orders', metadata, autoload_with=connection)
+
+    # Created first, MySQL's foreign key on oid needs an index at all times
+    create_index(connection, taken_orders, 'ux_taken_orders_oid', 'oid', unique=True)
+    drop_index(connection, taken_orders, 'ix_taken_orders_oid')
@@ -0,0 +1,102 @@
+import importlib
+import os
+import re
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    Table,
+    func,
+    select,
+)
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+# Scripts are NNNN_description.py in this folder, each with an upgrade(connection) function
+SCRIPT_NAME = re.compile(r'^(\d{4})_(\w+)\.py$')
+migrations_dir = os.path.abspath(os.path.dirname(__file__))
+
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version',
+    version_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('applied', DateTime, nullable=False, server_default=func.now()),
+)
+
+
+class SchemaOutdated(Exception):
+    def __init__(self, current, head):
+        super().__init__(
+            f'Database schema is at version {current}, the code needs {head}. '
+            'Run: python migrate.py upgrade'
+        )
+        self.current = current
+        self.head = head
+
+
+def scripts():
+    """[(version, name, module)] oldest first"""
+    found = []
+    for filename in os.listdir(migrations_dir):
+        match = SCRIPT_NAME.match(filename)
+        if match:
+            version, name = match.groups()
+            found.append((int(version), name, filename[:-3]))
+    found.sort()
+
+    versions = [version for version, _, _ in found]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError('Two migrations share a version number')
+
+    return [(version, name, importlib.import_module(f'{__name__}.{module}')) for version, name, module in found]
+
+
+def head():
+    found = [int(SCRIPT_NAME.match(name).group(1)) for name in os.listdir(migrations_dir) if SCRIPT_NAME.match(name)]
+    return max(found, default=0)
+
+
+def current(connection):
+    # A single query, a missing table means nothing was applied yet
+    try:
+        return connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        connection.rollback()
+        return 0
+
+
+def check(engine):
+    """Cheap startup check, raises SchemaOutdated when migrations are pending"""
+    with engine.connect() as connection:
+        version = current(connection)
+
+    latest = head()
+    if version < latest:
+        raise SchemaOutdated(version, latest)
+    return version
+
+
+def upgrade(engine, target=None, log=print):
+    """Apply pending migrations up to target (default: all), each in its own transaction"""
+    version_metadata.create_all(bind=engine)
+
+    with engine.connect() as connection:
+        version = current(connection)
+
+    applied = []
+    for script_version, name, module in scripts():
+        if script_version <= version:
+            continue
+        if target is not None and script_version > target:
+            break
+
+        log(f'Applying {script_version:04d} {name}')
+        # MySQL commits DDL implicitly, scripts are written to be safe to rerun
+        with engine.begin() as connection:
+            module.upgrade(connection)
+            connection.execute(schema_version.insert().values(version=script_version))
+        applied.append(script_version)
+
+    return applied
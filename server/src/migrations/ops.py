@@ -0,0 +1,52 @@
+from sqlalchemy import Index, inspect
+
+# Helpers for migration scripts, everything checks first so a script can run again after a failure
+
+
+def create_tables(connection, *tables):
+    for table in tables:
+        table.create(bind=connection, checkfirst=True)
+
+
+def has_index(connection, table, name):
+    return any(index['name'] == name for index in inspect(connection).get_indexes(table))
+
+
+def create_index(connection, table, name, *columns, **kwargs):
+    """kwargs are Index() dialect options, like mysql_prefix='FULLTEXT'"""
+    if has_index(connection, table.name, name):
+        return False
+
+    Index(name, *[table.c[column] for column in columns], **kwargs).create(bind=connection)
+    return True
+
+
+def drop_index(connection, table, name):
+    """table has to be reflected, so it knows its indexes"""
+    for index in table.indexes:
+        if index.name == name:
+            index.drop(bind=connection)
+            return True
+    return False
+
+
+def cascade_foreign_key(connection, table, column, referred_table, referred_column):
+    """
+    Make the foreign key from table.column ON DELETE CASCADE. MySQL only, SQLite can't alter constraints.
+
+    DDL isn't transactional on MySQL, so the key is added back even if an earlier run only got to drop it.
+    """
+    name = f'fk_{table}_{column}'
+    for key in inspect(connection).get_foreign_keys(table):
+        if key['constrained_columns'] != [column] or key['referred_table'] != referred_table:
+            continue
+        if (key.get('options') or {}).get('ondelete', '').upper() == 'CASCADE':
+            return False
+        name = key['name']
+        connection.exec_driver_sql(f'ALTER TABLE `{table}` DROP FOREIGN KEY `{name}`')
+
+    connection.exec_driver_sql(
+        f'ALTER TABLE `{table}` ADD CONSTRAINT `{name}` FOREIGN KEY (`{column}`) '
+        f'REFERENCES `{referred_table}` (`{referred_column}`) ON DELETE CASCADE'
+    )
+    return True